@@ -78,3 +78,7 @@ then
 fi
 
 echo "Run 'python3 manage.py createsuperuser' to create superusers in the future."
+
+
+echo
+echo "Grades, queued jobs and mails are handled by 'python3 manage.py run_scheduler', which must run in a dedicated process (e.g. a systemd service), see README.md." | fold -s
@@ -6,10 +6,14 @@
 #       - Coumes Quentin <coumes.quentin@gmail.com>
 #
 
-from django.contrib import admin
+import requests
+import wimsapi
+from django.contrib import admin, messages
 from django.contrib.auth.models import Group
+from django.shortcuts import render
 
 from lti_app import models
+from lti_app.roster import provision, read_roster
 
 
 
@@ -28,6 +32,46 @@ class WIMSAdmin(admin.ModelAdmin):
 @admin.register(models.WimsClass)
 class WIMSClassAdmin(admin.ModelAdmin):
     list_display = ('id', 'wims', 'lms_guid', 'qclass')
+    actions = ['provision_roster']
+    
+    
+    def provision_roster(self, request, queryset):
+        """Ask for a roster, then create the WIMS accounts of its members in the selected class,
+        see roster.provision()."""
+        if queryset.count() != 1:
+            self.message_user(request, "Select a single class to provision a roster.",
+                              messages.ERROR)
+            return None
+        wclass_db = queryset.select_related("wims").get()
+        
+        if "apply" not in request.POST:
+            return render(request, "admin/lti_app/provision_roster.html", {
+                **self.admin_site.each_context(request),
+                "title": "Provision a roster",
+                "wclass": wclass_db,
+            })
+        
+        try:
+            members = read_roster(request.FILES["roster"].read().decode("utf-8-sig"))
+            report = provision(wclass_db, members)
+        except (KeyError, UnicodeDecodeError, ValueError) as e:
+            self.message_user(request, "Could not read the roster: %s" % str(e), messages.ERROR)
+        except (wimsapi.WimsAPIError, requests.RequestException) as e:
+            self.message_user(request, "Could not join the WIMS class: %s" % str(e),
+                              messages.ERROR)
+        else:
+            self.message_user(request, "Roster of class '%s' provisioned: %s"
+                              % (wclass_db.name, report))
+        return None
+    
+    
+    provision_roster.short_description = "Provision a roster"
+
+
+
+@admin.register(models.ClassCreation)
+class ClassCreationAdmin(admin.ModelAdmin):
+    list_display = ('id', 'lms', 'lms_guid', 'wims', 'created')
 
 
 
@@ -45,13 +89,53 @@ class ActivityAdmin(admin.ModelAdmin):
 
 @admin.register(models.GradeLinkSheet)
 class GradeLinkSheetAdmin(admin.ModelAdmin):
-    list_display = ('id', 'user', 'activity', 'sourcedid', 'url')
+    list_display = ('id', 'user', 'activity', 'sourcedid', 'url', 'last_score', 'last_sent')
 
 
 
 @admin.register(models.GradeLinkExam)
 class GradeLinkSheetExam(admin.ModelAdmin):
-    list_display = ('id', 'user', 'activity', 'sourcedid', 'url')
+    list_display = ('id', 'user', 'activity', 'sourcedid', 'url', 'last_score', 'last_sent')
+
+
+
+@admin.register(models.GradeSyncJob)
+class GradeSyncJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'sheet', 'exam', 'created')
+
+
+
+@admin.register(models.GradeOutbox)
+class GradeOutboxAdmin(admin.ModelAdmin):
+    list_display = ('id', 'lms', 'sheet_link', 'exam_link', 'grade', 'attempts', 'next_attempt')
+
+
+
+@admin.register(models.MailOutbox)
+class MailOutboxAdmin(admin.ModelAdmin):
+    list_display = ('id', 'subject', 'wclass', 'recipients', 'attempts', 'next_attempt')
+    exclude = ('body',)  # Contains the passwords of the class
+
+
+
+@admin.register(models.TaskLock)
+class TaskLockAdmin(admin.ModelAdmin):
+    list_display = ('id', 'name', 'owner', 'expires')
+
+
+
+@admin.register(models.GradeSyncShard)
+class GradeSyncShardAdmin(admin.ModelAdmin):
+    list_display = ('id', 'kind', 'wims', 'first_class', 'last_class', 'status', 'progress',
+                    'sent', 'failed', 'owner', 'lease_expires')
+    list_filter = ('kind', 'status', 'wims')
+    
+    
+    def progress(self, obj):
+        return "%d/%d" % (obj.classes_done, obj.classes_total)
+    
+    
+    progress.short_description = "Progress"
 
 
 
@@ -12,7 +12,11 @@ from apscheduler.schedulers.background import BackgroundScheduler
 from django.apps import AppConfig
 from django.conf import settings
 
-from lti_app import tasks
+# Importing registry and db connects the signals invalidating the registry and configuring the
+# database connections
+from lti_app import connections, db, mails, registry
+from lti_app.scheduler import create_scheduler
+from lti_app.worker import worker
 
 
 
@@ -60,19 +64,17 @@ class LtiAppConfig(AppConfig):
     
     
     def ready(self):
-        """Display warning for missing settings and set up scheduled tasks."""
-        
+        """Display warning for missing settings, check the reused database connections, pool the
+        requests sent to the WIMS servers, load the mail templates and, if
+        settings.WORKER_IN_PROCESS and settings.SCHEDULER_IN_PROCESS are True, start the worker
+        and the scheduled tasks."""
         display_warnings()
+        # After django.db.close_old_connections(), connected when django.db was imported
+        db.connect_signals()
+        connections.install_wimsapi_transport()
+        mails.templates.load()
         
-        scheduler = BackgroundScheduler(job_defaults={
-            'coalesce':           True,
-            'max_instances':      1,
-            'misfire_grace_time': 60 * 10,
-        })
-        scheduler.add_job(tasks.send_back_all_sheets_grades,
-                          trigger=settings.SEND_GRADE_BACK_CRON_TRIGGER)
-        scheduler.add_job(tasks.send_back_all_exams_grades,
-                          trigger=settings.SEND_GRADE_BACK_CRON_TRIGGER)
-        scheduler.add_job(tasks.check_classes_exists,
-                          trigger=settings.CHECK_CLASSES_EXISTS_CRON_TRIGGER)
-        scheduler.start()
+        if settings.WORKER_IN_PROCESS:
+            worker.start()
+        if settings.SCHEDULER_IN_PROCESS:
+            create_scheduler(BackgroundScheduler).start()
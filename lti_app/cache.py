@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+#
+#  cache.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+import copy
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, Tuple, Union
+
+import requests
+import wimsapi
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+
+class TTLCache:
+    """Thread-safe cache whose values expire <ttl> seconds after being computed.
+    
+    <ttl> can also be the name of a setting, read each time a value is stored. Concurrent calls
+    to get() for a same missing key compute the value only once (single-flight): the first call
+    computes it while the others wait for its result, or its exception. Exceptions are never
+    cached."""
+    
+    
+    def __init__(self, ttl: Union[float, str]):
+        self._ttl = ttl
+        self._entries: Dict[Hashable, Tuple[float, Any]] = {}
+        self._flights: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+    
+    
+    @property
+    def ttl(self) -> float:
+        """Number of seconds a value is kept in the cache."""
+        return getattr(settings, self._ttl) if isinstance(self._ttl, str) else self._ttl
+    
+    
+    def get(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        """Return the value of <key>, calling <compute> to compute it if it is missing or
+        expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() < entry[0]:
+                return entry[1]
+            
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Future()
+        
+        if not leader:
+            return flight.result()
+        
+        try:
+            value = compute()
+        except BaseException as e:
+            flight.set_exception(e)
+            raise
+        else:
+            with self._lock:
+                if self.ttl > 0:
+                    self._entries[key] = (time.monotonic() + self.ttl, value)
+            flight.set_result(value)
+            return value
+        finally:
+            with self._lock:
+                del self._flights[key]
+    
+    
+    def invalidate(self, key: Hashable) -> None:
+        """Remove <key> from the cache."""
+        with self._lock:
+            self._entries.pop(key, None)
+    
+    
+    def clear(self) -> None:
+        """Remove every key from the cache."""
+        with self._lock:
+            self._entries.clear()
+
+
+
+classes = TTLCache("WIMS_CLASS_CACHE_TTL")
+
+
+
+def class_key(wims: Any, qclass: str) -> Tuple[str, str, str, str]:
+    """Return the key of the class <qclass> of the WIMS server <wims> (a models.WIMS) in
+    classes."""
+    return wims.url, wims.ident, wims.rclass, str(qclass)
+
+
+
+def get_class(wims: Any, qclass: str) -> wimsapi.Class:
+    """Return the wimsapi.Class <qclass> of the WIMS server <wims> (a models.WIMS).
+    
+    The class is only retrieved from the WIMS server if it was not already retrieved during the
+    last settings.WIMS_CLASS_CACHE_TTL seconds, concurrent launches of a same class thus only
+    send a single request to the WIMS server. A shallow copy of the cached instance is returned,
+    so that callers cannot modify each other's instance attributes.
+    
+    Raises the same exceptions as wimsapi.Class.get()."""
+    wclass = classes.get(class_key(wims, qclass), lambda: wimsapi.Class.get(
+        wims.url, wims.ident, wims.passwd, qclass, wims.rclass, timeout=settings.WIMSAPI_TIMEOUT
+    ))
+    return copy.copy(wclass)
+
+
+
+def invalidate_class(wims: Any, qclass: str) -> None:
+    """Remove the class <qclass> of the WIMS server <wims> (a models.WIMS) from the cache,
+    e.g. when it does not exist anymore on the WIMS server."""
+    classes.invalidate(class_key(wims, qclass))
+
+
+
+class ServerHealth:
+    """Last known state of the WIMS servers.
+    
+    A server is known to be up for settings.WIMS_HEALTH_TTL seconds after a successful
+    'checkident' request, and known to be down for settings.WIMS_DOWN_TTL seconds after a
+    'checkident' request which could not join it."""
+    
+    
+    def __init__(self):
+        self._up = TTLCache("WIMS_HEALTH_TTL")
+        self._down: Dict[str, float] = {}
+        self._lock = threading.Lock()
+    
+    
+    def _checkident(self, wapi: wimsapi.WimsAPI) -> bool:
+        """Send a 'checkident' request to the WIMS server of <wapi>, recording it as down if it
+        could not be joined."""
+        try:
+            bol, response = wapi.checkident(verbose=True)
+        except requests.RequestException:
+            with self._lock:
+                self._down[wapi.url] = time.monotonic() + settings.WIMS_DOWN_TTL
+            raise
+        
+        if not bol:
+            raise wimsapi.WimsAPIError(response['message'])
+        
+        with self._lock:
+            self._down.pop(wapi.url, None)
+        return True
+    
+    
+    def check(self, wapi: wimsapi.WimsAPI) -> None:
+        """Check that the WIMS server of <wapi> is available.
+        
+        No request is sent if the server is known to be up. Concurrent checks of a same server
+        only send a single 'checkident' request.
+        
+        Raises:
+            - requests.ConnectionError if the server is known to be down.
+            - requests.RequestException if the server could not be joined.
+            - wimsapi.WimsAPIError if the server denied the request."""
+        with self._lock:
+            down = self._down.get(wapi.url)
+        if down is not None and time.monotonic() < down:
+            raise requests.ConnectionError("WIMS server '%s' is known to be down" % wapi.url)
+        
+        self._up.get((wapi.url, wapi.ident), lambda: self._checkident(wapi))
+    
+    
+    def clear(self) -> None:
+        """Forget the state of every WIMS server."""
+        self._up.clear()
+        with self._lock:
+            self._down.clear()
+
+
+
+health = ServerHealth()
+
+
+
+def check_server(wapi: wimsapi.WimsAPI) -> None:
+    """Check that the WIMS server of <wapi> is available, see ServerHealth.check()."""
+    health.check(wapi)
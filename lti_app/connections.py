@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+#
+#  connections.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+import logging
+import threading
+from typing import Dict
+from urllib.parse import urlsplit
+
+import requests
+import wimsapi
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+logger = logging.getLogger(__name__)
+
+
+
+class SessionRegistry:
+    """Process-wide registry of requests.Session, one for each host.
+    
+    Each session keeps a pool of at most settings.HTTP_POOL_SIZE connections to its host, so that
+    successive requests sent to a same LMS or WIMS server reuse an already established TCP/TLS
+    connection. Requests failing to connect are retried settings.HTTP_POOL_RETRIES times with an
+    exponential backoff of settings.HTTP_POOL_BACKOFF seconds. Requests which reached the server
+    are never retried, as adm/raw requests are not idempotent."""
+    
+    
+    def __init__(self):
+        self._sessions: Dict[str, requests.Session] = {}
+        self._lock = threading.Lock()
+    
+    
+    @staticmethod
+    def host(url: str) -> str:
+        """Return the key of <url> in the registry ('scheme://netloc')."""
+        url = urlsplit(url)
+        return "%s://%s" % (url.scheme, url.netloc.lower())
+    
+    
+    @staticmethod
+    def _create() -> requests.Session:
+        """Create a new session according to the settings."""
+        retry = Retry(
+            total=settings.HTTP_POOL_RETRIES, connect=settings.HTTP_POOL_RETRIES, read=0,
+            status=0, redirect=0, backoff_factor=settings.HTTP_POOL_BACKOFF,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.HTTP_POOL_SIZE,
+                              max_retries=retry)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        if not settings.HTTP_POOL_KEEP_ALIVE:
+            session.headers["Connection"] = "close"
+        return session
+    
+    
+    def get(self, url: str) -> requests.Session:
+        """Return the session corresponding to the host of <url>, creating it if needed."""
+        host = self.host(url)
+        session = self._sessions.get(host)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(host)
+                if session is None:
+                    session = self._sessions[host] = self._create()
+        return session
+    
+    
+    def post(self, url: str, **kwargs) -> requests.Response:
+        """Send a POST request to <url> using the session of its host."""
+        return self.get(url).post(url, **kwargs)
+    
+    
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Return, for each host, the number of requests sent, the number of connections opened
+        and the number of requests which reused an already opened connection.
+        
+        A pooled connection dropped by the server and transparently reopened by urllib3 is not
+        counted as a new connection."""
+        stats = {}
+        with self._lock:
+            sessions = dict(self._sessions)
+        
+        for host, session in sessions.items():
+            requests_count = connections = 0
+            for adapter in set(session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools.get(key)
+                    if pool is not None:
+                        requests_count += pool.num_requests
+                        connections += pool.num_connections
+            stats[host] = {
+                "requests":    requests_count,
+                "connections": connections,
+                "reused":      max(requests_count - connections, 0),
+            }
+        return stats
+    
+    
+    def summary(self) -> str:
+        """Return a one-line summary of stats()."""
+        return ", ".join(
+            "%s: %d requests, %d connections (%d reused)"
+            % (host, s["requests"], s["connections"], s["reused"])
+            for host, s in sorted(self.stats().items())
+        ) or "no request sent"
+    
+    
+    def clear(self) -> None:
+        """Close every session of the registry."""
+        with self._lock:
+            sessions, self._sessions = self._sessions, {}
+        for session in sessions.values():
+            session.close()
+
+
+
+registry = SessionRegistry()
+
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    """Send a POST request to <url> through the process-wide registry."""
+    return registry.post(url, **kwargs)
+
+
+
+def wimsapi_post(url: str, **kwargs) -> requests.Response:
+    """Replacement of wimsapi.api.post() sending the adm/raw requests through the registry.
+    
+    Like the original, convert strings to 'ISO-8859-1' before sending the post request."""
+    for k, v in kwargs["data"].items():
+        kwargs["data"][k] = v if not isinstance(v, str) else v.encode("ISO-8859-1")
+    kwargs["headers"] = {"Content-Type": "application/x-www-form-urlencoded; charset=ISO-8859-1"}
+    return registry.post(url, **kwargs)
+
+
+
+def install_wimsapi_transport() -> None:
+    """Make every wimsapi's adm/raw request use the pooled sessions of the registry.
+    
+    wimsapi sends all of its requests through the module-level function wimsapi.api.post(),
+    replacing it is enough for every WimsAPI, Class, User, Sheet and Exam to be pooled."""
+    wimsapi.api.post = wimsapi_post
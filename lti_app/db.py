@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+#
+#  db.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+import logging
+
+from django.core.signals import request_started
+from django.db import connections
+from django.db.backends.base.base import BaseDatabaseWrapper
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+
+logger = logging.getLogger(__name__)
+
+
+
+@receiver(connection_created)
+def apply_pragmas(sender: type, connection: BaseDatabaseWrapper, **kwargs) -> None:
+    """Apply the 'PRAGMAS' of the database settings (see wimsLTI/databases.py) to every new
+    SQLite connection."""
+    # The SQLite profile does not set CONN_MAX_AGE, each request thus opens a new connection and
+    # runs these pragmas again, including 'PRAGMA journal_mode=WAL': this cost is expected, the
+    # journal mode being already WAL it does not write anything
+    pragmas = connection.settings_dict.get("PRAGMAS") or {}
+    if connection.vendor != "sqlite" or not pragmas:
+        return
+    
+    with connection.cursor() as cursor:
+        for name, value in pragmas.items():
+            cursor.execute("PRAGMA %s = %s" % (name, value))
+    logger.debug("SQLite pragmas applied to '%s': %s" % (connection.alias, pragmas))
+
+
+
+def check_connections(**kwargs) -> None:
+    """Close the persistent connections of the databases whose settings enable
+    'CONN_HEALTH_CHECKS' if they are not usable anymore (e.g. the database server restarted),
+    a new connection being then opened by the request.
+    
+    Must be connected to request_started after django.db.close_old_connections(), so that only
+    the connections reused by the request are checked, see connect_signals()."""
+    for connection in connections.all():
+        if (connection.connection is None
+                or not connection.settings_dict.get("CONN_HEALTH_CHECKS")):
+            continue
+        if not connection.is_usable():
+            logger.warning("Connection to database '%s' is not usable anymore, reconnecting"
+                           % connection.alias)
+            connection.close()
+
+
+
+def connect_signals() -> None:
+    """Connect check_connections() to request_started.
+    
+    django.db connects close_old_connections() to request_started when it is imported, which
+    happens before the applications are loaded, and receivers are called in the order they were
+    connected: called from AppConfig.ready(), this function thus connects check_connections()
+    after it."""
+    request_started.connect(check_connections, dispatch_uid="lti_app.db.check_connections")
@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+#
+#  dispatch.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+import logging
+import math
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Hashable, List, Optional, Tuple
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+
+class DispatchReport:
+    """Statistics about the grades sent back to the LMS by a GradeDispatcher."""
+    
+    
+    def __init__(self):
+        self.sent = 0
+        self.skipped = 0
+        self.failed = 0
+        self.deferred = 0
+        self.latencies: List[float] = []
+        self.elapsed = 0.0
+    
+    
+    def __str__(self) -> str:
+        return (
+            ("%d sent, %d skipped, %d failed, %d deferred in %.2fs (%.1f grades/s - latency "
+             "p50: %dms, p90: %dms, p99: %dms)")
+            % (self.sent, self.skipped, self.failed, self.deferred, self.elapsed, self.throughput,
+               self.percentile(50) * 1000, self.percentile(90) * 1000, self.percentile(99) * 1000)
+        )
+    
+    
+    @property
+    def total(self) -> int:
+        """Number of grades sent, whether they were successfully sent or not."""
+        return self.sent + self.failed
+    
+    
+    @property
+    def throughput(self) -> float:
+        """Number of grades processed per second."""
+        return self.total / self.elapsed if self.elapsed else 0.0
+    
+    
+    def percentile(self, p: float) -> float:
+        """Return the <p>-th percentile (nearest-rank) of the latencies, in seconds."""
+        if not self.latencies:
+            return 0.0
+        latencies = sorted(self.latencies)
+        rank = max(math.ceil(p / 100 * len(latencies)), 1)
+        return latencies[rank - 1]
+    
+    
+    def record(self, success: bool, latency: float) -> None:
+        """Record the result of a single grade."""
+        if success:
+            self.sent += 1
+        else:
+            self.failed += 1
+        self.latencies.append(latency)
+
+
+
+class CircuitBreaker:
+    """Stop sending grades to a LMS once it failed to receive <threshold> grades in a row.
+    
+    The circuit of this LMS is then opened for <cooldown> seconds, during which allow() returns
+    False. Once this delay expired, a single grade is let through: the circuit is closed again if
+    it is successfully sent, or opened for another <cooldown> seconds otherwise."""
+    
+    
+    def __init__(self, threshold: int = None, cooldown: float = None):
+        self.threshold = threshold or settings.CIRCUIT_BREAKER_THRESHOLD
+        self.cooldown = cooldown or settings.CIRCUIT_BREAKER_COOLDOWN
+        self._failures: Dict[int, int] = defaultdict(int)
+        self._opened: Dict[int, float] = {}
+        self._lock = threading.Lock()
+    
+    
+    def allow(self, lms_id: int) -> bool:
+        """Return whether a grade can be sent to the LMS <lms_id>."""
+        with self._lock:
+            deadline = self._opened.get(lms_id)
+            if deadline is None:
+                return True
+            if time.monotonic() < deadline:
+                return False
+            # Half-open, let a single grade through until it succeeded or failed
+            self._opened[lms_id] = time.monotonic() + self.cooldown
+            return True
+    
+    
+    def record(self, lms_id: int, success: bool) -> None:
+        """Record whether a grade was successfully sent to the LMS <lms_id>."""
+        with self._lock:
+            if success:
+                self._failures.pop(lms_id, None)
+                if self._opened.pop(lms_id, None) is not None:
+                    logger.info("Circuit of LMS of pk '%d' closed" % lms_id)
+                return
+            
+            self._failures[lms_id] += 1
+            if self._failures[lms_id] >= self.threshold:
+                if lms_id not in self._opened:
+                    logger.warning("Circuit of LMS of pk '%d' opened after %d failures in a row"
+                                   % (lms_id, self._failures[lms_id]))
+                self._opened[lms_id] = time.monotonic() + self.cooldown
+    
+    
+    def opened(self) -> List[int]:
+        """Return the pk of every LMS whose circuit is currently opened."""
+        now = time.monotonic()
+        with self._lock:
+            return [lms_id for lms_id, deadline in self._opened.items() if now < deadline]
+    
+    
+    def reset(self) -> None:
+        """Close every circuit."""
+        with self._lock:
+            self._failures.clear()
+            self._opened.clear()
+
+
+
+circuit_breaker = CircuitBreaker()
+
+
+
+class KeyedExecutor:
+    """Run callables in a pool of <workers> threads, with at most <per_key> callables sharing the
+    same key running at once.
+    
+    A callable whose key already has <per_key> running callables is kept in the queue of this
+    key, and handed to the pool once one of them is done. The threads of the pool thus never
+    wait for a key to be available, and the callables of the other keys are not delayed."""
+    
+    
+    def __init__(self, workers: int, per_key: int, thread_name_prefix: str = ""):
+        self.per_key = per_key
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix=thread_name_prefix)
+        self._running: Dict[Hashable, int] = defaultdict(int)
+        self._queues: Dict[Hashable, Deque[Tuple[Future, Callable, tuple]]] = defaultdict(deque)
+        self._pending = 0
+        self._idle = threading.Condition()
+    
+    
+    def __enter__(self) -> 'KeyedExecutor':
+        return self
+    
+    
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.shutdown()
+    
+    
+    def _start(self, key: Hashable, future: Future, fn: Callable, args: tuple) -> None:
+        """Hand <fn> to the pool, its result being set in <future>."""
+        try:
+            task = self._executor.submit(fn, *args)
+        except Exception as e:  # pragma: no cover
+            self._done(key, future, None, e)
+            return
+        task.add_done_callback(lambda t: self._done(key, future, t))
+    
+    
+    def _done(self, key: Hashable, future: Future, task: Optional[Future],
+              error: BaseException = None) -> None:
+        """Called once a callable of <key> is done, start the next one queued for <key>."""
+        with self._idle:
+            queue = self._queues[key]
+            following = queue.popleft() if queue else None
+            if following is None:
+                self._running[key] -= 1
+        if following is not None:
+            self._start(key, *following)
+        
+        if task is not None:
+            error = task.exception()
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(task.result())
+        
+        with self._idle:
+            self._pending -= 1
+            if not self._pending:
+                self._idle.notify_all()
+    
+    
+    def submit(self, key: Hashable, fn: Callable, *args: Any) -> Future:
+        """Schedule <fn>(*<args>) to be run once fewer than <per_key> callables of <key> are
+        running, returning a Future of its result."""
+        future = Future()
+        with self._idle:
+            self._pending += 1
+            if self._running[key] >= self.per_key:
+                self._queues[key].append((future, fn, args))
+                return future
+            self._running[key] += 1
+        self._start(key, future, fn, args)
+        return future
+    
+    
+    def shutdown(self) -> None:
+        """Wait for every submitted callable to be run, and release the threads of the pool."""
+        with self._idle:
+            self._idle.wait_for(lambda: not self._pending)
+        self._executor.shutdown()
+
+
+
+class GradeDispatcher:
+    """Send grades back to the LMSs concurrently.
+    
+    At most <workers> grades are sent at the same time, and at most <per_lms> of them to the same
+    LMS. Grades are queued with submit(), join() waits for every queued grade to be sent and
+    returns a DispatchReport. Grades which do not need to be sent can be reported with skip().
+    The grades of a LMS which already receives <per_lms> grades wait in a queue of this LMS (see
+    KeyedExecutor), so that they do not delay the grades of the other LMSs.
+    
+    Grades are not sent to LMSs whose circuit is opened in <breaker> (the process-wide breaker by
+    default), they are deferred instead.
+    
+    Once every grade has been sent, the grade links which were successfully sent are saved
+    through their model's mark_sent() class method, and the grades which failed or were deferred
+    are queued to be sent again later through their model's defer() class method, both in the
+    calling thread.
+    
+    Worker threads only perform the HTTP request, every grade link should thus be retrieved with
+    its 'lms', 'user' and 'activity__wclass' relations already loaded."""
+    
+    
+    def __init__(self, workers: int = None, per_lms: int = None, breaker: CircuitBreaker = None):
+        self.workers = workers or settings.SEND_GRADE_BACK_WORKERS
+        self.per_lms = per_lms or settings.SEND_GRADE_BACK_PER_LMS
+        self.breaker = breaker or circuit_breaker
+        self.report = DispatchReport()
+        self._executor = KeyedExecutor(self.workers, self.per_lms, "grade-dispatcher")
+        self._pending: List[Tuple[Any, float, Future]] = []
+        self._start = time.perf_counter()
+    
+    
+    def __enter__(self) -> 'GradeDispatcher':
+        return self
+    
+    
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.join()
+    
+    
+    def _send(self, gl: Any, grade: float) -> Tuple[Optional[bool], float]:
+        """Send <grade> through <gl>, returning whether it succeeded and how long it took.
+        
+        Returns None instead of a boolean if the circuit of the LMS is opened."""
+        if not self.breaker.allow(gl.lms_id):
+            return None, 0.0
+        
+        start = time.perf_counter()
+        try:
+            success = gl.send_back(grade)
+        except Exception:
+            self.breaker.record(gl.lms_id, False)
+            raise
+        self.breaker.record(gl.lms_id, success)
+        return success, time.perf_counter() - start
+    
+    
+    def submit(self, gl: Any, grade: float) -> Future:
+        """Queue <grade> to be sent back to the LMS through the grade link <gl>."""
+        future = self._executor.submit(gl.lms_id, self._send, gl, grade)
+        self._pending.append((gl, grade, future))
+        return future
+    
+    
+    def skip(self, count: int = 1) -> None:
+        """Report <count> grades as not needing to be sent."""
+        self.report.skipped += count
+    
+    
+    def flush(self) -> None:
+        """Wait for every grade queued so far to be sent, and save the grade links through their
+        model (see the class' docstring). The dispatcher can still be used afterward."""
+        pending, self._pending = self._pending, []
+        sent: Dict[type, List[Tuple[Any, float]]] = defaultdict(list)
+        failed: Dict[type, List[Tuple[Any, float]]] = defaultdict(list)
+        deferred: Dict[type, List[Tuple[Any, float]]] = defaultdict(list)
+        for gl, grade, future in pending:
+            try:
+                success, latency = future.result()
+            except Exception:
+                logger.exception("An error occurred while sending grade of %s" % str(gl))
+                success, latency = False, 0.0
+            
+            if success is None:
+                self.report.deferred += 1
+                deferred[type(gl)].append((gl, grade))
+                continue
+            self.report.record(success, latency)
+            (sent if success else failed)[type(gl)].append((gl, grade))
+        
+        for model, links in sent.items():
+            model.mark_sent(links)
+        for model, links in failed.items():
+            model.defer(links)
+        for model, links in deferred.items():
+            model.defer(links, attempted=False)
+    
+    
+    def join(self) -> DispatchReport:
+        """Wait for every queued grade to be sent and return the report of this dispatcher."""
+        self.flush()
+        self._executor.shutdown()
+        self.report.elapsed = time.perf_counter() - self._start
+        return self.report
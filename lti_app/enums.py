@@ -7,11 +7,23 @@
 #
 
 import logging
+import re
+import time
 from enum import Enum
+from functools import lru_cache
+from typing import Dict, FrozenSet
 
 
 logger = logging.getLogger(__name__)
 
+# Matches a single LTI role, either as a short label or as an URN, capturing the role's name
+ROLE_REGEX = re.compile(r"\s*(?:urn:lti:(?:instrole|sysrole|role):ims/lis/)?(.*?)\s*")
+
+# Minimum number of seconds between two warnings about the same unknown LTI role
+UNKNOWN_ROLE_WARNING_INTERVAL = 3600
+
+_unknown_roles: Dict[str, float] = {}
+
 
 
 class Role(Enum):
@@ -34,23 +46,41 @@ class Role(Enum):
     
     
     @classmethod
-    def parse_role_lti(cls, role: str) -> 'Role':
-        """Returns the list of Roles' enums corresponding to the LTI roles.
+    def parse_role_lti(cls, role: str) -> FrozenSet['Role']:
+        """Returns the frozenset of Roles' enums corresponding to the LTI roles.
+        
+            Results are cached by <role>, as LMSs send the same few role strings over and over.
     
             Parameter:
                 role - (str) The role string retrieved from the LTI request."""
-        ret = []
-        roles = [
-            (r.replace("urn:lti:instrole:ims/lis/", "")
-             .replace("urn:lti:sysrole:ims/lis/", "")
-             .replace("urn:lti:role:ims/lis/", "")
-             .strip())
-            for r in role.split(",")
-        ]
-        for r in roles:
-            try:
-                ret.append(Role(r.title()))
-            except ValueError:
-                logger.warning("Received unknown LTI role: '%s'" % r)
-        
-        return ret
+        return _parse_role_lti(role)
+
+
+
+def _warn_unknown_role(role: str) -> None:
+    """Log a warning about the unknown LTI role <role>, at most once every
+    UNKNOWN_ROLE_WARNING_INTERVAL seconds for a same role."""
+    now = time.monotonic()
+    last = _unknown_roles.get(role)
+    if last is not None and now - last < UNKNOWN_ROLE_WARNING_INTERVAL:
+        return
+    
+    if len(_unknown_roles) >= 1024:  # Keep memory bounded against arbitrary roles
+        _unknown_roles.clear()
+    _unknown_roles[role] = now
+    logger.warning("Received unknown LTI role: '%s'" % role)
+
+
+
+@lru_cache(maxsize=256)
+def _parse_role_lti(role: str) -> FrozenSet[Role]:
+    """Parse <role>, see Role.parse_role_lti()."""
+    ret = set()
+    for r in role.split(","):
+        name = ROLE_REGEX.fullmatch(r).group(1)
+        try:
+            ret.add(Role(name.title()))
+        except ValueError:
+            _warn_unknown_role(name)
+    
+    return frozenset(ret)
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+#
+#  launch.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Optional, Tuple, Type
+
+import requests
+import wimsapi
+from django.conf import settings
+from django.http import (Http404, HttpRequest, HttpResponse, HttpResponseBadRequest,
+                         HttpResponseForbidden, HttpResponseNotAllowed, HttpResponseNotFound)
+from django.shortcuts import redirect
+from django.urls import reverse
+from wimsapi.item import ClassItemABC
+
+from lti_app import cache
+from lti_app.exceptions import BadRequestException
+from lti_app.metrics import Timing
+from lti_app.models import (GradeLinkBase, GradeLinkExam, GradeLinkSheet, GradeSyncJob, LMS, WIMS,
+                            WimsClass)
+from lti_app.registry import registry
+from lti_app.utils import (LaunchContext, MODE, get_exam, get_or_create_class,
+                           get_or_create_user, get_sheet, is_valid_request, parse_launch)
+from lti_app.worker import worker
+
+
+logger = logging.getLogger(__name__)
+
+GET_ERROR_MSG = """405 Method Not Allowed: 'GET'<br><br>
+This is usually caused by one of the following reason:
+<ul>
+    <li>Missing trailing slash '/' at the end of the URL
+        (eg: "%s" instead of "%s").</li>
+    <li>Used this URL outside of an LTI activity.</li>
+</ul>
+"""
+
+# Requests sent to the WIMS servers concurrently with the other stages of a launch, see launch()
+executor = ThreadPoolExecutor(settings.LAUNCH_WORKERS, thread_name_prefix="launch")
+
+
+
+class ActivityStage:
+    """Stages of a launch specific to a kind of activity (a WIMS item the user is redirected to,
+    whose grades are sent back to the LMS).
+    
+    Subclasses define the wimsapi <item> class, the GradeLink <link> model, and how the
+    activity is saved, whether it is available and the parameters of its WIMS URL."""
+    
+    name: str
+    label: str
+    item: Type[ClassItemABC]
+    link: Type[GradeLinkBase]
+    
+    
+    def fetch(self, wclass: wimsapi.Class, pk: int) -> Any:
+        """Retrieve the item <pk> of <wclass> from the WIMS server."""
+        return wclass.getitem(pk, self.item)
+    
+    
+    def save(self, wclass_db: WimsClass, wclass: wimsapi.Class, pk: int,
+             parameters: LaunchContext, item: Any) -> Any:
+        """Get or create the model of <item>."""
+        raise NotImplementedError  # pragma: no cover
+    
+    
+    def mode(self, item: Any) -> int:
+        """Return the mode of <item> (see utils.MODE)."""
+        raise NotImplementedError  # pragma: no cover
+    
+    
+    def ident(self, item: Any) -> str:
+        """Return the identifier of <item> on the WIMS server."""
+        raise NotImplementedError  # pragma: no cover
+    
+    
+    def url_params(self, wclass: wimsapi.Class, item: Any) -> str:
+        """Return the parameters appended to the home URL of the user to open <item>."""
+        raise NotImplementedError  # pragma: no cover
+
+
+
+class SheetStage(ActivityStage):
+    name = "sheet"
+    label = "WIMS sheet"
+    item = wimsapi.Sheet
+    link = GradeLinkSheet
+    
+    
+    def save(self, wclass_db: WimsClass, wclass: wimsapi.Class, pk: int,
+             parameters: LaunchContext, item: wimsapi.Sheet) -> Any:
+        return get_sheet(wclass_db, wclass, pk, parameters, item)[0]
+    
+    
+    def mode(self, item: wimsapi.Sheet) -> int:
+        return int(item.sheetmode)
+    
+    
+    def ident(self, item: wimsapi.Sheet) -> str:
+        return str(item.qsheet)
+    
+    
+    def url_params(self, wclass: wimsapi.Class, item: wimsapi.Sheet) -> str:
+        return "&lang=%s&module=adm%%2Fsheet&sh=%s" % (wclass.lang, str(item.qsheet))
+
+
+
+class ExamStage(ActivityStage):
+    name = "exam"
+    label = "exam"
+    item = wimsapi.Exam
+    link = GradeLinkExam
+    
+    
+    def save(self, wclass_db: WimsClass, wclass: wimsapi.Class, pk: int,
+             parameters: LaunchContext, item: wimsapi.Exam) -> Any:
+        return get_exam(wclass_db, wclass, pk, parameters, item)[0]
+    
+    
+    def mode(self, item: wimsapi.Exam) -> int:
+        return int(item.exammode)
+    
+    
+    def ident(self, item: wimsapi.Exam) -> str:
+        return str(item.qexam)
+    
+    
+    def url_params(self, wclass: wimsapi.Class, item: wimsapi.Exam) -> str:
+        return ("&lang=%s&module=adm%%2Fclass%%2Fexam&+job=student&+exam=%s"
+                % (wclass.lang, str(item.qexam)))
+
+
+
+SHEET = SheetStage()
+EXAM = ExamStage()
+
+
+
+def get_class(wims_srv: WIMS, lms: LMS, parameters: LaunchContext
+              ) -> Tuple[WimsClass, Optional[wimsapi.Class]]:
+    """Get the existing class of the launch.
+    
+    If the class was deleted from the WIMS server, its WimsClass is deleted and None is returned
+    instead of the wimsapi.Class.
+    
+    Raises WimsClass.DoesNotExist if the class does not exist."""
+    wclass_db = WimsClass.objects.get(wims=wims_srv, lms=lms, lms_guid=parameters['context_id'])
+    
+    try:
+        return wclass_db, cache.get_class(wims_srv, wclass_db.qclass)
+    except wimsapi.WimsAPIError as e:
+        if "not existing" in str(e):  # Class was deleted on the WIMS server
+            cache.invalidate_class(wims_srv, wclass_db.qclass)
+            logger.info(("Deleting class (id : %d - wims id : %s - lms id : %s) as it was"
+                         "deleted from the WIMS server")
+                        % (wclass_db.id, str(wclass_db.qclass), str(wclass_db.lms_guid)))
+            wclass_db.delete()
+            return wclass_db, None
+        raise  # Unknown error (pragma: no cover)
+
+
+
+def launch(request: HttpRequest, wims_pk: int, activity: ActivityStage = None,
+           activity_pk: int = None) -> HttpResponse:
+    """Run the LTI launch <request>, redirecting the client to the WIMS server <wims_pk>, in the
+    class of the launch, and in the activity <activity_pk> if <activity> is given.
+    
+    Without <activity>, the class is created if it does not exist. Otherwise, the item is
+    retrieved from the WIMS server concurrently with the user (unless
+    settings.LAUNCH_CONCURRENT is False), as these requests are independent.
+    
+    See views.wims_class(), views.wims_sheet() and views.wims_exam() for the responses."""
+    timing = getattr(request, "timing", None) or Timing("launch")
+    
+    if request.method == "GET":
+        uri = request.build_absolute_uri()
+        return HttpResponseNotAllowed(["POST"], GET_ERROR_MSG % (uri[:-1], uri))
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"], "405 Method Not Allowed: '%s'" % request.method)
+    
+    try:
+        logger.info("Request received from '%s'" % request.META.get('HTTP_REFERER', "Unknown"))
+        parameters = parse_launch(request.POST)
+        is_valid_request(request, parameters)
+        timing.lap("oauth")
+    except BadRequestException as e:
+        logger.info(str(e))
+        return HttpResponseBadRequest(str(e))
+    
+    # Retrieve the WIMS server
+    try:
+        wims_srv = registry.get_wims(wims_pk)
+    except WIMS.DoesNotExist:
+        raise Http404("Unknown WIMS server of id '%d'" % wims_pk)
+    
+    # Retrieve the LMS
+    try:
+        lms = registry.get_lms_by_guid(parameters["tool_consumer_instance_guid"])
+    except LMS.DoesNotExist:
+        raise Http404("No LMS found with guid '%s'" % parameters["tool_consumer_instance_guid"])
+    timing.label(wims=wims_srv.name, lms=lms.guid)
+    timing.lap("lookup")
+    
+    wapi = wimsapi.WimsAPI(wims_srv.url, wims_srv.ident, wims_srv.passwd)
+    
+    try:
+        # Check that the WIMS server is available
+        cache.check_server(wapi)
+        timing.lap("checkident")
+        
+        # Get the class, creating it when launching the class itself
+        if activity is None:
+            wclass_db, wclass = get_or_create_class(lms, wims_srv, wapi, parameters)
+        else:
+            wclass_db, wclass = get_class(wims_srv, lms, parameters)
+            if wclass is None:
+                return HttpResponseNotFound(
+                    ("Class of ID %s could not be found on the WIMS server. Maybe it has been "
+                     "deleted from the WIMS server. Use this LTI link on your LMS to create a new "
+                     "WIMS class: %s")
+                    % (wclass_db.qclass,
+                       request.build_absolute_uri(reverse("lti:wims_class", args=[wims_pk])))
+                )
+        timing.lap("class")
+        
+        # The item does not depend on the user, it is retrieved in the meantime
+        pending: Optional[Future] = None
+        if activity is not None:
+            if settings.LAUNCH_CONCURRENT:
+                pending = executor.submit(activity.fetch, wclass, activity_pk)
+            else:
+                pending = Future()
+                pending.set_result(activity.fetch(wclass, activity_pk))
+        
+        # Check whether the user already exists, creating it otherwise
+        user_db, user = get_or_create_user(wclass_db, wclass, parameters)
+        timing.lap("user")
+        
+        params = "&lang=%s" % wclass.lang
+        if activity is not None:
+            # Check whether the activity already exists, creating it otherwise
+            item = pending.result()
+            activity_db = activity.save(wclass_db, wclass, activity_pk, parameters, item)
+            timing.lap(activity.name)
+            if activity.mode(item) not in [1, 2]:  # not active or expired
+                return HttpResponseForbidden(
+                    "This %s (%s) is currently unavailable (%s)"
+                    % (activity.label, activity.ident(item), MODE[activity.mode(item)])
+                )
+            
+            # Storing the URL and ID to send the grade back to the LMS
+            activity.link.upsert(user_db, activity_db, lms, parameters["lis_result_sourcedid"],
+                                 parameters["lis_outcome_service_url"])
+            timing.lap("grade_link")
+            
+            # If user is a teacher, send all grade back to the LMS in the background
+            if parameters.is_teacher and GradeSyncJob.enqueue(activity_db):
+                worker.notify()
+            timing.lap("send_back_all")
+            
+            params = activity.url_params(wclass, item)
+        
+        # Trying to authenticate the user on the WIMS server
+        bol, response = wapi.authuser(wclass.qclass, wclass.rclass, user.quser)
+        if not bol:  # pragma: no cover
+            raise wimsapi.WimsAPIError(response['message'])
+        timing.lap("authuser")
+        
+        url = response["home_url"] + params
+    
+    except WimsClass.DoesNotExist as e:
+        logger.info(str(e))
+        return HttpResponseNotFound("Could not find class of id '%s'" % parameters['context_id'])
+    
+    except wimsapi.WimsAPIError as e:  # WIMS server responded with ERROR
+        logger.info(str(e))
+        return HttpResponse(str(e), status=502)
+    
+    except requests.RequestException:
+        logger.exception("Could not join the WIMS server '%s'" % wims_srv.url)
+        return HttpResponse("Could not join the WIMS server '%s'" % wims_srv.url, status=504)
+    
+    return redirect(url)
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+#
+#  mails.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+import logging
+import os
+import string
+import threading
+from typing import Any, Dict, Tuple
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+
+class MailTemplates:
+    """Title and body templates of the credentials mail, for every language of <root>
+    (settings.MAIL_ROOT by default, see its README.md).
+    
+    Templates are read and checked once, when the application is ready (or on first use), instead
+    of for every mail. A malformed template thus fails at startup rather than when a class is
+    created."""
+    
+    
+    def __init__(self, root: str = None):
+        self._root = root
+        self._templates: Dict[str, Tuple[str, str]] = None
+        self._lock = threading.Lock()
+    
+    
+    def load(self) -> None:
+        """Read the templates of every language.
+        
+        Raises ValueError if a template contains a malformed field."""
+        root = self._root or settings.MAIL_ROOT
+        templates = {}
+        for lang in sorted(os.listdir(root)):
+            tpath = os.path.join(root, lang, "title.txt")
+            bpath = os.path.join(root, lang, "body.txt")
+            if not (os.path.isfile(tpath) and os.path.isfile(bpath)):
+                continue
+            with open(tpath) as t, open(bpath) as b:
+                title, body = t.read(), b.read()
+            for template in (title, body):
+                list(string.Formatter().parse(template))
+            templates[lang] = (title, body)
+        
+        with self._lock:
+            self._templates = templates
+        logger.debug("Mail templates loaded (%s)" % ", ".join(templates))
+    
+    
+    def render(self, lang: str, params: Dict[str, Any]) -> Tuple[str, str]:
+        """Return the title and the body of the mail in <lang>, English being used if <lang> has
+        no template."""
+        if self._templates is None:
+            self.load()
+        
+        title, body = self._templates.get(lang) or self._templates["en"]
+        return title.format(**params).rstrip(), body.format(**params)
+
+
+
+templates = MailTemplates()
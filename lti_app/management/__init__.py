@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+#
+#  __init__.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
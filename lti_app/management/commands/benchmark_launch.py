@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+#
+#  benchmark_launch.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+import time
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test import RequestFactory, override_settings
+from django.urls import Resolver404, resolve
+from oauthlib.oauth1 import SIGNATURE_TYPE_BODY
+from oauthlib.oauth1.rfc5849 import Client
+
+from lti_app.dispatch import DispatchReport
+from lti_app.management.commands.load_test import launch_parameters
+
+
+
+class Command(BaseCommand):
+    help = ("Compare the latency of the launches of a sheet or an exam when the activity and the "
+            "user are retrieved from the WIMS server concurrently (LAUNCH_CONCURRENT) and "
+            "sequentially. The launches are run in this process, with the database of its "
+            "settings: the LMS of guid 'load-test' must exist with the given key and secret, and "
+            "the class of the launches must already exist. The launches do create users on the "
+            "WIMS server: use a test WIMS server.")
+    
+    
+    def add_arguments(self, parser):
+        parser.add_argument("url", help="LTI URL of a sheet or an exam, its host must be in "
+                                        "ALLOWED_HOSTS")
+        parser.add_argument("--key", required=True, help="key of the 'load-test' LMS")
+        parser.add_argument("--secret", required=True, help="secret of the 'load-test' LMS")
+        parser.add_argument("--launches", type=int, default=50,
+                            help="number of launches in each mode (default: 50)")
+        parser.add_argument("--users", type=int, default=10,
+                            help="number of distinct users launching (default: 10)")
+        parser.add_argument("--context", default="load-test",
+                            help="context_id of the launches (default: 'load-test')")
+    
+    
+    def handle(self, *args, **options):
+        if options["launches"] < 1 or options["users"] < 1:
+            raise CommandError("--launches and --users must be positive")
+        
+        url = urlsplit(options["url"])
+        try:
+            match = resolve(url.path)
+        except Resolver404:
+            raise CommandError("'%s' is not an LTI URL of wims-lti" % options["url"])
+        if match.url_name not in ("wims_sheet", "wims_exam"):
+            raise CommandError("'%s' is not the LTI URL of a sheet or an exam" % options["url"])
+        
+        client = Client(options["key"], client_secret=options["secret"],
+                        signature_type=SIGNATURE_TYPE_BODY)
+        factory = RequestFactory(HTTP_HOST=url.netloc)
+        
+        def launch(i: int) -> bool:
+            params = launch_parameters(i, options["users"], options["context"], "Learner")
+            _, _, body = client.sign(
+                options["url"], "POST", body=params,
+                headers={"Content-Type": "application/x-www-form-urlencoded"},
+            )
+            request = factory.post(url.path, body, secure=url.scheme == "https",
+                                   content_type="application/x-www-form-urlencoded")
+            return match.func(request, *match.args, **match.kwargs).status_code == 302
+        
+        for concurrent in (False, True):
+            report = DispatchReport()
+            with override_settings(LAUNCH_CONCURRENT=concurrent):
+                start = time.perf_counter()
+                for i in range(options["launches"]):
+                    launch_start = time.perf_counter()
+                    succeeded = launch(i)
+                    report.record(succeeded, time.perf_counter() - launch_start)
+                report.elapsed = time.perf_counter() - start
+            
+            self.stdout.write(
+                "LAUNCH_CONCURRENT=%s: %d succeeded, %d failed in %.2fs - latency p50: %dms, "
+                "p90: %dms, p99: %dms"
+                % (concurrent, report.sent, report.failed, report.elapsed,
+                   report.percentile(50) * 1000, report.percentile(90) * 1000,
+                   report.percentile(99) * 1000)
+            )
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+#
+#  benchmark_parsing.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+import time
+from urllib.parse import parse_qsl
+
+from django.core.management.base import BaseCommand, CommandError
+from oauthlib.oauth1 import SIGNATURE_TYPE_BODY
+from oauthlib.oauth1.rfc5849 import Client
+
+from lti_app.management.commands.load_test import launch_parameters
+from lti_app.utils import parse_launch
+
+
+
+class Command(BaseCommand):
+    help = ("Measure how long parsing and checking the parameters of a signed LTI launch takes, "
+            "without sending any request (see the 'load_test' command to measure whole launches).")
+    
+    
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=10_000,
+                            help="number of launches parsed (default: 10000)")
+        parser.add_argument("--role", default="Learner,urn:lti:role:ims/lis/Instructor",
+                            help="roles of the launches (default: "
+                                 "'Learner,urn:lti:role:ims/lis/Instructor')")
+    
+    
+    def handle(self, *args, **options):
+        if options["iterations"] < 1:
+            raise CommandError("--iterations must be positive")
+        
+        client = Client("key", client_secret="secret", signature_type=SIGNATURE_TYPE_BODY)
+        _, _, body = client.sign(
+            "https://wims-lti.invalid/lti/1/", "POST",
+            body=launch_parameters(0, 1, "benchmark", options["role"]),
+            headers={"Content-Type": "application/x-www-form-urlencoded"},
+        )
+        params = dict(parse_qsl(body))
+        
+        start = time.perf_counter()
+        for _ in range(options["iterations"]):
+            parse_launch(params).is_teacher
+        elapsed = time.perf_counter() - start
+        
+        self.stdout.write("Parsed %d launches in %.3fs: %.1fus per launch"
+                          % (options["iterations"], elapsed,
+                             elapsed / options["iterations"] * 1_000_000))
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+#
+#  load_test.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Tuple
+
+import requests
+from django.core.management.base import BaseCommand, CommandError
+from oauthlib.oauth1 import SIGNATURE_TYPE_BODY
+from oauthlib.oauth1.rfc5849 import Client
+
+from lti_app.dispatch import DispatchReport
+
+
+
+def launch_parameters(i: int, users: int, context: str, role: str) -> Dict[str, str]:
+    """Return the parameters of the <i>-th launch, sent by one of <users> users."""
+    user = i % users
+    return {
+        'lti_message_type':                   'basic-lti-launch-request',
+        'lti_version':                        'LTI-1p0',
+        'launch_presentation_locale':         'en',
+        'resource_link_id':                   'load-test',
+        'context_id':                         context,
+        'context_title':                      'Load test',
+        'user_id':                            'load-test-%d' % user,
+        'lis_result_sourcedid':               'load-test-%d' % user,
+        'lis_outcome_service_url':            'https://lms.invalid/outcome',
+        'lis_person_contact_email_primary':   'load-test-%d@lms.invalid' % user,
+        'lis_person_name_family':             'Test%d' % user,
+        'lis_person_name_given':              'Load',
+        'tool_consumer_instance_description': 'Load test',
+        'tool_consumer_instance_guid':        'load-test',
+        'roles':                              role,
+    }
+
+
+
+class Command(BaseCommand):
+    help = ("Send concurrent signed LTI launches to a running wims-lti server and report its "
+            "throughput and latency. Run it once per database profile of the server (see "
+            "wimsLTI/databases.py) to compare them. The LMS of guid 'load-test' must exist on the "
+            "server with the given key and secret, and the launches do create users on the WIMS "
+            "server: use a test WIMS server.")
+    
+    
+    def add_arguments(self, parser):
+        parser.add_argument("url", help="LTI URL of a class, a sheet or an exam")
+        parser.add_argument("--key", required=True, help="key of the 'load-test' LMS")
+        parser.add_argument("--secret", required=True, help="secret of the 'load-test' LMS")
+        parser.add_argument("--launches", type=int, default=500,
+                            help="total number of launches (default: 500)")
+        parser.add_argument("--concurrency", type=int, default=16,
+                            help="number of concurrent launches (default: 16)")
+        parser.add_argument("--users", type=int, default=100,
+                            help="number of distinct users launching (default: 100)")
+        parser.add_argument("--context", default="load-test",
+                            help="context_id of the launches (default: 'load-test')")
+        parser.add_argument("--role", default="Learner",
+                            help="roles of the launches (default: 'Learner'), the class must "
+                                 "already exist unless it is 'Instructor'")
+    
+    
+    def handle(self, *args, **options):
+        if options["launches"] < 1 or options["concurrency"] < 1 or options["users"] < 1:
+            raise CommandError("--launches, --concurrency and --users must be positive")
+        
+        client = Client(options["key"], client_secret=options["secret"],
+                        signature_type=SIGNATURE_TYPE_BODY)
+        local = threading.local()
+        
+        def launch(i: int) -> Tuple[int, float]:
+            if not hasattr(local, "session"):
+                local.session = requests.Session()
+            params = launch_parameters(i, options["users"], options["context"], options["role"])
+            uri, headers, body = client.sign(
+                options["url"], "POST", body=params, realm=None,
+                headers={"Content-Type": "application/x-www-form-urlencoded"},
+            )
+            start = time.perf_counter()
+            try:
+                response = local.session.post(uri, data=body, headers=headers,
+                                              allow_redirects=False, timeout=60)
+                status = response.status_code
+            except requests.RequestException:
+                status = 0
+            return status, time.perf_counter() - start
+        
+        self.stdout.write("Sending %d launches (%d concurrent) to %s"
+                          % (options["launches"], options["concurrency"], options["url"]))
+        
+        report = DispatchReport()
+        statuses = Counter()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(options["concurrency"]) as executor:
+            for status, latency in executor.map(launch, range(options["launches"])):
+                report.record(status == 302, latency)
+                statuses[status] += 1
+        report.elapsed = time.perf_counter() - start
+        
+        self.stdout.write(
+            "%d succeeded, %d failed in %.2fs: %.1f launches/s - latency p50: %dms, p90: %dms, "
+            "p99: %dms"
+            % (report.sent, report.failed, report.elapsed, report.throughput,
+               report.percentile(50) * 1000, report.percentile(90) * 1000,
+               report.percentile(99) * 1000)
+        )
+        self.stdout.write("Status codes: %s" % ", ".join(
+            "%s: %d" % (status or "connection error", count)
+            for status, count in sorted(statuses.items())
+        ))
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+#
+#  provision_roster.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+import requests
+import wimsapi
+from django.core.management.base import BaseCommand, CommandError
+
+from lti_app.models import WimsClass
+from lti_app.roster import provision, read_roster
+
+
+
+class Command(BaseCommand):
+    help = ("Create the WIMS accounts of every member of a roster (CSV or JSON membership export) "
+            "in a class ahead of their first launch. Can be run again to resume an interrupted "
+            "provisioning.")
+    
+    
+    def add_arguments(self, parser):
+        parser.add_argument("wclass", type=int, help="pk of the WimsClass")
+        parser.add_argument("roster", help="path to the roster")
+        parser.add_argument("--workers", type=int, default=None,
+                            help="maximum number of concurrent requests to the WIMS server")
+        parser.add_argument("--batch-size", type=int, default=None,
+                            help="number of users provisioned by batch")
+    
+    
+    def handle(self, *args, **options):
+        try:
+            wclass_db = WimsClass.objects.select_related("wims").get(pk=options["wclass"])
+        except WimsClass.DoesNotExist:
+            raise CommandError("No WimsClass with pk '%d'" % options["wclass"])
+        
+        try:
+            with open(options["roster"], encoding="utf-8-sig") as f:
+                members = read_roster(f.read())
+        except (OSError, ValueError) as e:
+            raise CommandError("Could not read the roster: %s" % str(e))
+        
+        try:
+            report = provision(wclass_db, members, options["workers"], options["batch_size"])
+        except (wimsapi.WimsAPIError, requests.RequestException) as e:
+            raise CommandError("Could not join the WIMS class: %s" % str(e))
+        
+        self.stdout.write("Roster of class %d provisioned: %s" % (wclass_db.id, report))
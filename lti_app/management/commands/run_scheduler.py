@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+#
+#  run_scheduler.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+from apscheduler.schedulers.blocking import BlockingScheduler
+from django.core.management.base import BaseCommand
+
+from lti_app.scheduler import JOBS, create_scheduler, run_locked
+from lti_app.worker import worker
+
+
+
+class Command(BaseCommand):
+    help = ("Run the scheduled tasks (sending the grades back to the LMSs, checking that the "
+            "classes still exist on their WIMS server) and the jobs queued in the database (see "
+            "lti_app/worker.py) until interrupted. Should run in a single, dedicated process, "
+            "each task being anyway never run by two processes at once.")
+    
+    
+    def add_arguments(self, parser):
+        parser.add_argument("--run", choices=[name for name, _ in JOBS], default=None,
+                            help="run this task once and exit instead")
+    
+    
+    def handle(self, *args, **options):
+        if options["run"]:
+            result = run_locked(options["run"])
+            self.stdout.write("Task '%s' done: %s" % (options["run"], result))
+            return
+        
+        worker.start()
+        scheduler = create_scheduler(BlockingScheduler)
+        self.stdout.write("Scheduler started, press CTRL-C to stop it")
+        try:
+            scheduler.start()
+        except (KeyboardInterrupt, SystemExit):
+            pass
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+#
+#  sync_grades.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+from django.core.management.base import BaseCommand
+
+from lti_app import tasks
+from lti_app.models import GradeSyncShard
+
+
+
+class Command(BaseCommand):
+    help = ("Send the grades back to the LMSs, resuming the previous synchronization if it did not "
+            "finish. Can be run by several processes at once to speed up a synchronization, "
+            "each of them running different shards of the classes.")
+    
+    
+    def add_arguments(self, parser):
+        parser.add_argument("--kind", choices=list(GradeSyncShard.KINDS), default="all",
+                            help="grades to send (default: all)")
+        parser.add_argument("--force", action="store_true",
+                            help="also send the grades which did not change since last sent")
+        parser.add_argument("--join", action="store_true",
+                            help="only help running the shards of an ongoing synchronization")
+    
+    
+    def handle(self, *args, **options):
+        if options["join"]:
+            run = tasks.run_grade_sync_shards(options["kind"])
+            self.stdout.write("%d shard(s) run" % run)
+            return
+        
+        sheets, exams = GradeSyncShard.KINDS[options["kind"]]
+        report = tasks.send_back_grades(sheets, exams, options["force"])
+        self.stdout.write("Grades synchronized: %s" % report)
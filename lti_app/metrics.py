@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+#
+#  metrics.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+import bisect
+import functools
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from django.conf import settings
+from django.http import HttpRequest, HttpResponse
+
+
+logger = logging.getLogger(__name__)
+
+
+
+class Histogram:
+    """Thread-safe histogram of durations, in seconds, exported in the Prometheus text format.
+    
+    Observations are counted in the bucket of <buckets> (upper bounds, in seconds) they fall in,
+    for each combination of values of <labels>. Values are kept in the memory of the process, each
+    process of the server thus exports its own histogram."""
+    
+    
+    def __init__(self, name: str, description: str, labels: Sequence[str],
+                 buckets: Sequence[float]):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+        self._lock = threading.Lock()
+    
+    
+    def observe(self, value: float, **labels: str) -> None:
+        """Record a duration of <value> seconds for the given values of the labels."""
+        key = tuple(str(labels.get(label, "")) for label in self.labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            # Count of every bucket (the last one being +Inf), followed by the sum
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            series[i] += 1
+            series[-1] += value
+    
+    
+    def clear(self) -> None:
+        """Forget every observation."""
+        with self._lock:
+            self._series.clear()
+    
+    
+    @staticmethod
+    def _escape(value: str) -> str:
+        return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    
+    
+    def render(self) -> str:
+        """Return this histogram in the Prometheus text exposition format."""
+        with self._lock:
+            series = sorted((k, list(v)) for k, v in self._series.items())
+        
+        lines = [
+            "# HELP %s %s" % (self.name, self.description),
+            "# TYPE %s histogram" % self.name,
+        ]
+        for key, values in series:
+            labels = ",".join(
+                '%s="%s"' % (label, self._escape(value)) for label, value in zip(self.labels, key)
+            )
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), values):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append('%s_bucket{%s,le="%s"} %d' % (self.name, labels, le, cumulative))
+            lines.append("%s_sum{%s} %r" % (self.name, labels, values[-1]))
+            lines.append("%s_count{%s} %d" % (self.name, labels, cumulative))
+        return "\n".join(lines) + "\n"
+
+
+
+launch_stages = Histogram(
+    "wimslti_launch_stage_seconds", "Duration of each stage of the LTI launches.",
+    ["view", "stage", "wims", "lms"], settings.METRICS_BUCKETS,
+)
+
+
+
+class Timing:
+    """Durations of the successive stages of a request.
+    
+    lap(<stage>) ends the current stage, which started at the end of the previous one (or when
+    the timing was created). Once the request is done, finish() records every stage in
+    launch_stages, labeled by the WIMS server and the LMS given to label(), and adds them to the
+    Server-Timing header of the response."""
+    
+    
+    def __init__(self, view: str):
+        self.view = view
+        self.wims = "unknown"
+        self.lms = "unknown"
+        self.stages: Dict[str, float] = {}
+        self._start = self._last = time.perf_counter()
+    
+    
+    def label(self, wims: str = None, lms: str = None) -> None:
+        """Set the WIMS server and / or the LMS of the request."""
+        if wims is not None:
+            self.wims = wims
+        if lms is not None:
+            self.lms = lms
+    
+    
+    def lap(self, stage: str) -> None:
+        """End <stage>, adding its duration to the previous ones of the same name, if any."""
+        now = time.perf_counter()
+        self.stages[stage] = self.stages.get(stage, 0.0) + (now - self._last)
+        self._last = now
+    
+    
+    def header(self) -> str:
+        """Return the value of the Server-Timing header corresponding to the stages."""
+        return ", ".join("%s;dur=%.1f" % (s, d * 1000) for s, d in self.stages.items())
+    
+    
+    def finish(self, response: Optional[HttpResponse]) -> None:
+        """Record the stages and the total duration of the request, and add them to the
+        Server-Timing header of <response>, if any."""
+        self.stages["total"] = time.perf_counter() - self._start
+        if settings.METRICS_ENABLED:
+            for stage, duration in self.stages.items():
+                launch_stages.observe(duration, view=self.view, stage=stage, wims=self.wims,
+                                      lms=self.lms)
+        if settings.SERVER_TIMING_HEADER and response is not None:
+            response["Server-Timing"] = self.header()
+
+
+
+def timed(view: Callable[..., HttpResponse]) -> Callable[..., HttpResponse]:
+    """Decorator giving a Timing to the request of <view> (as request.timing), finished once
+    the view returned or raised."""
+    
+    @functools.wraps(view)
+    def wrapper(request: HttpRequest, *args, **kwargs) -> HttpResponse:
+        request.timing = timing = Timing(view.__name__)
+        response = None
+        try:
+            response = view(request, *args, **kwargs)
+            return response
+        finally:
+            timing.finish(response)
+    
+    return wrapper
+
+
+
+def render() -> str:
+    """Return every metric in the Prometheus text exposition format."""
+    return launch_stages.render()
@@ -9,17 +9,23 @@
 import logging
 import random
 from datetime import timedelta
-from typing import Any
+from itertools import groupby
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
 import requests
 from defusedxml import DefusedXmlException, ElementTree
 from defusedxml.ElementTree import ParseError
 from django.conf import settings
+from django.core.mail import send_mail
 from django.core.validators import MinLengthValidator, URLValidator
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import Q
+from django.utils import timezone
 from oauthlib.oauth1.rfc5849 import Client
-from wimsapi import AdmRawError, Class, Exam, Sheet
+from wimsapi import AdmRawError, Class, Sheet
 
+from lti_app import connections
+from lti_app.dispatch import GradeDispatcher
 from lti_app.validator import ModelsValidator
 
 
@@ -59,6 +65,7 @@ class LMS(models.Model):
         verbose_name_plural = "LMS"
         indexes = [
             models.Index(fields=['key']),
+            models.Index(fields=['guid']),
         ]
     
     
@@ -122,6 +129,58 @@ class WimsClass(models.Model):
 
 
 
+class ClassCreation(models.Model):
+    """A class being created on a WIMS server for the course <lms_guid> of a LMS.
+    
+    Inserting this row acts as a lock shared by every process: only the launch which inserted it
+    creates the class, the others wait for the corresponding WimsClass. Rows older than
+    CLASS_CREATION_TIMEOUT seconds are considered abandoned (e.g. the process was killed) and are
+    replaced."""
+    
+    lms = models.ForeignKey(LMS, models.CASCADE)
+    lms_guid = models.CharField(max_length=256)
+    wims = models.ForeignKey(WIMS, models.CASCADE)
+    created = models.DateTimeField(auto_now_add=True)
+    
+    
+    class Meta:
+        unique_together = (("lms", "lms_guid", "wims"),)
+    
+    
+    def __str__(self) -> str:
+        return "lms guid: %s - created: %s" % (self.lms_guid, self.created)
+    
+    
+    @classmethod
+    def acquire(cls, lms: LMS, lms_guid: str, wims: WIMS) -> bool:
+        """Insert the row of the course <lms_guid> of <lms> on <wims>, returning False if another
+        launch is already creating its class."""
+        stale = timezone.now() - timedelta(seconds=settings.CLASS_CREATION_TIMEOUT)
+        cls.objects.filter(lms=lms, lms_guid=lms_guid, wims=wims, created__lt=stale).delete()
+        try:
+            with transaction.atomic():
+                cls.objects.create(lms=lms, lms_guid=lms_guid, wims=wims)
+        except IntegrityError:
+            return False
+        return True
+    
+    
+    @classmethod
+    def held(cls, lms: LMS, lms_guid: str, wims: WIMS) -> bool:
+        """Return whether another launch is creating the class of the course <lms_guid> of <lms>
+        on <wims>. Unlike acquire(), this only reads the database."""
+        stale = timezone.now() - timedelta(seconds=settings.CLASS_CREATION_TIMEOUT)
+        return cls.objects.filter(lms=lms, lms_guid=lms_guid, wims=wims,
+                                  created__gte=stale).exists()
+    
+    
+    @classmethod
+    def release(cls, lms: LMS, lms_guid: str, wims: WIMS) -> None:
+        """Delete the row of the course <lms_guid> of <lms> on <wims>."""
+        cls.objects.filter(lms=lms, lms_guid=lms_guid, wims=wims).delete()
+
+
+
 class WimsUser(models.Model):
     """Represent an user on a WIMS server."""
     
@@ -133,6 +192,11 @@ class WimsUser(models.Model):
     class Meta:
         verbose_name_plural = "WimsUsers"
         unique_together = (("quser", "wclass"),)
+        indexes = [
+            # Users (and the supervisor, whose lms_guid is NULL) are looked up by class and LMS
+            # id at each launch, which the unique index on (quser, wclass) cannot serve
+            models.Index(fields=['wclass', 'lms_guid']),
+        ]
     
     
     def __str__(self) -> str:
@@ -174,15 +238,49 @@ class WimsExam(models.Model):
 
 
 
+class GradeSyncJob(models.Model):
+    """A pending request to send every grade of an activity back to the LMS.
+    
+    Exactly one of <sheet> and <exam> is set. There can only be a single pending job for a given
+    activity."""
+    
+    sheet = models.OneToOneField(WimsSheet, models.CASCADE, null=True, blank=True, default=None)
+    exam = models.OneToOneField(WimsExam, models.CASCADE, null=True, blank=True, default=None)
+    created = models.DateTimeField(auto_now_add=True)
+    
+    
+    def __str__(self) -> str:
+        return "sheet: %s - exam: %s" % (self.sheet, self.exam)
+    
+    
+    @property
+    def activity(self) -> Any:
+        """Return the WimsSheet or WimsExam of this job."""
+        return self.sheet if self.sheet_id is not None else self.exam
+    
+    
+    @classmethod
+    def enqueue(cls, activity: Any) -> bool:
+        """Queue a job sending every grade of <activity> (a WimsSheet or a WimsExam), unless one
+        is already pending. Returns whether a new job was queued."""
+        field = "sheet" if isinstance(activity, WimsSheet) else "exam"
+        _, created = cls.objects.get_or_create(**{field: activity})
+        return created
+
+
+
 class GradeLinkBase(models.Model):
     """Store links to send grade back to the LMS."""
     
     activity: Any
+    outbox_field: str  # Name of the field of GradeOutbox pointing to this model
     
     user = models.ForeignKey(WimsUser, models.CASCADE)
     sourcedid = models.CharField(max_length=256)
     url = models.URLField(max_length=1023)
     lms = models.ForeignKey(LMS, models.CASCADE)
+    last_score = models.FloatField(null=True, blank=True, default=None)
+    last_sent = models.DateTimeField(null=True, blank=True, default=None)
     
     
     class Meta:
@@ -208,7 +306,7 @@ class GradeLinkBase(models.Model):
         
         try:
             uri, headers, body = c.sign(self.url, "POST", body=content, headers=headers)
-            response = requests.post(uri, data=body, headers=headers)
+            response = connections.post(uri, data=body, headers=headers)
         except (requests.RequestException, ValueError):
             logger.warning("Could not join the LMS to send the grade back at url %s"
                            % self.url)
@@ -242,6 +340,92 @@ class GradeLinkBase(models.Model):
             return False
         
         return True
+    
+    
+    @classmethod
+    def upsert(cls, user: WimsUser, activity: Any, lms: LMS, sourcedid: str, url: str
+               ) -> 'GradeLinkBase':
+        """Get or create the link of <user> for <activity>, updating its <sourcedid> and <url>.
+        
+        The link is only written if it is created or if one of them changed, in which case
+        the grade is sent again through the new link. A launch through an unchanged link thus
+        only reads the database."""
+        gl, created = cls.objects.get_or_create(
+            user=user, activity=activity, defaults={"lms": lms, "sourcedid": sourcedid, "url": url}
+        )
+        if not created and (gl.sourcedid != sourcedid or gl.url != url):
+            gl.sourcedid, gl.url, gl.last_score = sourcedid, url, None
+            cls.objects.filter(pk=gl.pk).update(sourcedid=sourcedid, url=url, last_score=None)
+        return gl
+    
+    
+    @classmethod
+    def links(cls, activity: Any) -> Dict[str, 'GradeLinkBase']:
+        """Return every grade link of <activity> indexed by the quser of their user.
+        
+        The links are retrieved with a single query, along with their user, lms and activity's
+        class, so that sending them back does not need any other query."""
+        links = cls.objects.filter(activity=activity).select_related(
+            "user", "lms", "activity__wclass"
+        )
+        return {gl.user.quser: gl for gl in links}
+    
+    
+    @classmethod
+    def mark_sent(cls, links: Iterable[Tuple['GradeLinkBase', float]]) -> None:
+        """Save, for every (grade link, grade) couple of <links>, that the grade was successfully
+        sent back to the LMS, removing any older grade of these links from the GradeOutbox."""
+        now = timezone.now()
+        updated = []
+        for gl, grade in links:
+            gl.last_score = grade
+            gl.last_sent = now
+            updated.append(gl)
+        cls.objects.bulk_update(updated, ["last_score", "last_sent"], batch_size=500)
+        GradeOutbox.objects.filter(**{cls.outbox_field + "__in": updated}).delete()
+    
+    
+    @classmethod
+    def defer(cls, links: Iterable[Tuple['GradeLinkBase', float]], attempted: bool = True
+              ) -> None:
+        """Queue every (grade link, grade) couple of <links> in the GradeOutbox, to be sent back
+        to the LMS later. <attempted> tells whether sending these grades was actually attempted.
+        
+        The last score of these links is also reset, so that the next run of send_back_all()
+        sends their current grade even if it is equal to the last one successfully sent."""
+        links = list(links)
+        GradeOutbox.defer(cls, links, attempted)
+        reset = [gl.pk for gl, _ in links if gl.last_score is not None]
+        if reset:
+            cls.objects.filter(pk__in=reset).update(last_score=None)
+        for gl, _ in links:
+            gl.last_score = None
+    
+    
+    @classmethod
+    def dispatch(cls, grades: Iterable[Tuple['GradeLinkBase', float]],
+                 dispatcher: GradeDispatcher = None, force: bool = False) -> int:
+        """Send every (grade link, grade) couple of <grades> back to the LMS.
+        
+        Grades equal to the last one successfully sent through their grade link are skipped,
+        unless <force> is True.
+        
+        If <dispatcher> is given, the grades are only queued in it and the number of queued
+        grades is returned. Else, the grades are sent through a new dispatcher and the number of
+        grades successfully sent is returned."""
+        if dispatcher is None:
+            with GradeDispatcher() as dispatcher:
+                cls.dispatch(grades, dispatcher, force)
+            return dispatcher.report.sent
+        
+        queued = 0
+        for gl, grade in grades:
+            if not force and gl.last_score == grade:
+                dispatcher.skip()
+                continue
+            dispatcher.submit(gl, grade)
+            queued += 1
+        return queued
 
 
 
@@ -249,6 +433,7 @@ class GradeLinkSheet(GradeLinkBase):
     """Store link of a Sheet."""
     
     activity = models.ForeignKey(WimsSheet, models.CASCADE)
+    outbox_field = "sheet_link"
     
     
     class Meta:
@@ -261,34 +446,64 @@ class GradeLinkSheet(GradeLinkBase):
         return self.activity.qsheet
     
     
+    @staticmethod
+    def scores(wclass: Class, qsheet: str) -> List[Tuple[str, float]]:
+        """Return a list of (quser, score) couples for every user of the sheet <qsheet> in
+        <wclass>.
+        
+        The score used it the the one set by the teacher at the sheet creation for WIMS > 4.18,
+        else the cumul score.
+        
+        Unlike wimsapi.Sheet.scores(), this only needs a single adm/raw request: the sheet itself
+        and each user are not retrieved from the WIMS server."""
+        status, response = wclass._api.getsheetscores(wclass.qclass, wclass.rclass, qsheet,
+                                                      verbose=True)
+        if not status:
+            raise AdmRawError(response['message'])
+        
+        scores = []
+        for data in response["data_scores"]:
+            try:
+                score = Sheet._compute_grade(
+                    response["sheet_formula"]["formula"], response["sheet_formula"]["I"],
+                    data["user_quality"], data["user_percent"], data["user_best"],
+                    data["user_level"]
+                )
+            except Exception:  # pragma: no cover
+                score = -1
+            score = score / 10 if score != -1 else data.get("user_best", -1) / 100
+            scores.append((data["id"], score))
+        
+        return scores
+    
+    
     @classmethod
-    def send_back_all(cls, sheet: WimsSheet) -> int:
-        """Send the score of the sheet of every user back to the LMS. The score used
-        it the the one set by the teacher at the sheet creation for WIMS > 4.18, else
-        the cumul score."""
+    def send_back_all(cls, sheet: WimsSheet, dispatcher: GradeDispatcher = None,
+                      wclass: Class = None, force: bool = False) -> int:
+        """Send the score of the sheet of every user back to the LMS.
+        
+        <wclass> should be the wimsapi.Class corresponding to sheet.wclass if it has already been
+        retrieved, it will be retrieved from the WIMS server otherwise.
+        
+        See GradeLinkBase.dispatch() for the use of <dispatcher> and <force>, and the returned
+        value."""
         try:
-            wclass = sheet.wclass
-            wims = wclass.wims
-            grades = Class.get(
-                wims.url, wclass.wims.ident, wims.passwd, wclass.qclass, wims.rclass,
-                timeout=settings.WIMSAPI_TIMEOUT
-            ).getitem(sheet.qsheet, Sheet).scores()
+            if wclass is None:
+                wclass_db = sheet.wclass
+                wims = wclass_db.wims
+                wclass = Class.get(
+                    wims.url, wims.ident, wims.passwd, wclass_db.qclass, wims.rclass,
+                    timeout=settings.WIMSAPI_TIMEOUT
+                )
+            grades = cls.scores(wclass, sheet.qsheet)
         except AdmRawError as e:  # pragma: no cover
             if "There is no user in this class" in str(e):
                 return 0
             raise
         
-        total = 0
-        for grade in grades:
-            try:
-                user = WimsUser.objects.get(wclass=wclass, quser=grade.user.quser)
-                gl = GradeLinkSheet.objects.get(user=user, activity=sheet)
-            except (GradeLinkSheet.DoesNotExist, WimsUser.DoesNotExist):  # pragma: no cover
-                continue
-            score = grade.score / 10 if grade.score != -1 else grade.best / 100
-            total += gl.send_back(score)
-        
-        return total
+        links = cls.links(sheet)
+        grades = [(links[quser], score) for quser, score in grades if quser in links]
+        return cls.dispatch(grades, dispatcher, force)
 
 
 
@@ -296,6 +511,7 @@ class GradeLinkExam(GradeLinkBase):
     """Store link of a Sheet."""
     
     activity = models.ForeignKey(WimsExam, models.CASCADE)
+    outbox_field = "exam_link"
     
     
     class Meta:
@@ -308,28 +524,347 @@ class GradeLinkExam(GradeLinkBase):
         return self.activity.qexam
     
     
+    @staticmethod
+    def scores(wclass: Class, qexam: str) -> List[Tuple[str, float]]:
+        """Return a list of (quser, score) couples for every user of the exam <qexam> in
+        <wclass>.
+        
+        Unlike wimsapi.Exam.scores(), this only needs a single adm/raw request: the exam itself
+        and each user are not retrieved from the WIMS server."""
+        status, response = wclass._api.getexamscores(wclass.qclass, wclass.rclass, qexam,
+                                                     verbose=True)
+        if not status:
+            raise AdmRawError(response['message'])
+        
+        return [(data["id"], data["score"] / 10) for data in response["data_scores"]]
+    
+    
     @classmethod
-    def send_back_all(cls, exam: WimsExam) -> int:
-        """Send the score of the exam of every user back to the LMS."""
+    def send_back_all(cls, exam: WimsExam, dispatcher: GradeDispatcher = None,
+                      wclass: Class = None, force: bool = False) -> int:
+        """Send the score of the exam of every user back to the LMS.
+        
+        <wclass> should be the wimsapi.Class corresponding to exam.wclass if it has already been
+        retrieved, it will be retrieved from the WIMS server otherwise.
+        
+        See GradeLinkBase.dispatch() for the use of <dispatcher> and <force>, and the returned
+        value."""
         try:
-            wclass = exam.wclass
-            wims = wclass.wims
-            grades = Class.get(
-                wims.url, wclass.wims.ident, wims.passwd, wclass.qclass, wims.rclass,
-                timeout=settings.WIMSAPI_TIMEOUT
-            ).getitem(exam.qexam, Exam).scores()
+            if wclass is None:
+                wclass_db = exam.wclass
+                wims = wclass_db.wims
+                wclass = Class.get(
+                    wims.url, wims.ident, wims.passwd, wclass_db.qclass, wims.rclass,
+                    timeout=settings.WIMSAPI_TIMEOUT
+                )
+            grades = cls.scores(wclass, exam.qexam)
         except AdmRawError as e:  # pragma: no cover
             if "There's no user in this class" in str(e):
                 return 0
             raise
         
-        total = 0
-        for grade in grades:
-            try:
-                user = WimsUser.objects.get(wclass=wclass, quser=grade.user.quser)
-                gl = GradeLinkExam.objects.get(user=user, activity=exam)
-            except (GradeLinkExam.DoesNotExist, WimsUser.DoesNotExist):  # pragma: no cover
-                continue
-            score = grade.score / 10
-            total += gl.send_back(score)
-        return total
+        links = cls.links(exam)
+        grades = [(links[quser], score) for quser, score in grades if quser in links]
+        return cls.dispatch(grades, dispatcher, force)
+
+
+
+class GradeOutbox(models.Model):
+    """A grade which could not be sent back to the LMS, waiting to be sent again.
+    
+    Exactly one of <sheet_link> and <exam_link> is set. Only the latest grade of a grade link is
+    kept. Each failed attempt pushes <next_attempt> back exponentially, from OUTBOX_BACKOFF to
+    OUTBOX_BACKOFF_MAX seconds, the grade being dropped after OUTBOX_MAX_ATTEMPTS attempts."""
+    
+    sheet_link = models.OneToOneField(GradeLinkSheet, models.CASCADE, null=True, blank=True,
+                                      default=None)
+    exam_link = models.OneToOneField(GradeLinkExam, models.CASCADE, null=True, blank=True,
+                                     default=None)
+    lms = models.ForeignKey(LMS, models.CASCADE)
+    grade = models.FloatField()
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt = models.DateTimeField(db_index=True)
+    created = models.DateTimeField(auto_now_add=True)
+    
+    # Delay after which a grade claimed by a worker which crashed before sending it is sent again
+    CLAIM_DELAY = timedelta(minutes=10)
+    
+    
+    def __str__(self) -> str:
+        return "%s - grade: %s - attempts: %d" % (self.link, self.grade, self.attempts)
+    
+    
+    @property
+    def link(self) -> GradeLinkBase:
+        """Return the GradeLinkSheet or GradeLinkExam of this grade."""
+        return self.sheet_link if self.sheet_link_id is not None else self.exam_link
+    
+    
+    @staticmethod
+    def backoff(attempts: int) -> timedelta:
+        """Return the delay before the next attempt after <attempts> failed attempts.
+        
+        The delay is randomly reduced by up to half, so that grades which failed together are not
+        all sent again at the same time."""
+        delay = settings.OUTBOX_BACKOFF * 2 ** max(attempts - 1, 0)
+        delay = min(delay, settings.OUTBOX_BACKOFF_MAX)
+        return timedelta(seconds=delay * random.uniform(0.5, 1))
+    
+    
+    @classmethod
+    def defer(cls, model: type, links: List[Tuple[GradeLinkBase, float]], attempted: bool = True
+              ) -> None:
+        """Queue every (grade link, grade) couple of <links>, <model> being the class of the grade
+        links. <attempted> tells whether sending these grades was actually attempted, the number
+        of attempts is not incremented otherwise."""
+        if not links:
+            return
+        
+        field = model.outbox_field
+        existing = {
+            getattr(entry, field + "_id"): entry
+            for entry in cls.objects.filter(**{field + "__in": [gl for gl, _ in links]})
+        }
+        
+        now = timezone.now()
+        created, updated, dropped = [], [], []
+        for gl, grade in links:
+            entry = existing.get(gl.pk)
+            if entry is None:
+                entry = cls(**{field: gl}, lms_id=gl.lms_id)
+            entry.grade = grade
+            entry.attempts += int(attempted)
+            entry.next_attempt = now + cls.backoff(entry.attempts)
+            
+            if entry.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+                logger.error("Dropping grade %s of %s after %d failed attempts"
+                             % (grade, str(gl), entry.attempts))
+                if entry.pk is not None:
+                    dropped.append(entry.pk)
+            elif entry.pk is None:
+                created.append(entry)
+            else:
+                updated.append(entry)
+        
+        cls.objects.bulk_create(created, batch_size=500)
+        cls.objects.bulk_update(updated, ["grade", "attempts", "next_attempt"], batch_size=500)
+        if dropped:
+            cls.objects.filter(pk__in=dropped).delete()
+
+
+
+class MailOutbox(models.Model):
+    """A mail waiting to be sent by the worker.
+    
+    Mails which could not be sent are sent again later, with the same backoff as the grades of
+    GradeOutbox, and are dropped after OUTBOX_MAX_ATTEMPTS failed attempts.
+    
+    The body of the credentials mail of a class contains the passwords of the class and of its
+    supervisor: it is not shown in the admin, and the row is deleted as soon as the mail is sent
+    or dropped, or when its class <wclass> is deleted."""
+    
+    subject = models.CharField(max_length=998)
+    body = models.TextField()
+    wclass = models.ForeignKey(WimsClass, models.CASCADE, null=True, blank=True, default=None)
+    from_email = models.CharField(max_length=254)
+    recipients = models.TextField()  # One address per line
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt = models.DateTimeField(db_index=True, default=timezone.now)
+    created = models.DateTimeField(auto_now_add=True)
+    
+    # Delay after which a mail claimed by a worker which crashed before sending it is sent again
+    CLAIM_DELAY = timedelta(minutes=10)
+    
+    
+    def __str__(self) -> str:
+        return "%s - to: %s - attempts: %d" % (self.subject, self.recipients, self.attempts)
+    
+    
+    @classmethod
+    def enqueue(cls, subject: str, body: str, recipients: List[str], from_email: str = None,
+                wclass: WimsClass = None) -> 'MailOutbox':
+        """Queue a mail to <recipients>, sent from <from_email> (settings.SERVER_EMAIL by
+        default), about the class <wclass> if given."""
+        return cls.objects.create(
+            subject=subject, body=body, from_email=from_email or settings.SERVER_EMAIL,
+            recipients="\n".join(recipients), wclass=wclass
+        )
+    
+    
+    def send(self) -> bool:
+        """Send this mail, deleting it if it succeeded, or pushing its next attempt back
+        otherwise. Returns whether it was sent."""
+        try:
+            send_mail(self.subject, self.body, self.from_email, self.recipients.splitlines())
+        except Exception:
+            self.attempts += 1
+            if self.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+                logger.exception("Dropping mail '%s' to %s after %d failed attempts:"
+                                 % (self.subject, self.recipients, self.attempts))
+                self.delete()
+            else:
+                logger.warning("Could not send mail '%s' to %s (attempt %d)"
+                               % (self.subject, self.recipients, self.attempts), exc_info=True)
+                self.next_attempt = timezone.now() + GradeOutbox.backoff(self.attempts)
+                self.save(update_fields=["attempts", "next_attempt"])
+            return False
+        
+        self.delete()
+        return True
+
+
+
+class TaskLock(models.Model):
+    """A lock held by the process running the scheduled task <name>, so that a task is never run
+    by two processes at once. A lock whose <expires> passed is considered abandoned (e.g. the
+    process was killed) and can be acquired by another process."""
+    
+    name = models.CharField(max_length=128, unique=True)
+    owner = models.CharField(max_length=128)
+    expires = models.DateTimeField()
+    
+    
+    def __str__(self) -> str:
+        return "%s - owner: %s - expires: %s" % (self.name, self.owner, self.expires)
+    
+    
+    @classmethod
+    def acquire(cls, name: str, owner: str, ttl: timedelta) -> bool:
+        """Acquire the lock <name> for <owner> during <ttl>, returning False if it is already
+        held by another owner."""
+        now = timezone.now()
+        if cls.objects.filter(name=name, expires__lt=now).update(owner=owner, expires=now + ttl):
+            return True
+        try:
+            with transaction.atomic():
+                cls.objects.create(name=name, owner=owner, expires=now + ttl)
+        except IntegrityError:
+            return False
+        return True
+    
+    
+    @classmethod
+    def release(cls, name: str, owner: str) -> None:
+        """Release the lock <name> if it is still held by <owner>."""
+        cls.objects.filter(name=name, owner=owner).delete()
+
+
+
+class GradeSyncShard(models.Model):
+    """A range of WimsClass of a same WIMS server whose grades are sent back to the LMSs as part
+    of a grade synchronization run, see tasks.send_back_grades().
+    
+    <kind> tells whether the grades of the sheets, of the exams or of both are sent. A shard is
+    claimed by a single process at a time, for GRADE_SYNC_LEASE seconds, this lease being renewed
+    at each checkpoint. <checkpoint> is the pk of the last class whose grades were sent, so that a
+    shard whose process was interrupted can be resumed by another process once its lease
+    expired. A shard whose WIMS server could not be joined is marked as failed, its remaining
+    classes being synchronized by the next run."""
+    
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS = [(PENDING, "Pending"), (RUNNING, "Running"), (DONE, "Done"), (FAILED, "Failed")]
+    
+    # Kind of synchronization, mapped to whether it sends the grades of the sheets and the exams
+    KINDS = {
+        "all":    (True, True),
+        "sheets": (True, False),
+        "exams":  (False, True),
+    }
+    
+    kind = models.CharField(max_length=16, choices=[(k, k) for k in KINDS])
+    force = models.BooleanField(default=False)
+    wims = models.ForeignKey(WIMS, models.CASCADE)
+    first_class = models.PositiveIntegerField()
+    last_class = models.PositiveIntegerField()
+    checkpoint = models.PositiveIntegerField(default=0)
+    status = models.CharField(max_length=16, choices=STATUS, default=PENDING)
+    owner = models.CharField(max_length=128, blank=True, default="")
+    lease_expires = models.DateTimeField(null=True, blank=True, default=None)
+    classes_total = models.PositiveIntegerField(default=0)
+    classes_done = models.PositiveIntegerField(default=0)
+    sent = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    started = models.DateTimeField(null=True, blank=True, default=None)
+    finished = models.DateTimeField(null=True, blank=True, default=None)
+    
+    
+    def __str__(self) -> str:
+        return "%s - %s - classes %d to %d - %s" % (
+            self.kind, self.wims, self.first_class, self.last_class, self.status
+        )
+    
+    
+    @classmethod
+    def plan(cls, kind: str, force: bool = False, size: int = None) -> Optional[int]:
+        """Partition the WimsClass of every WIMS server in shards of at most <size> classes
+        (GRADE_SYNC_SHARD_SIZE by default) for a new run of <kind>. The shards of the previous run
+        are deleted. Returns the number of shards created.
+        
+        If a run of <kind> is not finished yet, None is returned instead so that it is resumed,
+        unless <force> is True: this run is then discarded (the processes running its shards stop
+        at their next checkpoint) so that the new one sends every grade."""
+        unfinished = cls.objects.filter(kind=kind, status__in=[cls.PENDING, cls.RUNNING])
+        if not force and unfinished.exists():
+            return None
+        
+        size = size or settings.GRADE_SYNC_SHARD_SIZE
+        cls.objects.filter(kind=kind).delete()
+        shards = []
+        classes = WimsClass.objects.order_by("wims_id", "pk").values_list("wims_id", "pk")
+        for wims_id, pks in groupby(classes, key=lambda c: c[0]):
+            pks = [pk for _, pk in pks]
+            for i in range(0, len(pks), size):
+                chunk = pks[i:i + size]
+                shards.append(cls(kind=kind, force=force, wims_id=wims_id, first_class=chunk[0],
+                                  last_class=chunk[-1], classes_total=len(chunk)))
+        cls.objects.bulk_create(shards)
+        return len(shards)
+    
+    
+    @classmethod
+    def claim(cls, owner: str, kind: str = None) -> Optional['GradeSyncShard']:
+        """Claim a pending shard (of <kind> if given), or a running one whose lease expired, for
+        <owner>. Returns None if there is no shard to claim."""
+        now = timezone.now()
+        claimable = cls.objects.filter(
+            Q(status=cls.PENDING) | Q(status=cls.RUNNING, lease_expires__lt=now)
+        ).order_by("pk")
+        if kind is not None:
+            claimable = claimable.filter(kind=kind)
+        
+        for shard in claimable:
+            claimed = cls.objects.filter(
+                pk=shard.pk, status=shard.status, lease_expires=shard.lease_expires
+            ).update(
+                status=cls.RUNNING, owner=owner, started=shard.started or now,
+                lease_expires=now + timedelta(seconds=settings.GRADE_SYNC_LEASE),
+            )
+            if claimed:
+                shard.refresh_from_db()
+                return shard
+        return None
+    
+    
+    def save_checkpoint(self, checkpoint: int, classes: int, sent: int, failed: int,
+                        status: str = RUNNING) -> bool:
+        """Record that the grades of <classes> more classes, up to the class of pk <checkpoint>,
+        were sent (<sent> grades successfully, <failed> not), renewing the lease, or ending the
+        shard if <status> is DONE or FAILED.
+        
+        Returns False if the shard was claimed by another process in the meantime."""
+        now = timezone.now()
+        self.checkpoint = checkpoint
+        self.classes_done += classes
+        self.sent += sent
+        self.failed += failed
+        self.status = status
+        self.finished = None if status == self.RUNNING else now
+        self.lease_expires = now + timedelta(seconds=settings.GRADE_SYNC_LEASE)
+        fields = ["checkpoint", "classes_done", "sent", "failed", "status", "finished",
+                  "lease_expires"]
+        return bool(type(self).objects.filter(pk=self.pk, owner=self.owner).update(
+            **{f: getattr(self, f) for f in fields}
+        ))
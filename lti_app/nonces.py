@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+#
+#  nonces.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+import hashlib
+import logging
+import threading
+from typing import List, Set, Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+
+from lti_app.registry import LOCAL_CACHE_BACKENDS
+
+
+logger = logging.getLogger(__name__)
+
+
+
+class MemoryNonceStore:
+    """Remember the (client_key, nonce) couples received during the last <window> seconds.
+    
+    Couples are indexed in a set, for constant-time lookups, and in a ring of <buckets> + 1 sets,
+    each holding the couples received during <window> / <buckets> seconds. Whenever the ring moves
+    to a new bucket, the couples of the oldest bucket are forgotten, the cost of expiring a couple
+    is thus constant and paid once. The extra bucket ensures that a couple is remembered during
+    at least <window> seconds.
+    
+    At most <max_size> couples are remembered. Beyond that, the oldest buckets are forgotten
+    early, so that a burst of requests cannot exhaust the memory."""
+    
+    
+    def __init__(self, window: int = None, buckets: int = None, max_size: int = None):
+        self.window = window or settings.NONCE_WINDOW
+        self.buckets = buckets or settings.NONCE_BUCKETS
+        self.max_size = max_size or settings.NONCE_STORE_MAX_SIZE
+        self.bucket_size = self.window / self.buckets
+        self._seen: Set[Tuple[str, str]] = set()
+        self._ring: List[Set[Tuple[str, str]]] = [set() for _ in range(self.buckets + 1)]
+        self._current = None
+        self._lock = threading.Lock()
+    
+    
+    def __len__(self) -> int:
+        return len(self._seen)
+    
+    
+    def _expire(self, epoch: int) -> None:
+        """Forget the couples of the buckets the ring went through to reach <epoch>."""
+        if self._current is None or epoch - self._current >= len(self._ring):
+            self._seen.clear()
+            for bucket in self._ring:
+                bucket.clear()
+        else:
+            for e in range(self._current + 1, epoch + 1):
+                self._forget(e % len(self._ring))
+        self._current = epoch
+    
+    
+    def _forget(self, index: int) -> None:
+        """Forget the couples of the bucket <index>."""
+        bucket = self._ring[index]
+        for key in bucket:
+            self._seen.discard(key)
+        bucket.clear()
+    
+    
+    def seen(self, client_key: str, nonce: str, now: float) -> bool:
+        """Return whether the couple (<client_key>, <nonce>) was received during the last
+        <window> seconds before <now>, without remembering it."""
+        epoch = int(now // self.bucket_size)
+        
+        with self._lock:
+            if self._current is None or epoch > self._current:
+                self._expire(epoch)
+            return (client_key, nonce) in self._seen
+    
+    
+    def add(self, client_key: str, nonce: str, now: float) -> bool:
+        """Remember the couple (<client_key>, <nonce>) received at <now>. Returns False if it
+        was already received during the last <window> seconds, True otherwise."""
+        key = (client_key, nonce)
+        epoch = int(now // self.bucket_size)
+        
+        with self._lock:
+            if self._current is None or epoch > self._current:
+                self._expire(epoch)
+            
+            if key in self._seen:
+                return False
+            
+            if len(self._seen) >= self.max_size:
+                logger.warning("Nonce store full (%d nonces), forgetting the oldest nonces early"
+                               % len(self._seen))
+                for e in range(self._current - len(self._ring) + 1, self._current + 1):
+                    self._forget(e % len(self._ring))
+                    if len(self._seen) < self.max_size:
+                        break
+            
+            self._seen.add(key)
+            self._ring[self._current % len(self._ring)].add(key)
+            return True
+
+
+
+class CacheNonceStore:
+    """Remember the (client_key, nonce) couples received during the last <window> seconds in
+    the Django's cache <alias>, so that they are shared by every process.
+    
+    Relies on the atomicity of cache.add(), supported by the Memcached, Redis and database
+    backends."""
+    
+    
+    def __init__(self, window: int = None, alias: str = None):
+        self.window = window or settings.NONCE_WINDOW
+        self.cache = caches[alias or settings.NONCE_CACHE_ALIAS]
+    
+    
+    @staticmethod
+    def _key(client_key: str, nonce: str) -> str:
+        """Return the cache key of the couple (<client_key>, <nonce>)."""
+        digest = hashlib.sha1(("%s\0%s" % (client_key, nonce)).encode()).hexdigest()
+        return "lti_app.nonce.%s" % digest
+    
+    
+    def seen(self, client_key: str, nonce: str, now: float) -> bool:
+        """Return whether the couple (<client_key>, <nonce>) was received during the last
+        <window> seconds, without remembering it."""
+        return self.cache.get(self._key(client_key, nonce)) is not None
+    
+    
+    def add(self, client_key: str, nonce: str, now: float) -> bool:
+        """Remember the couple (<client_key>, <nonce>) received at <now>. Returns False if it
+        was already received during the last <window> seconds, True otherwise."""
+        return self.cache.add(self._key(client_key, nonce), 1, self.window)
+
+
+
+def create_store():
+    """Return a new nonce store according to settings.NONCE_STORE ('memory' or 'cache'), or if
+    it is None, a CacheNonceStore if settings.NONCE_CACHE_ALIAS is shared by every process and a
+    MemoryNonceStore otherwise."""
+    store = settings.NONCE_STORE
+    if store is None:
+        backend = settings.CACHES[settings.NONCE_CACHE_ALIAS]["BACKEND"]
+        store = "memory" if backend in LOCAL_CACHE_BACKENDS else "cache"
+    if store == "cache":
+        return CacheNonceStore()
+    return MemoryNonceStore()
+
+
+
+nonce_store = create_store()
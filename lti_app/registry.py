@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+#
+#  registry.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+import logging
+import threading
+import time
+import uuid
+from collections import defaultdict
+from typing import Any, Dict, List
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+
+logger = logging.getLogger(__name__)
+
+VERSION_KEY = "lti_app.registry.version"
+
+# Cache backends which are not shared between processes
+LOCAL_CACHE_BACKENDS = [
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.dummy.DummyCache",
+]
+
+
+
+class ConfigRegistry:
+    """In-process registry of every LMS and WIMS rows.
+    
+    The rows are loaded with two queries on the first lookup, then served from memory until they
+    are modified. Saving or deleting a LMS or a WIMS invalidates the registry of the current
+    process and changes the version stored in Django's cache, so that the other processes reload
+    their registry on their next lookup (this needs a cache shared by every process, see
+    settings.CACHES). The registry is also reloaded settings.CONFIG_REGISTRY_TTL seconds after
+    being loaded, in case a modification was not notified.
+    
+    If the registry is disabled (see enabled()), every lookup queries the database."""
+    
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._expires = 0.0
+        self._lms_by_key: Dict[str, Any] = {}
+        self._lms_by_guid: Dict[str, List[Any]] = {}
+        self._wims_by_pk: Dict[int, Any] = {}
+    
+    
+    @staticmethod
+    def enabled() -> bool:
+        """Return settings.CONFIG_REGISTRY, or if it is None, whether the default cache is shared
+        by every process (outside of the tests)."""
+        if settings.CONFIG_REGISTRY is not None:
+            return settings.CONFIG_REGISTRY
+        return (not settings.TESTING
+                and settings.CACHES["default"]["BACKEND"] not in LOCAL_CACHE_BACKENDS)
+    
+    
+    @staticmethod
+    def _current_version() -> str:
+        """Return the version shared by every process, creating it if needed."""
+        version = cache.get(VERSION_KEY)
+        if version is None:
+            cache.add(VERSION_KEY, uuid.uuid4().hex, None)
+            version = cache.get(VERSION_KEY)
+        return version
+    
+    
+    def _load(self) -> None:
+        """Load every LMS and WIMS if the registry is outdated or expired."""
+        version = self._current_version()
+        if version == self._version and time.monotonic() < self._expires:
+            return
+        
+        with self._lock:
+            if version == self._version and time.monotonic() < self._expires:
+                return
+            
+            LMS = apps.get_model("lti_app", "LMS")
+            WIMS = apps.get_model("lti_app", "WIMS")
+            lms_by_guid = defaultdict(list)
+            lms_by_key = {}
+            for lms in LMS.objects.all():
+                lms_by_key[lms.key] = lms
+                lms_by_guid[lms.guid].append(lms)
+            self._lms_by_key = lms_by_key
+            self._lms_by_guid = dict(lms_by_guid)
+            self._wims_by_pk = {wims.pk: wims for wims in WIMS.objects.all()}
+            self._version = version
+            self._expires = time.monotonic() + settings.CONFIG_REGISTRY_TTL
+            logger.debug("Registry loaded (%d LMS, %d WIMS)"
+                         % (len(self._lms_by_key), len(self._wims_by_pk)))
+    
+    
+    def invalidate(self) -> None:
+        """Invalidate the registry of every process."""
+        cache.set(VERSION_KEY, uuid.uuid4().hex, None)
+        with self._lock:
+            self._version = None
+    
+    
+    def get_lms_by_key(self, key: str) -> Any:
+        """Return the LMS whose key is <key>, raising LMS.DoesNotExist if there is none."""
+        LMS = apps.get_model("lti_app", "LMS")
+        if not self.enabled():
+            return LMS.objects.get(key=key)
+        
+        self._load()
+        try:
+            return self._lms_by_key[key]
+        except KeyError:
+            raise LMS.DoesNotExist("LMS matching query does not exist.")
+    
+    
+    def get_lms_by_guid(self, guid: str) -> Any:
+        """Return the LMS whose guid is <guid>, raising LMS.DoesNotExist if there is none, or
+        LMS.MultipleObjectsReturned if there is more than one."""
+        LMS = apps.get_model("lti_app", "LMS")
+        if not self.enabled():
+            return LMS.objects.get(guid=guid)
+        
+        self._load()
+        lms = self._lms_by_guid.get(guid, [])
+        if not lms:
+            raise LMS.DoesNotExist("LMS matching query does not exist.")
+        if len(lms) > 1:
+            raise LMS.MultipleObjectsReturned(
+                "get() returned more than one LMS -- it returned %d!" % len(lms)
+            )
+        return lms[0]
+    
+    
+    def get_wims(self, pk: int) -> Any:
+        """Return the WIMS whose pk is <pk>, raising WIMS.DoesNotExist if there is none."""
+        WIMS = apps.get_model("lti_app", "WIMS")
+        if not self.enabled():
+            return WIMS.objects.get(pk=pk)
+        
+        self._load()
+        try:
+            return self._wims_by_pk[int(pk)]
+        except KeyError:
+            raise WIMS.DoesNotExist("WIMS matching query does not exist.")
+
+
+
+registry = ConfigRegistry()
+
+
+
+@receiver(post_save, sender="lti_app.LMS")
+@receiver(post_delete, sender="lti_app.LMS")
+@receiver(post_save, sender="lti_app.WIMS")
+@receiver(post_delete, sender="lti_app.WIMS")
+def invalidate_registry(**kwargs) -> None:
+    """Invalidate the registry whenever a LMS or a WIMS is saved or deleted."""
+    registry.invalidate()
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+#
+#  roster.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+import csv
+import io
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Dict, Iterator, List, Optional
+
+import requests
+import wimsapi
+from django.conf import settings
+
+from lti_app import utils
+from lti_app.cache import get_class
+from lti_app.models import WimsClass, WimsUser
+from lti_app.utils import LaunchContext
+
+
+logger = logging.getLogger(__name__)
+
+# Columns accepted in a roster, mapped to the corresponding LTI parameter
+ROSTER_COLUMNS = {
+    "user_id":                          "user_id",
+    "lis_person_name_given":            "lis_person_name_given",
+    "lis_person_name_family":           "lis_person_name_family",
+    "lis_person_contact_email_primary": "lis_person_contact_email_primary",
+    "roles":                            "roles",
+    "given_name":                       "lis_person_name_given",
+    "firstname":                        "lis_person_name_given",
+    "family_name":                      "lis_person_name_family",
+    "lastname":                         "lis_person_name_family",
+    "email":                            "lis_person_contact_email_primary",
+}
+
+# LTI parameters which must be given for every member of a roster
+ROSTER_REQUIRED = ["user_id", "lis_person_name_given", "lis_person_name_family"]
+
+
+
+class ProvisionReport:
+    """Statistics about the users provisioned by provision()."""
+    
+    
+    def __init__(self):
+        self.created = 0
+        self.skipped = 0
+        self.failed = 0
+        self.elapsed = 0.0
+    
+    
+    def __str__(self) -> str:
+        return ("%d created, %d skipped, %d failed in %.2fs"
+                % (self.created, self.skipped, self.failed, self.elapsed))
+
+
+
+def _member(row: Dict[str, Any]) -> LaunchContext:
+    """Convert a row of a roster to the LTI parameters of its member."""
+    parameters = {}
+    for column, value in row.items():
+        name = ROSTER_COLUMNS.get(str(column).strip().lower())
+        if name is None or value is None:
+            continue
+        if name == "roles" and isinstance(value, list):
+            # LTI Names and Role Provisioning Services use URIs ending with '#<role>'
+            value = ",".join(r.rsplit("#", 1)[-1] for r in value)
+        parameters[name] = str(value).strip()
+    
+    missing = [p for p in ROSTER_REQUIRED if not parameters.get(p)]
+    if missing:
+        raise ValueError("Member '%s' of the roster is missing: %s"
+                         % (parameters.get("user_id", "?"), ", ".join(missing)))
+    return utils.parse_parameters(parameters)
+
+
+
+def read_roster(content: str) -> List[LaunchContext]:
+    """Read the members of a roster, returning the LTI parameters of each of them.
+    
+    The roster can either be a CSV file with a header, or a JSON membership export (either a
+    list of members, or an object with a 'members' list, as returned by the LTI Names and Role
+    Provisioning Services). See ROSTER_COLUMNS for the accepted columns / keys.
+    
+    Raises ValueError if the roster is malformed or if a member is missing a required column."""
+    stripped = content.lstrip()
+    if stripped.startswith(("{", "[")):
+        data = json.loads(stripped)
+        rows = data.get("members", []) if isinstance(data, dict) else data
+    else:
+        rows = csv.DictReader(io.StringIO(content))
+    
+    return [_member(row) for row in rows]
+
+
+
+def _add_user(wclass: wimsapi.Class, user: wimsapi.User) -> Optional[Exception]:
+    """Add <user> to <wclass>, returning the exception raised if it failed."""
+    try:
+        wclass.additem(user)
+        return None
+    except (wimsapi.WimsAPIError, requests.RequestException) as e:
+        return e
+
+
+
+def _adopt(wclass: wimsapi.Class, user: wimsapi.User, member: LaunchContext) -> bool:
+    """Return whether the WIMS user having the quser of <user> was created for <member>, e.g.
+    by a previous run interrupted before its WimsUser could be saved."""
+    try:
+        existing = wimsapi.User.get(wclass, user.quser)
+    except (wimsapi.WimsAPIError, requests.RequestException):
+        return False
+    return existing.regnum == member["user_id"]
+
+
+
+def provision(wclass_db: WimsClass, members: List[LaunchContext], workers: int = None,
+              batch_size: int = None) -> ProvisionReport:
+    """Create the WIMS accounts and the WimsUser of every member of <wclass_db> in <members>, so
+    that their first launch only has to read them.
+    
+    Members are provisioned by batches of <batch_size>, the accounts of a batch being created on
+    the WIMS server by at most <workers> concurrent requests. The WimsUser of a batch are saved
+    once it is done, so that a run can be interrupted and resumed: members already having a
+    WimsUser are skipped, as well as the teachers (who are logged in as the supervisor).
+    
+    Raises requests.RequestException if the WIMS server could not be joined and
+    wimsapi.WimsAPIError if it denied retrieving the class."""
+    workers = workers or settings.ROSTER_WORKERS
+    batch_size = batch_size or settings.ROSTER_BATCH_SIZE
+    report = ProvisionReport()
+    start = time.perf_counter()
+    
+    wclass = get_class(wclass_db.wims, wclass_db.qclass)
+    known = set(WimsUser.objects.filter(wclass=wclass_db).values_list("lms_guid", flat=True))
+    pending = []
+    for member in members:
+        if member.is_teacher or member["user_id"] in known:
+            report.skipped += 1
+            continue
+        known.add(member["user_id"])
+        pending.append(member)
+    
+    candidates: Dict[str, Iterator[str]] = {}
+    with ThreadPoolExecutor(workers, thread_name_prefix="roster") as executor:
+        for i in range(0, len(pending), batch_size):
+            batch = pending[i:i + batch_size]
+            users = []
+            for member in batch:
+                user = utils.create_user(member)
+                if user.quser not in candidates:
+                    candidates[user.quser] = utils.quser_candidates(wclass_db, user.quser)
+                user.quser = next(candidates[user.quser])
+                users.append(user)
+            
+            errors = list(executor.map(partial(_add_user, wclass), users))
+            created = []
+            conflicts = []
+            for member, user, error in zip(batch, users, errors):
+                if error is None or (
+                        "user already exists" in str(error) and _adopt(wclass, user, member)):
+                    created.append(
+                        WimsUser(lms_guid=member["user_id"], wclass=wclass_db, quser=user.quser)
+                    )
+                elif "user already exists" in str(error):
+                    conflicts.append(member)
+                else:
+                    logger.warning("Could not provision user '%s' in class %d: %s"
+                                   % (member["user_id"], wclass_db.id, str(error)))
+                    report.failed += 1
+            WimsUser.objects.bulk_create(created)
+            report.created += len(created)
+            
+            # quser taken outside of the LTI, retried one at a time
+            for member in conflicts:
+                try:
+                    utils.get_or_create_user(wclass_db, wclass, member)
+                    report.created += 1
+                except (wimsapi.WimsAPIError, requests.RequestException) as e:
+                    logger.warning("Could not provision user '%s' in class %d: %s"
+                                   % (member["user_id"], wclass_db.id, str(e)))
+                    report.failed += 1
+            
+            logger.info("Provisioned %d/%d users in class %d"
+                        % (min(i + batch_size, len(pending)), len(pending), wclass_db.id))
+    
+    report.elapsed = time.perf_counter() - start
+    logger.info("Roster of class %d provisioned: %s" % (wclass_db.id, report))
+    return report
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+#
+#  scheduler.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+import logging
+from datetime import timedelta
+from typing import Any, Callable, Optional
+
+from apscheduler.schedulers.base import BaseScheduler
+from django.apps import apps
+from django.conf import settings
+from django.db import close_old_connections
+
+from lti_app import tasks
+
+
+logger = logging.getLogger(__name__)
+
+# Scheduled tasks (name of the function in tasks, name of the setting containing its trigger)
+JOBS = [
+    ("send_back_all_grades", "SEND_GRADE_BACK_CRON_TRIGGER"),
+    ("check_classes_exists", "CHECK_CLASSES_EXISTS_CRON_TRIGGER"),
+]
+
+
+
+def run_locked(name: str) -> Optional[Any]:
+    """Run the task <name> of tasks, unless it is already running in another process (see
+    models.TaskLock). Returns the task's result, or None if it was not run."""
+    TaskLock = apps.get_model("lti_app", "TaskLock")
+    owner = tasks.owner_id()
+    ttl = timedelta(seconds=settings.SCHEDULER_LOCK_TTL)
+    
+    close_old_connections()
+    if not TaskLock.acquire(name, owner, ttl):
+        logger.info("Task '%s' is already running in another process, skipping it" % name)
+        return None
+    
+    try:
+        logger.info("Running task '%s'" % name)
+        return getattr(tasks, name)()
+    finally:
+        TaskLock.release(name, owner)
+        close_old_connections()
+
+
+
+def create_scheduler(scheduler_class: Callable[..., BaseScheduler]) -> BaseScheduler:
+    """Return a new, not yet started, instance of <scheduler_class> (an APScheduler scheduler)
+    running every task of JOBS according to its trigger."""
+    scheduler = scheduler_class(job_defaults={
+        'coalesce':           True,
+        'max_instances':      1,
+        'misfire_grace_time': 60 * 10,
+    })
+    for name, trigger in JOBS:
+        scheduler.add_job(run_locked, args=[name], id=name, name=name,
+                          trigger=getattr(settings, trigger))
+    return scheduler
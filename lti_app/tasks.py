@@ -6,11 +6,23 @@
 #       - Coumes Quentin <coumes.quentin@gmail.com>
 
 import logging
+import os
+import socket
+import threading
+import time
 import traceback
+import uuid
+from collections import defaultdict
+from datetime import timedelta
+from typing import Any, Optional, Set
 
+import requests
 import wimsapi
 from django.apps import apps
+from django.utils import timezone
 
+from lti_app import cache, connections
+from lti_app.dispatch import DispatchReport, GradeDispatcher, KeyedExecutor, circuit_breaker
 from wimsLTI import settings
 
 
@@ -18,72 +30,408 @@ logger = logging.getLogger(__name__)
 
 
 
-def send_back_all_sheets_grades() -> int:
-    """Send back the grades of every User of every WimsSheet to their corresponding LMS."""
+def owner_id() -> str:
+    """Return an identifier unique to the calling process and thread, used as the owner of the
+    TaskLock and GradeSyncShard it acquires."""
+    return "%s:%d:%d:%s" % (socket.gethostname(), os.getpid(), threading.get_ident(),
+                            uuid.uuid4().hex[:8])
+
+
+
+def _send_class_grades(wclass_db: Any, dispatcher: GradeDispatcher, sheets: bool, exams: bool,
+                       force: bool) -> None:
+    """Send back the grades of every User of every WimsSheet and / or WimsExam of <wclass_db>,
+    whose sheets and exams must have been prefetched, through <dispatcher>."""
     GradeLinkSheet = apps.get_model("lti_app", "GradeLinkSheet")
-    WimsSheet = apps.get_model("lti_app", "WimsSheet")
-    total = 0
+    GradeLinkExam = apps.get_model("lti_app", "GradeLinkExam")
     
-    logger.info("Sending grades of every User of every WimsSheet to their LMS")
-    for sheet in WimsSheet.objects.all():
+    activities = []
+    if sheets:
+        activities += [(GradeLinkSheet, s) for s in wclass_db.wimssheet_set.all()]
+    if exams:
+        activities += [(GradeLinkExam, e) for e in wclass_db.wimsexam_set.all()]
+    if not activities:
+        return
+    
+    try:
+        wims = wclass_db.wims
+        wclass = wimsapi.Class.get(
+            wims.url, wims.ident, wims.passwd, wclass_db.qclass, wims.rclass,
+            timeout=settings.WIMSAPI_TIMEOUT
+        )
+    except wimsapi.WimsAPIError:  # pragma: no cover
+        logger.info("Failed to retrieve class '%s'" % str(wclass_db))
+        logger.info(traceback.format_exc())
+        return
+    
+    for model, activity in activities:
         try:
-            total = + GradeLinkSheet.send_back_all(sheet)
+            model.send_back_all(activity, dispatcher, wclass, force)
         except wimsapi.WimsAPIError:  # pragma: no cover
-            logger.info("Failed to send grade for sheet '%s'" % str(sheet))
+            logger.info("Failed to send grade for activity '%s'" % str(activity))
             logger.info(traceback.format_exc())
-    logger.info("Done sending grades of every User of every WimsSheet to their LMS (%d sent)"
-                % total)
-    return total
 
 
 
-def send_back_all_exams_grades() -> int:
-    """Send back the grades of every User of every WimsExam to their corresponding LMS."""
-    GradeLinkExam = apps.get_model("lti_app", "GradeLinkExam")
-    WimsExam = apps.get_model("lti_app", "WimsExam")
-    total = 0
+def _run_shard(shard: Any, dispatcher: GradeDispatcher, checkpoint: int) -> bool:
+    """Send back the grades of the classes of <shard> following its checkpoint, saving a new
+    checkpoint every <checkpoint> classes. Returns False if the shard was claimed by another
+    process in the meantime (e.g. because this one stalled past its lease).
     
-    logger.info("Sending grades of every User of every WimsExam to their LMS")
-    for exam in WimsExam.objects.all():
+    The shard is marked as failed if its WIMS server cannot be joined, logging how many of its
+    classes were not synchronized."""
+    WimsClass = apps.get_model("lti_app", "WimsClass")
+    
+    sheets, exams = shard.KINDS[shard.kind]
+    prefetch = (["wimssheet_set"] if sheets else []) + (["wimsexam_set"] if exams else [])
+    classes = WimsClass.objects.filter(
+        wims_id=shard.wims_id, pk__gt=shard.checkpoint, pk__gte=shard.first_class,
+        pk__lte=shard.last_class,
+    ).select_related("wims").prefetch_related(*prefetch).order_by("pk")
+    
+    report = dispatcher.report
+    done, last = 0, shard.checkpoint
+    sent, failed = report.sent, report.failed
+    try:
+        for wclass_db in classes:
+            _send_class_grades(wclass_db, dispatcher, sheets, exams, shard.force)
+            done, last = done + 1, wclass_db.pk
+            if done % checkpoint == 0:
+                dispatcher.flush()
+                if not shard.save_checkpoint(last, done, report.sent - sent,
+                                             report.failed - failed):
+                    return False
+                done, sent, failed = 0, report.sent, report.failed
+    except requests.RequestException:
+        remaining = classes.filter(pk__gt=last).count()
+        logger.warning(
+            ("Grade synchronization shard %d (%s) failed, its WIMS server could not be joined: "
+             "its %d remaining class(es) will only be synchronized by the next run")
+            % (shard.pk, str(shard), remaining), exc_info=True
+        )
+        dispatcher.flush()
+        return shard.save_checkpoint(last, done, report.sent - sent, report.failed - failed,
+                                     status=shard.FAILED)
+    
+    dispatcher.flush()
+    return shard.save_checkpoint(shard.last_class, done, report.sent - sent,
+                                 report.failed - failed, status=shard.DONE)
+
+
+
+def run_grade_sync_shards(kind: str = None, dispatcher: GradeDispatcher = None,
+                          checkpoint: int = None) -> int:
+    """Claim and run the GradeSyncShard (of <kind> if given) until none is left, sending their
+    grades through <dispatcher> (a new one by default). Returns the number of shards run.
+    
+    Can be called by any number of processes at once, each shard being run by a single one."""
+    GradeSyncShard = apps.get_model("lti_app", "GradeSyncShard")
+    checkpoint = checkpoint or settings.GRADE_SYNC_CHECKPOINT
+    owner = owner_id()
+    
+    if dispatcher is None:
+        with GradeDispatcher() as dispatcher:
+            return run_grade_sync_shards(kind, dispatcher, checkpoint)
+    
+    run = 0
+    while True:
+        shard = GradeSyncShard.claim(owner, kind)
+        if shard is None:
+            return run
+        
+        logger.info("Running grade synchronization shard '%s'" % str(shard))
+        if _run_shard(shard, dispatcher, checkpoint):
+            run += 1
+        else:
+            logger.warning("Grade synchronization shard '%s' was claimed by another process"
+                           % str(shard))
+
+
+
+def send_back_grades(sheets: bool = True, exams: bool = True, force: bool = False
+                     ) -> DispatchReport:
+    """Send back the grades of every User of every WimsSheet and / or WimsExam to their
+    corresponding LMS.
+    
+    Only grades which changed since they were last sent are sent, unless <force> is True.
+    
+    Classes are partitioned in GradeSyncShard (by WIMS server and range of classes), which are
+    then run by this process and by any other running run_grade_sync_shards() (see the
+    'sync_grades' command). Each shard saves its progress every GRADE_SYNC_CHECKPOINT classes:
+    if the previous run of the same kind did not finish, it is resumed from these checkpoints
+    instead of starting a new one, unless <force> is True (see GradeSyncShard.plan()).
+    
+    Activities are grouped by WimsClass, so that each class is retrieved only once from its WIMS
+    server, the scores of every activity being then fetched from this class. Every grade sent by
+    this process goes through a single GradeDispatcher, whose report is returned."""
+    GradeSyncShard = apps.get_model("lti_app", "GradeSyncShard")
+    TaskLock = apps.get_model("lti_app", "TaskLock")
+    
+    kind = {(True, True): "all", (True, False): "sheets", (False, True): "exams"}[sheets, exams]
+    name = "grade_sync_plan_%s" % kind
+    owner = owner_id()
+    if TaskLock.acquire(name, owner, timedelta(seconds=settings.GRADE_SYNC_LEASE)):
         try:
-            total = + GradeLinkExam.send_back_all(exam)
-        except wimsapi.WimsAPIError:  # pragma: no cover
-            logger.info("Failed to send grade for exam '%s'" % str(exam))
-            logger.info(traceback.format_exc())
-    logger.info("Done sending grades of every User of every WimsExam to their LMS (%d sent)"
-                % total)
-    return total
+            planned = GradeSyncShard.plan(kind, force)
+            if planned is None:
+                logger.info("Resuming the unfinished '%s' grade synchronization" % kind)
+            elif not planned:
+                logger.info("No class to run the '%s' grade synchronization on" % kind)
+        finally:
+            TaskLock.release(name, owner)
+    
+    with GradeDispatcher() as dispatcher:
+        run_grade_sync_shards(kind, dispatcher)
+    
+    logger.info("HTTP connections: %s" % connections.registry.summary())
+    return dispatcher.report
+
+
+
+def send_back_all_grades(force: bool = False) -> int:
+    """Send back the grades of every User of every WimsSheet and WimsExam to their corresponding
+    LMS. Only grades which changed since they were last sent are sent, unless <force> is True."""
+    logger.info("Sending grades of every User of every WimsSheet and WimsExam to their LMS")
+    report = send_back_grades(force=force)
+    logger.info("Done sending grades of every User of every WimsSheet and WimsExam to their LMS "
+                "(%s)" % report)
+    return report.sent
+
 
 
+def send_back_all_sheets_grades(force: bool = False) -> int:
+    """Send back the grades of every User of every WimsSheet to their corresponding LMS. Only
+    grades which changed since they were last sent are sent, unless <force> is True."""
+    logger.info("Sending grades of every User of every WimsSheet to their LMS")
+    report = send_back_grades(exams=False, force=force)
+    logger.info("Done sending grades of every User of every WimsSheet to their LMS (%s)" % report)
+    return report.sent
+
+
+
+def send_back_all_exams_grades(force: bool = False) -> int:
+    """Send back the grades of every User of every WimsExam to their corresponding LMS. Only
+    grades which changed since they were last sent are sent, unless <force> is True."""
+    logger.info("Sending grades of every User of every WimsExam to their LMS")
+    report = send_back_grades(sheets=False, force=force)
+    logger.info("Done sending grades of every User of every WimsExam to their LMS (%s)" % report)
+    return report.sent
+
 
-def check_classes_exists() -> int:
+
+def run_grade_sync_jobs() -> int:
+    """Run every pending GradeSyncJob, sending back every grade of their activity. Returns the
+    number of jobs run.
+    
+    A job is deleted before being run, so that it is run by a single process and that a new job
+    can be queued for the same activity in the meantime."""
+    GradeSyncJob = apps.get_model("lti_app", "GradeSyncJob")
+    GradeLinkSheet = apps.get_model("lti_app", "GradeLinkSheet")
+    GradeLinkExam = apps.get_model("lti_app", "GradeLinkExam")
+    
+    jobs = GradeSyncJob.objects.select_related("sheet__wclass__wims", "exam__wclass__wims")
+    run = 0
+    with GradeDispatcher() as dispatcher:
+        for job in jobs.order_by("created"):
+            if not GradeSyncJob.objects.filter(pk=job.pk).delete()[0]:
+                continue  # Already run by another process
+            
+            model = GradeLinkSheet if job.sheet_id is not None else GradeLinkExam
+            try:
+                model.send_back_all(job.activity, dispatcher)
+            except (wimsapi.WimsAPIError, requests.RequestException):
+                logger.info("Failed to send grade for activity '%s'" % str(job.activity))
+                logger.info(traceback.format_exc())
+            run += 1
+    
+    if run:
+        logger.info("Done running %d grade synchronization job(s) (%s)"
+                    % (run, dispatcher.report))
+    return run
+
+
+
+def retry_deferred_grades() -> int:
+    """Send again the grades of the GradeOutbox whose next attempt is due, except those of LMSs
+    whose circuit is opened. Returns the number of grades successfully sent.
+    
+    At most settings.OUTBOX_BATCH_SIZE grades are sent, the oldest due first. Grades failing
+    again are put back in the outbox with an increased delay by the dispatcher.
+    
+    Each grade is claimed before being sent, by pushing its next attempt back, so that a grade is
+    never sent by two processes at once."""
+    GradeOutbox = apps.get_model("lti_app", "GradeOutbox")
+    
+    due = GradeOutbox.objects.filter(next_attempt__lte=timezone.now()).exclude(
+        lms__in=circuit_breaker.opened()
+    ).select_related(
+        "sheet_link__user", "sheet_link__lms", "sheet_link__activity__wclass",
+        "exam_link__user", "exam_link__lms", "exam_link__activity__wclass",
+    ).order_by("next_attempt")[:settings.OUTBOX_BATCH_SIZE]
+    
+    with GradeDispatcher() as dispatcher:
+        for entry in due:
+            claimed = GradeOutbox.objects.filter(
+                pk=entry.pk, next_attempt=entry.next_attempt
+            ).update(next_attempt=timezone.now() + GradeOutbox.CLAIM_DELAY)
+            if not claimed:
+                continue  # Already sent by another process
+            dispatcher.submit(entry.link, entry.grade)
+    
+    if dispatcher.report.total or dispatcher.report.deferred:
+        logger.info("Done retrying deferred grades (%s)" % dispatcher.report)
+    return dispatcher.report.sent
+
+
+
+def send_queued_mails() -> int:
+    """Send the mails of the MailOutbox whose next attempt is due, the oldest first. Returns the
+    number of mails successfully sent.
+    
+    Each mail is claimed before being sent, by pushing its next attempt back, so that a mail is
+    never sent by two processes at once."""
+    MailOutbox = apps.get_model("lti_app", "MailOutbox")
+    
+    due = MailOutbox.objects.filter(next_attempt__lte=timezone.now()).order_by("next_attempt")
+    sent = total = 0
+    for mail in due[:settings.OUTBOX_BATCH_SIZE]:
+        claimed = MailOutbox.objects.filter(pk=mail.pk, next_attempt=mail.next_attempt).update(
+            next_attempt=timezone.now() + MailOutbox.CLAIM_DELAY
+        )
+        if not claimed:
+            continue  # Already sent by another process
+        sent += mail.send()
+        total += 1
+    
+    if total:
+        logger.info("Done sending queued mails (%d/%d sent)" % (sent, total))
+    return sent
+
+
+
+def run_pending_jobs() -> None:
+    """Run every job queued in the database."""
+    run_grade_sync_jobs()
+    retry_deferred_grades()
+    send_queued_mails()
+
+
+
+class CheckClassesReport:
+    """Statistics about a run of check_classes_exists()."""
+    
+    
+    def __init__(self):
+        self.servers = 0
+        self.checked = 0
+        self.listed = 0
+        self.deleted = 0
+        self.errors = 0
+        self.elapsed = 0.0
+    
+    
+    def __str__(self) -> str:
+        return (("%d classes checked on %d WIMS servers in %.2fs (%d listed in bulk, %d checked "
+                 "one by one): %d deleted, %d errors")
+                % (self.checked, self.servers, self.elapsed, self.listed,
+                   self.checked - self.listed, self.deleted, self.errors))
+
+
+
+def list_qclasses(wims: Any) -> Set[str]:
+    """Return the qclass of every class of the WIMS server <wims> (a models.WIMS) having
+    connection with its rclass, with a single request.
+    
+    Raises the same exceptions as wimsapi.WimsAPI.listclasses()."""
+    api = wimsapi.WimsAPI(wims.url, wims.ident, wims.passwd, timeout=settings.WIMSAPI_TIMEOUT)
+    status, response = api.listclasses(wims.rclass, verbose=True)
+    if not status:
+        if "there is no class allowed for this server" in response["message"]:
+            return set()
+        raise wimsapi.AdmRawError(response["message"])
+    return {str(c["qclass"]) for c in response["classes_list"]}
+
+
+
+def class_exists(wims: Any, qclass: str) -> Optional[bool]:
+    """Return whether the class <qclass> exists on the WIMS server <wims> (a models.WIMS), or
+    None if it could not be checked."""
+    try:
+        wimsapi.Class.get(wims.url, wims.ident, wims.passwd, qclass, wims.rclass,
+                          timeout=settings.WIMSAPI_TIMEOUT)
+        return True
+    except wimsapi.WimsAPIError as e:
+        if "class %s not existing" % str(qclass) in str(e):
+            return False
+        logger.info("An error occurred checking for class '%s' on server '%s': %s"
+                    % (str(qclass), wims.url, str(e)))
+    except requests.RequestException as e:
+        logger.info("Could not check for class '%s' on server '%s': %s"
+                    % (str(qclass), wims.url, str(e)))
+    return None
+
+
+
+def check_classes_exists(workers: int = None, per_server: int = None) -> int:
     """Checks that the corresponding class exists on its WIMS server for every WimsClass. Delete
-    the instance of WimsClass if not."""
+    the instance of WimsClass if not. Returns the number of deleted WimsClass.
+    
+    Classes are grouped by WIMS server. The classes of each server are first listed with a single
+    request, only the classes missing from this list being then checked one by one before being
+    deleted. If the list cannot be retrieved, every class of the server is checked one by one.
+    
+    These checks are sent concurrently, by at most <workers> threads (CHECK_CLASSES_WORKERS by
+    default), with at most <per_server> concurrent requests (CHECK_CLASSES_PER_SERVER by default)
+    to a same server. The checks of a server which already receives <per_server> requests wait
+    in a queue of this server (see dispatch.KeyedExecutor), so that a slow server does not delay
+    the checks of the others."""
     WimsClass = apps.get_model("lti_app", "WimsClass")
+    workers = workers or settings.CHECK_CLASSES_WORKERS
+    per_server = per_server or settings.CHECK_CLASSES_PER_SERVER
+    report = CheckClassesReport()
+    start = time.perf_counter()
     
-    deleted = 0
-    for c in WimsClass.objects.all():
-        try:
-            wimsapi.Class.get(
-                c.wims.url, c.wims.ident, c.wims.passwd, c.qclass, c.wims.rclass,
-                timeout=settings.WIMSAPI_TIMEOUT
-            )
-        except wimsapi.WimsAPIError as e:
-            # Delete the class if it does not exists on the server anymore
-            if "class %s not existing" % str(c.qclass) in str(e):
+    servers = defaultdict(list)
+    for c in WimsClass.objects.select_related("wims"):
+        servers[c.wims_id].append(c)
+    report.servers = len(servers)
+    
+    checks = []
+    with KeyedExecutor(workers, per_server, "check-classes") as executor:
+        listings = {
+            wims_id: executor.submit(wims_id, list_qclasses, classes[0].wims)
+            for wims_id, classes in servers.items()
+        }
+        for wims_id, classes in servers.items():
+            try:
+                listed = listings[wims_id].result()
+            except (wimsapi.WimsAPIError, requests.RequestException) as e:
+                logger.info("Could not list the classes of the WIMS server '%s', checking them "
+                            "one by one: %s" % (classes[0].wims.url, str(e)))
+                listed = set()
+            
+            for c in classes:
+                report.checked += 1
+                if str(c.qclass) in listed:
+                    report.listed += 1
+                else:
+                    checks.append((c, executor.submit(wims_id, class_exists, c.wims, c.qclass)))
+        
+        for c, future in checks:
+            exists = future.result()
+            if exists is None:
+                report.errors += 1
+            elif not exists:
                 logger.info(
                     (
                         "Deleting class of pk '%s' has the corresponding class of id '%s' does not "
                         "exists on the WIMS server '%s'  anymore")
                     % (str(c.pk), str(c.qclass), c.wims.url)
                 )
+                cache.invalidate_class(c.wims, c.qclass)
                 c.delete()
-                deleted += 1
-            else:  # pragma: no cover
-                logger.info(
-                    "An error occurred checking for class of pk '%s' (qclass '%s', server '%s')"
-                    % (str(c.pk), str(c.qclass), c.wims.url)
-                )
-                logger.info(traceback.format_exc())
+                report.deleted += 1
     
-    return deleted
+    report.elapsed = time.perf_counter() - start
+    logger.info("Done checking classes (%s)" % report)
+    return report.deleted
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+#
+#  test_cache.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+import threading
+import time
+from unittest import mock
+
+import requests
+from django.test import SimpleTestCase, override_settings
+from wimsapi import WimsAPIError
+
+from lti_app import cache
+from lti_app.cache import ServerHealth, TTLCache
+
+
+
+class TTLCacheTestCase(SimpleTestCase):
+    
+    def test_get(self):
+        ttl_cache = TTLCache(ttl=60)
+        compute = mock.Mock(return_value=1)
+        self.assertEqual(1, ttl_cache.get("key", compute))
+        self.assertEqual(1, ttl_cache.get("key", compute))
+        self.assertEqual(1, compute.call_count)
+        
+        ttl_cache.invalidate("key")
+        self.assertEqual(1, ttl_cache.get("key", compute))
+        self.assertEqual(2, compute.call_count)
+        
+        ttl_cache.clear()
+        self.assertEqual(1, ttl_cache.get("key", compute))
+        self.assertEqual(3, compute.call_count)
+    
+    
+    def test_expired(self):
+        ttl_cache = TTLCache(ttl=0.05)
+        compute = mock.Mock(return_value=1)
+        ttl_cache.get("key", compute)
+        time.sleep(0.06)
+        ttl_cache.get("key", compute)
+        self.assertEqual(2, compute.call_count)
+    
+    
+    @override_settings(WIMS_CLASS_CACHE_TTL=0)
+    def test_disabled(self):
+        ttl_cache = TTLCache("WIMS_CLASS_CACHE_TTL")
+        compute = mock.Mock(return_value=1)
+        ttl_cache.get("key", compute)
+        ttl_cache.get("key", compute)
+        self.assertEqual(2, compute.call_count)
+    
+    
+    def test_exception_not_cached(self):
+        ttl_cache = TTLCache(ttl=60)
+        compute = mock.Mock(side_effect=[ValueError(), 1])
+        with self.assertRaises(ValueError):
+            ttl_cache.get("key", compute)
+        self.assertEqual(1, ttl_cache.get("key", compute))
+    
+    
+    def test_single_flight(self):
+        ttl_cache = TTLCache(ttl=60)
+        calls = []
+        results = []
+        barrier = threading.Barrier(20)
+        
+        def compute():
+            calls.append(1)
+            time.sleep(0.05)
+            return "class"
+        
+        def launch():
+            barrier.wait()
+            results.append(ttl_cache.get("key", compute))
+        
+        threads = [threading.Thread(target=launch) for _ in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        
+        self.assertEqual(1, len(calls))
+        self.assertEqual(["class"] * 20, results)
+    
+    
+    def test_single_flight_exception(self):
+        ttl_cache = TTLCache(ttl=60)
+        started = threading.Event()
+        release = threading.Event()
+        errors = []
+        
+        def compute():
+            started.set()
+            release.wait(5)
+            raise ValueError("down")
+        
+        def launch():
+            try:
+                ttl_cache.get("key", compute)
+            except ValueError as e:
+                errors.append(e)
+        
+        leader = threading.Thread(target=launch)
+        leader.start()
+        started.wait(5)
+        follower = threading.Thread(target=launch)
+        follower.start()
+        time.sleep(0.02)
+        release.set()
+        leader.join()
+        follower.join()
+        
+        self.assertEqual(2, len(errors))
+        self.assertIs(errors[0], errors[1])
+
+
+
+@override_settings(WIMS_CLASS_CACHE_TTL=60)
+class GetClassTestCase(SimpleTestCase):
+    
+    def setUp(self):
+        cache.classes.clear()
+        self.wims = mock.Mock(url="https://wims.fr/wims/wims.cgi", ident="myself",
+                              passwd="toto", rclass="myclass")
+    
+    
+    def tearDown(self):
+        cache.classes.clear()
+    
+    
+    @mock.patch("wimsapi.Class.get")
+    def test_get_class(self, get):
+        get.return_value = mock.Mock(qclass="1", lang="fr")
+        
+        wclass = cache.get_class(self.wims, "1")
+        wclass.lang = "en"
+        self.assertEqual("fr", cache.get_class(self.wims, "1").lang)
+        get.assert_called_once_with("https://wims.fr/wims/wims.cgi", "myself", "toto", "1",
+                                    "myclass", timeout=mock.ANY)
+        
+        cache.get_class(self.wims, "2")
+        self.assertEqual(2, get.call_count)
+    
+    
+    @mock.patch("wimsapi.Class.get")
+    def test_invalidate_class(self, get):
+        cache.get_class(self.wims, "1")
+        cache.invalidate_class(self.wims, "1")
+        cache.get_class(self.wims, "1")
+        self.assertEqual(2, get.call_count)
+
+
+
+@override_settings(WIMS_HEALTH_TTL=60, WIMS_DOWN_TTL=60)
+class ServerHealthTestCase(SimpleTestCase):
+    
+    def setUp(self):
+        self.wapi = mock.Mock(url="https://wims.fr/wims/wims.cgi", ident="myself")
+    
+    
+    def test_up(self):
+        health = ServerHealth()
+        self.wapi.checkident.return_value = (True, {"status": "OK"})
+        for _ in range(3):
+            health.check(self.wapi)
+        self.wapi.checkident.assert_called_once_with(verbose=True)
+        
+        health.clear()
+        health.check(self.wapi)
+        self.assertEqual(2, self.wapi.checkident.call_count)
+    
+    
+    def test_down(self):
+        health = ServerHealth()
+        self.wapi.checkident.side_effect = requests.ConnectTimeout()
+        with self.assertRaises(requests.ConnectTimeout):
+            health.check(self.wapi)
+        for _ in range(3):
+            with self.assertRaises(requests.ConnectionError):
+                health.check(self.wapi)
+        self.wapi.checkident.assert_called_once_with(verbose=True)
+    
+    
+    @override_settings(WIMS_DOWN_TTL=0)
+    def test_back_up(self):
+        health = ServerHealth()
+        self.wapi.checkident.side_effect = [requests.ConnectionError(), (True, {})]
+        with self.assertRaises(requests.ConnectionError):
+            health.check(self.wapi)
+        health.check(self.wapi)
+        health.check(self.wapi)
+        self.assertEqual(2, self.wapi.checkident.call_count)
+    
+    
+    def test_error_not_cached(self):
+        health = ServerHealth()
+        self.wapi.checkident.return_value = (False, {"message": "Bad ident"})
+        for _ in range(2):
+            with self.assertRaises(WimsAPIError):
+                health.check(self.wapi)
+        self.assertEqual(2, self.wapi.checkident.call_count)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+#
+#  test_connections.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import wimsapi
+from django.test import TestCase, override_settings
+
+from lti_app import connections
+from lti_app.connections import SessionRegistry
+
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    
+    
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        body = b"OK"
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    
+    def log_message(self, *args):
+        pass
+
+
+
+class SessionRegistryTestCase(TestCase):
+    
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), KeepAliveHandler)
+        cls.url = "http://127.0.0.1:%d/" % cls.server.server_port
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+    
+    
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+    
+    
+    def test_host(self):
+        self.assertEqual("https://lms.fr", SessionRegistry.host("https://LMS.fr/mod/lti"))
+        self.assertEqual("http://wims.fr:8080", SessionRegistry.host("http://wims.fr:8080/a?b=c"))
+    
+    
+    def test_get_same_host(self):
+        registry = SessionRegistry()
+        self.assertIs(registry.get("https://lms.fr/a"), registry.get("https://lms.fr/b"))
+        self.assertIsNot(registry.get("https://lms.fr/a"), registry.get("https://wims.fr/a"))
+        registry.clear()
+    
+    
+    def test_connection_reused(self):
+        registry = SessionRegistry()
+        for _ in range(5):
+            self.assertEqual(200, registry.post(self.url, data=b"grade").status_code)
+        
+        stats = registry.stats()[SessionRegistry.host(self.url)]
+        self.assertEqual(5, stats["requests"])
+        self.assertEqual(1, stats["connections"])
+        self.assertEqual(4, stats["reused"])
+        self.assertIn("5 requests, 1 connections (4 reused)", registry.summary())
+        registry.clear()
+        self.assertEqual({}, registry.stats())
+    
+    
+    @override_settings(HTTP_POOL_KEEP_ALIVE=False)
+    def test_keep_alive_disabled(self):
+        registry = SessionRegistry()
+        self.assertEqual("close", registry.get(self.url).headers["Connection"])
+        self.assertEqual(200, registry.post(self.url, data=b"grade").status_code)
+        registry.clear()
+    
+    
+    def test_wimsapi_transport(self):
+        connections.install_wimsapi_transport()
+        self.assertIs(connections.wimsapi_post, wimsapi.api.post)
+        
+        with mock.patch.object(connections.registry, "post") as post:
+            wimsapi.api.post(self.url, data={"job": "checkident", "name": "é"})
+        post.assert_called_once_with(
+            self.url, data={"job": b"checkident", "name": "é".encode("ISO-8859-1")},
+            headers={"Content-Type": "application/x-www-form-urlencoded; charset=ISO-8859-1"}
+        )
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+#
+#  test_db.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+import os
+import subprocess
+import sys
+import tempfile
+from io import StringIO
+from unittest import mock
+
+from django.conf import settings
+from django.core.management import CommandError, call_command
+from django.db.utils import ConnectionHandler
+from django.test import LiveServerTestCase, SimpleTestCase
+from django.urls import reverse
+
+from lti_app import db
+from lti_app.management.commands.load_test import launch_parameters
+from lti_app.models import LMS
+from wimsLTI import databases
+
+
+
+class SqliteProfileTestCase(SimpleTestCase):
+    
+    def test_pragmas(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        handler = ConnectionHandler({
+            "default": databases.sqlite(os.path.join(directory.name, "db.sqlite3"), timeout=3),
+        })
+        connection = handler["default"]
+        self.addCleanup(connection.close)
+        
+        with connection.cursor() as cursor:
+            self.assertEqual("wal", cursor.execute("PRAGMA journal_mode").fetchone()[0])
+            self.assertEqual(1, cursor.execute("PRAGMA synchronous").fetchone()[0])  # NORMAL
+            self.assertEqual(3000, cursor.execute("PRAGMA busy_timeout").fetchone()[0])
+    
+    
+    def test_postgresql(self):
+        profile = databases.postgresql("wimslti", "user", "password", conn_max_age=30)
+        self.assertEqual("django.db.backends.postgresql", profile["ENGINE"])
+        self.assertEqual(30, profile["CONN_MAX_AGE"])
+        self.assertTrue(profile["CONN_HEALTH_CHECKS"])
+
+
+
+class CheckConnectionsTestCase(SimpleTestCase):
+    
+    @mock.patch("lti_app.db.connections")
+    def test_check_connections(self, connections):
+        usable = mock.Mock(settings_dict={"CONN_HEALTH_CHECKS": True})
+        usable.is_usable.return_value = True
+        broken = mock.Mock(settings_dict={"CONN_HEALTH_CHECKS": True})
+        broken.is_usable.return_value = False
+        unchecked = mock.Mock(settings_dict={})
+        closed = mock.Mock(settings_dict={"CONN_HEALTH_CHECKS": True}, connection=None)
+        connections.all.return_value = [usable, broken, unchecked, closed]
+        
+        db.check_connections()
+        
+        usable.close.assert_not_called()
+        broken.close.assert_called_once_with()
+        unchecked.is_usable.assert_not_called()
+        closed.is_usable.assert_not_called()
+    
+    
+    def test_receivers_order(self):
+        # The test client disconnects and reconnects close_old_connections() around each request,
+        # the receivers of a newly started process are thus checked instead
+        script = (
+            "import django; django.setup()\n"
+            "from django.core.signals import request_started\n"
+            "from lti_app import db\n"
+            "db.connect_signals()\n"
+            "print(' '.join(r.__name__ for r in request_started._live_receivers(None)))\n"
+        )
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE="wimsLTI.settings")
+        output = subprocess.run([sys.executable, "-c", script], env=env, check=True,
+                                cwd=settings.BASE_DIR, stdout=subprocess.PIPE,
+                                universal_newlines=True).stdout
+        receivers = output.split()
+        
+        self.assertEqual(1, receivers.count("check_connections"))
+        self.assertLess(receivers.index("close_old_connections"),
+                        receivers.index("check_connections"))
+
+
+
+class LoadTestTestCase(LiveServerTestCase):
+    
+    def test_launch_parameters(self):
+        params = launch_parameters(12, 10, "ctx", "Learner")
+        self.assertEqual("load-test-2", params["user_id"])
+        self.assertEqual("ctx", params["context_id"])
+    
+    
+    @mock.patch("lti_app.launch.is_valid_request")  # The live server does not use HTTPS
+    def test_load_test(self, is_valid_request):
+        LMS.objects.create(guid="load-test", url="https://lms.invalid/", name="Load test",
+                           key="key", secret="secret")
+        url = self.live_server_url + reverse("lti:wims_class", args=[999])
+        
+        out = StringIO()
+        call_command("load_test", url, "--key", "key", "--secret", "secret", "--launches", "6",
+                     "--concurrency", "2", stdout=out)
+        
+        # There is no WIMS server of pk 999
+        self.assertEqual(6, is_valid_request.call_count)
+        self.assertIn("0 succeeded, 6 failed", out.getvalue())
+        self.assertIn("Status codes: 404: 6", out.getvalue())
+        
+        with self.assertRaises(CommandError):
+            call_command("load_test", url, "--key", "key", "--secret", "secret", "--users", "0")
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+#
+#  test_dispatch.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+import threading
+import time
+
+from django.test import TestCase
+
+from lti_app.dispatch import (CircuitBreaker, DispatchReport, GradeDispatcher, KeyedExecutor,
+                              circuit_breaker)
+
+
+
+class FakeGradeLink:
+    """Mimic a GradeLinkBase, keeping track of the concurrent calls to send_back()."""
+    
+    lock = threading.Lock()
+    
+    
+    def __init__(self, lms_id, success=True, running=None):
+        self.lms_id = lms_id
+        self.success = success
+        self.running = running if running is not None else {"current": 0, "max": 0}
+    
+    
+    @classmethod
+    def mark_sent(cls, links):
+        for gl, grade in links:
+            gl.last_score = grade
+    
+    
+    @classmethod
+    def defer(cls, links, attempted=True):
+        for gl, grade in links:
+            gl.deferred = (grade, attempted)
+    
+    
+    def send_back(self, grade):
+        with self.lock:
+            self.running["current"] += 1
+            self.running["max"] = max(self.running["max"], self.running["current"])
+        time.sleep(0.02)
+        with self.lock:
+            self.running["current"] -= 1
+        if isinstance(self.success, Exception):
+            raise self.success
+        return self.success
+
+
+
+class DispatchReportTestCase(TestCase):
+    
+    def test_percentile(self):
+        report = DispatchReport()
+        self.assertEqual(0, report.percentile(50))
+        for i in range(1, 101):
+            report.record(True, i / 1000)
+        self.assertEqual(0.05, report.percentile(50))
+        self.assertEqual(0.09, report.percentile(90))
+        self.assertEqual(0.099, report.percentile(99))
+        self.assertEqual(0.001, report.percentile(0))
+    
+    
+    def test_counts(self):
+        report = DispatchReport()
+        report.record(True, 0.1)
+        report.record(False, 0.1)
+        report.record(True, 0.1)
+        report.skipped = 4
+        report.elapsed = 1.5
+        self.assertEqual(2, report.sent)
+        self.assertEqual(1, report.failed)
+        self.assertEqual(3, report.total)
+        self.assertEqual(2, report.throughput)
+        self.assertIn("2 sent, 4 skipped, 1 failed, 0 deferred", str(report))
+
+
+
+class CircuitBreakerTestCase(TestCase):
+    
+    def test_open_after_threshold(self):
+        breaker = CircuitBreaker(threshold=3, cooldown=60)
+        for _ in range(2):
+            breaker.record(1, False)
+        self.assertTrue(breaker.allow(1))
+        breaker.record(1, True)
+        for _ in range(2):
+            breaker.record(1, False)
+        self.assertTrue(breaker.allow(1))
+        
+        breaker.record(1, False)
+        self.assertFalse(breaker.allow(1))
+        self.assertTrue(breaker.allow(2))
+        self.assertEqual([1], breaker.opened())
+        
+        breaker.reset()
+        self.assertTrue(breaker.allow(1))
+    
+    
+    def test_half_open(self):
+        breaker = CircuitBreaker(threshold=1, cooldown=0.05)
+        breaker.record(1, False)
+        self.assertFalse(breaker.allow(1))
+        time.sleep(0.06)
+        
+        self.assertTrue(breaker.allow(1))
+        self.assertFalse(breaker.allow(1))
+        breaker.record(1, False)
+        self.assertFalse(breaker.allow(1))
+        time.sleep(0.06)
+        
+        self.assertTrue(breaker.allow(1))
+        breaker.record(1, True)
+        self.assertTrue(breaker.allow(1))
+        self.assertTrue(breaker.allow(1))
+        self.assertEqual([], breaker.opened())
+
+
+
+class KeyedExecutorTestCase(TestCase):
+    
+    def test_other_keys_not_blocked(self):
+        release = threading.Event()
+        with KeyedExecutor(workers=2, per_key=1) as executor:
+            try:
+                blocked = [executor.submit("slow", release.wait, 5) for _ in range(3)]
+                fast = [executor.submit("fast", lambda i: i, i) for i in range(3)]
+                
+                # The queued callables of 'slow' do not take the second thread of the pool
+                self.assertEqual([0, 1, 2], [f.result(timeout=5) for f in fast])
+                self.assertFalse(any(f.done() for f in blocked))
+            finally:
+                release.set()
+        
+        self.assertEqual([True] * 3, [f.result() for f in blocked])
+    
+    
+    def test_per_key_limit(self):
+        running = {"current": 0, "max": 0}
+        gl = FakeGradeLink(1, running=running)
+        with KeyedExecutor(workers=8, per_key=3) as executor:
+            futures = [executor.submit(1, gl.send_back, 1) for _ in range(9)]
+        
+        self.assertTrue(all(f.result() for f in futures))
+        self.assertEqual(3, running["max"])
+    
+    
+    def test_exception(self):
+        with KeyedExecutor(workers=1, per_key=1) as executor:
+            failing = executor.submit(1, int, "a")
+            following = executor.submit(1, int, "2")
+        
+        self.assertIsInstance(failing.exception(), ValueError)
+        self.assertEqual(2, following.result())
+
+
+
+class GradeDispatcherTestCase(TestCase):
+    
+    def setUp(self):
+        circuit_breaker.reset()
+    
+    
+    def test_join(self):
+        links = [FakeGradeLink(1, success=bool(i % 2)) for i in range(10)]
+        with GradeDispatcher(workers=4, per_lms=4) as dispatcher:
+            for i, gl in enumerate(links):
+                dispatcher.submit(gl, i)
+            dispatcher.skip(3)
+        
+        self.assertEqual(5, dispatcher.report.sent)
+        self.assertEqual(3, dispatcher.report.skipped)
+        self.assertEqual(5, dispatcher.report.failed)
+        self.assertEqual(10, len(dispatcher.report.latencies))
+        self.assertEqual([None, 1, None, 3, None, 5, None, 7, None, 9],
+                         [getattr(gl, "last_score", None) for gl in links])
+        self.assertEqual([(0, True), None, (2, True), None, (4, True), None, (6, True), None,
+                          (8, True), None],
+                         [getattr(gl, "deferred", None) for gl in links])
+    
+    
+    def test_exception_counted_as_failure(self):
+        with GradeDispatcher(workers=2, per_lms=2) as dispatcher:
+            dispatcher.submit(FakeGradeLink(1, success=ValueError()), 1)
+            dispatcher.submit(FakeGradeLink(1), 1)
+        
+        self.assertEqual(1, dispatcher.report.sent)
+        self.assertEqual(1, dispatcher.report.failed)
+    
+    
+    def test_concurrency(self):
+        running = {"current": 0, "max": 0}
+        with GradeDispatcher(workers=8, per_lms=8) as dispatcher:
+            for i in range(16):
+                dispatcher.submit(FakeGradeLink(i, running=running), 1)
+        
+        self.assertEqual(16, dispatcher.report.sent)
+        self.assertLessEqual(running["max"], 8)
+        self.assertGreater(running["max"], 1)
+    
+    
+    def test_per_lms_limit(self):
+        running = {"current": 0, "max": 0}
+        with GradeDispatcher(workers=8, per_lms=2) as dispatcher:
+            for _ in range(12):
+                dispatcher.submit(FakeGradeLink(1, running=running), 1)
+        
+        self.assertEqual(12, dispatcher.report.sent)
+        self.assertEqual(2, running["max"])
+    
+    
+    def test_other_lms_not_blocked(self):
+        release = threading.Event()
+        slow = FakeGradeLink(1)
+        slow.send_back = lambda grade: release.wait(5)
+        with GradeDispatcher(workers=2, per_lms=1) as dispatcher:
+            try:
+                for _ in range(3):
+                    dispatcher.submit(slow, 1)
+                success, _ = dispatcher.submit(FakeGradeLink(2), 1).result(timeout=5)
+                self.assertTrue(success)
+            finally:
+                release.set()
+        
+        self.assertEqual(4, dispatcher.report.sent)
+    
+    
+    def test_circuit_opened(self):
+        breaker = CircuitBreaker(threshold=2, cooldown=60)
+        with GradeDispatcher(workers=1, per_lms=1, breaker=breaker) as dispatcher:
+            for _ in range(2):
+                dispatcher.submit(FakeGradeLink(1, success=False), 1)
+        self.assertEqual(2, dispatcher.report.failed)
+        
+        links = [FakeGradeLink(1), FakeGradeLink(1), FakeGradeLink(2)]
+        with GradeDispatcher(workers=1, per_lms=1, breaker=breaker) as dispatcher:
+            for gl in links:
+                dispatcher.submit(gl, 0.5)
+        
+        self.assertEqual(1, dispatcher.report.sent)
+        self.assertEqual(2, dispatcher.report.deferred)
+        self.assertEqual(0, dispatcher.report.failed)
+        self.assertEqual([(0.5, False), (0.5, False), None],
+                         [getattr(gl, "deferred", None) for gl in links])
@@ -10,62 +10,93 @@ from unittest import mock
 
 from django.test import TestCase
 
+from lti_app import enums
 from lti_app.enums import Role
 
 
 
 class RoleTestCase(TestCase):
     
+    def setUp(self):
+        enums._parse_role_lti.cache_clear()
+        enums._unknown_roles.clear()
+    
+    
     def test_parse_role_lti_label(self):
-        self.assertEqual([Role.STUDENT], Role.parse_role_lti("Student"))
-        self.assertEqual([Role.STUDENT, Role.ALUMNI], Role.parse_role_lti("Student, Alumni"))
-        self.assertEqual([Role.STUDENT, Role.ALUMNI], Role.parse_role_lti("Student ,Alumni"))
-        self.assertEqual([Role.STUDENT, Role.ALUMNI], Role.parse_role_lti("Student,Alumni"))
-        self.assertEqual([Role.STUDENT, Role.ALUMNI], Role.parse_role_lti(" Student , Alumni "))
+        self.assertEqual({Role.STUDENT}, Role.parse_role_lti("Student"))
+        self.assertEqual({Role.STUDENT, Role.ALUMNI}, Role.parse_role_lti("Student, Alumni"))
+        self.assertEqual({Role.STUDENT, Role.ALUMNI}, Role.parse_role_lti("Student ,Alumni"))
+        self.assertEqual({Role.STUDENT, Role.ALUMNI}, Role.parse_role_lti("Student,Alumni"))
+        self.assertEqual({Role.STUDENT, Role.ALUMNI}, Role.parse_role_lti(" Student , Alumni "))
     
     
     def test_parse_role_lti_URN(self):
-        self.assertEqual([Role.STUDENT], Role.parse_role_lti("urn:lti:instrole:ims/lis/Student"))
-        self.assertEqual([Role.STUDENT, Role.ALUMNI],
+        self.assertEqual({Role.STUDENT}, Role.parse_role_lti("urn:lti:instrole:ims/lis/Student"))
+        self.assertEqual({Role.STUDENT, Role.ALUMNI},
                          Role.parse_role_lti("urn:lti:instrole:ims/lis/Student, "
                                              "urn:lti:instrole:ims/lis/Alumni"))
-        self.assertEqual([Role.STUDENT, Role.ALUMNI],
+        self.assertEqual({Role.STUDENT, Role.ALUMNI},
                          Role.parse_role_lti("urn:lti:instrole:ims/lis/Student ,"
                                              "urn:lti:instrole:ims/lis/Alumni"))
-        self.assertEqual([Role.STUDENT, Role.ALUMNI],
+        self.assertEqual({Role.STUDENT, Role.ALUMNI},
                          Role.parse_role_lti("urn:lti:instrole:ims/lis/Student,"
                                              "urn:lti:instrole:ims/lis/Alumni"))
-        self.assertEqual([Role.STUDENT, Role.ALUMNI],
+        self.assertEqual({Role.STUDENT, Role.ALUMNI},
                          Role.parse_role_lti(" urn:lti:instrole:ims/lis/Student , "
                                              "urn:lti:instrole:ims/lis/Alumni "))
     
     
     def test_parse_role_lti_label_URN(self):
-        self.assertEqual([Role.STUDENT, Role.ALUMNI],
+        self.assertEqual({Role.STUDENT, Role.ALUMNI},
                          Role.parse_role_lti("urn:lti:instrole:ims/lis/Student, "
                                              "Alumni"))
-        self.assertEqual([Role.STUDENT, Role.ALUMNI],
+        self.assertEqual({Role.STUDENT, Role.ALUMNI},
                          Role.parse_role_lti("urn:lti:instrole:ims/lis/Student ,"
                                              "Alumni"))
-        self.assertEqual([Role.STUDENT, Role.ALUMNI],
+        self.assertEqual({Role.STUDENT, Role.ALUMNI},
                          Role.parse_role_lti("urn:lti:instrole:ims/lis/Student,"
                                              "Alumni"))
-        self.assertEqual([Role.STUDENT, Role.ALUMNI],
+        self.assertEqual({Role.STUDENT, Role.ALUMNI},
                          Role.parse_role_lti(" urn:lti:instrole:ims/lis/Student , "
                                              "Alumni "))
     
     
     @mock.patch("lti_app.enums.logger")
     def test_parse_role_unkown_one(self, logger):
-        self.assertEqual([], Role.parse_role_lti("Unknown"))
+        self.assertEqual(frozenset(), Role.parse_role_lti("Unknown"))
         logger.warning.assert_called_with("Received unknown LTI role: 'Unknown'")
     
     
     @mock.patch("lti_app.enums.logger")
     def test_parse_role_unkown_multiple(self, logger):
-        self.assertEqual([Role.STUDENT, Role.ALUMNI],
+        self.assertEqual({Role.STUDENT, Role.ALUMNI},
                          Role.parse_role_lti("Student, Unknown1, Unknown2, Alumni"))
         logger.warning.assert_has_calls([
             mock.call("Received unknown LTI role: 'Unknown1'"),
             mock.call("Received unknown LTI role: 'Unknown2'"),
         ])
+    
+    
+    def test_parse_role_lti_frozenset(self):
+        roles = Role.parse_role_lti("Instructor,urn:lti:sysrole:ims/lis/Administrator")
+        self.assertIsInstance(roles, frozenset)
+        self.assertEqual({Role.INSTRUCTOR, Role.ADMINISTRATOR}, roles)
+        self.assertEqual(frozenset(), Role.parse_role_lti(""))
+    
+    
+    def test_parse_role_lti_cached(self):
+        roles = Role.parse_role_lti("Instructor,urn:lti:sysrole:ims/lis/Administrator")
+        self.assertIs(roles, Role.parse_role_lti("Instructor,urn:lti:sysrole:ims/lis/Administrator"))
+        self.assertEqual(1, enums._parse_role_lti.cache_info().hits)
+    
+    
+    @mock.patch("lti_app.enums.logger")
+    def test_parse_role_unkown_rate_limited(self, logger):
+        Role.parse_role_lti("Student, Unknown")
+        Role.parse_role_lti("Unknown, Alumni")
+        Role.parse_role_lti("Unknown")
+        logger.warning.assert_called_once_with("Received unknown LTI role: 'Unknown'")
+        
+        enums._unknown_roles["Unknown"] -= enums.UNKNOWN_ROLE_WARNING_INTERVAL
+        Role.parse_role_lti("Unknown, Student")
+        self.assertEqual(2, logger.warning.call_count)
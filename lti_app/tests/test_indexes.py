@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+#
+#  test_indexes.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+import re
+import unittest
+
+from django.db import connection
+from django.test import TestCase
+
+from lti_app.models import (GradeLinkExam, GradeLinkSheet, LMS, WIMS, WimsClass, WimsExam,
+                            WimsSheet, WimsUser)
+
+
+
+@unittest.skipUnless(connection.vendor == "sqlite", "Query plans are checked on SQLite")
+class QueryPlanTestCase(TestCase):
+    """Checks that the queries run at each launch are served by an index instead of scanning
+    their table."""
+    
+    @classmethod
+    def setUpTestData(cls):
+        cls.lms = LMS.objects.create(guid="elearning.upem.fr", url="https://elearning.u-pem.fr/",
+                                     name="LMS", key="provider1", secret="secret1")
+        cls.wims = WIMS.objects.create(url="https://wims.fr/wims/wims.cgi", name="WIMS",
+                                       ident="myself", passwd="toto", rclass="myclass")
+        cls.wclass = WimsClass.objects.create(lms=cls.lms, lms_guid="1", wims=cls.wims,
+                                              qclass="1", name="class")
+        cls.user = WimsUser.objects.create(lms_guid="1", wclass=cls.wclass, quser="user")
+        cls.sheet = WimsSheet.objects.create(wclass=cls.wclass, lms_guid="1", qsheet="1")
+        cls.exam = WimsExam.objects.create(wclass=cls.wclass, lms_guid="1", qexam="1")
+    
+    
+    def assertUsesIndex(self, queryset, *columns):
+        """Assert that <queryset> searches an index on every column of <columns>."""
+        plan = queryset.explain()
+        self.assertIsNone(re.search(r"\bSCAN\b", plan), plan)
+        for column in columns:
+            self.assertIn("%s=?" % column, plan)
+    
+    
+    def test_lms(self):
+        self.assertUsesIndex(LMS.objects.filter(guid="elearning.upem.fr"), "guid")
+        self.assertUsesIndex(LMS.objects.filter(key="provider1"), "key")
+    
+    
+    def test_wims_class(self):
+        self.assertUsesIndex(
+            WimsClass.objects.filter(wims=self.wims, lms=self.lms, lms_guid="1"),
+            "wims_id", "lms_id", "lms_guid"
+        )
+        self.assertUsesIndex(WimsClass.objects.filter(wims=self.wims, qclass="1"), "wims_id",
+                             "qclass")
+    
+    
+    def test_wims_user(self):
+        self.assertUsesIndex(WimsUser.objects.filter(wclass=self.wclass, lms_guid="1"),
+                             "wclass_id", "lms_guid")
+        self.assertUsesIndex(WimsUser.objects.filter(wclass=self.wclass, lms_guid=None),
+                             "wclass_id", "lms_guid")
+        self.assertUsesIndex(WimsUser.objects.filter(wclass=self.wclass, quser="user"),
+                             "wclass_id", "quser")
+    
+    
+    def test_activities(self):
+        self.assertUsesIndex(WimsSheet.objects.filter(wclass=self.wclass, qsheet="1"),
+                             "wclass_id", "qsheet")
+        self.assertUsesIndex(WimsExam.objects.filter(wclass=self.wclass, qexam="1"),
+                             "wclass_id", "qexam")
+    
+    
+    def test_grade_links(self):
+        for model, activity in ((GradeLinkSheet, self.sheet), (GradeLinkExam, self.exam)):
+            self.assertUsesIndex(model.objects.filter(user=self.user, activity=activity),
+                                 "user_id", "activity_id")
+            self.assertUsesIndex(model.objects.filter(activity=activity), "activity_id")
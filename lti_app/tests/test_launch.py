@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+#
+#  test_launch.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+import threading
+from io import StringIO
+from unittest import mock
+
+import wimsapi
+from django.core.management import CommandError, call_command
+from django.shortcuts import reverse
+from django.test import RequestFactory, TestCase, override_settings
+
+from lti_app import launch
+from lti_app.models import (GradeLinkExam, GradeLinkSheet, LMS, WIMS, WimsClass, WimsExam,
+                            WimsSheet, WimsUser)
+from lti_app.tests.test_metrics import LAUNCH
+
+
+
+class LaunchTestCase(TestCase):
+    
+    def setUp(self):
+        self.wims = WIMS.objects.create(url="https://wims.u-pem.fr/", name="WIMS UPEM",
+                                        ident="X", passwd="X", rclass="myclass")
+        self.lms = LMS.objects.create(guid="elearning.upem.fr", url="https://elearning.u-pem.fr/",
+                                      name="Moodle UPEM", key="provider1", secret="secret1")
+        self.wclass_db = WimsClass.objects.create(lms=self.lms, lms_guid="77777", wims=self.wims,
+                                                  qclass="1", name="test1")
+        WimsUser.objects.create(lms_guid="77", wclass=self.wclass_db, quser="jdoe")
+        
+        # Set once the user is retrieved, getitem() waits on it for <timeout> seconds
+        self.user_fetched = threading.Event()
+        self.timeout = 5
+        self.calls = []
+        
+        self.wclass = mock.Mock(qclass="1", rclass="myclass", lang="fr")
+        self.wclass.getitem.side_effect = self.getitem
+        self.item = mock.Mock(sheetmode="1", exammode="1", qsheet="2", qexam="2")
+        
+        patchers = [
+            mock.patch("lti_app.launch.is_valid_request"),
+            mock.patch("lti_app.launch.cache.check_server"),
+            mock.patch("lti_app.launch.cache.get_class", return_value=self.wclass),
+            mock.patch("wimsapi.User.get", side_effect=self.wait),
+            mock.patch("wimsapi.WimsAPI.authuser",
+                       return_value=(True, {"home_url": "https://wims.u-pem.fr/?session=X"})),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.get_class = launch.cache.get_class
+    
+    
+    def wait(self, *args, **kwargs):
+        self.calls.append("user")
+        self.user_fetched.set()
+        return mock.Mock(quser="jdoe")
+    
+    
+    def getitem(self, *args, **kwargs):
+        self.calls.append(("item", self.user_fetched.wait(self.timeout)))
+        return self.item
+    
+    
+    def request(self):
+        return RequestFactory().post(reverse("lti:wims_class", args=[self.wims.pk]), LAUNCH)
+    
+    
+    def test_sheet(self):
+        response = launch.launch(self.request(), self.wims.pk, launch.SHEET, 2)
+        
+        self.assertEqual(302, response.status_code)
+        self.assertEqual("https://wims.u-pem.fr/?session=X&lang=fr&module=adm%2Fsheet&sh=2",
+                         response.url)
+        self.wclass.getitem.assert_called_once_with(2, wimsapi.Sheet)
+        sheet_db = WimsSheet.objects.get(wclass=self.wclass_db, qsheet="2")
+        self.assertEqual("14821455", GradeLinkSheet.objects.get(activity=sheet_db).sourcedid)
+    
+    
+    def test_exam(self):
+        response = launch.launch(self.request(), self.wims.pk, launch.EXAM, 2)
+        
+        self.assertEqual(302, response.status_code)
+        self.assertIn("&+exam=2", response.url)
+        exam_db = WimsExam.objects.get(wclass=self.wclass_db, qexam="2")
+        self.assertTrue(GradeLinkExam.objects.filter(activity=exam_db).exists())
+    
+    
+    def test_class(self):
+        response = launch.launch(self.request(), self.wims.pk)
+        
+        self.assertEqual(302, response.status_code)
+        self.assertEqual("https://wims.u-pem.fr/?session=X&lang=fr", response.url)
+        self.wclass.getitem.assert_not_called()
+    
+    
+    def test_unavailable(self):
+        self.item.sheetmode = "0"
+        
+        response = launch.launch(self.request(), self.wims.pk, launch.SHEET, 2)
+        
+        self.assertContains(response, "This WIMS sheet (2) is currently unavailable (pending)",
+                            status_code=403)
+        self.assertFalse(GradeLinkSheet.objects.exists())
+    
+    
+    def test_class_deleted(self):
+        self.get_class.side_effect = wimsapi.WimsAPIError("class 1 not existing")
+        
+        response = launch.launch(self.request(), self.wims.pk, launch.SHEET, 2)
+        
+        self.assertEqual(404, response.status_code)
+        self.assertFalse(WimsClass.objects.exists())
+    
+    
+    def test_item_error(self):
+        self.wclass.getitem.side_effect = wimsapi.WimsAPIError("sheet 2 not existing")
+        
+        response = launch.launch(self.request(), self.wims.pk, launch.SHEET, 2)
+        
+        self.assertContains(response, "sheet 2 not existing", status_code=502)
+    
+    
+    @override_settings(LAUNCH_CONCURRENT=True)
+    def test_concurrent(self):
+        """The sheet is retrieved while the user is: the sheet request is still pending when the
+        user is retrieved."""
+        response = launch.launch(self.request(), self.wims.pk, launch.SHEET, 2)
+        
+        self.assertEqual(302, response.status_code)
+        self.assertEqual(["user", ("item", True)], self.calls)
+    
+    
+    @override_settings(LAUNCH_CONCURRENT=False)
+    def test_sequential(self):
+        self.timeout = 0
+        
+        response = launch.launch(self.request(), self.wims.pk, launch.SHEET, 2)
+        
+        self.assertEqual(302, response.status_code)
+        self.assertEqual([("item", False), "user"], self.calls)
+    
+    
+    def test_benchmark_command(self):
+        self.timeout = 0
+        lms = LMS.objects.create(guid="load-test", url="https://lms.invalid/", name="Load test",
+                                 key="key", secret="secret")
+        WimsClass.objects.create(lms=lms, lms_guid="load-test", wims=self.wims, qclass="2",
+                                 name="load test")
+        url = "http://testserver" + reverse("lti:wims_sheet", args=[self.wims.pk, 2])
+        out = StringIO()
+        
+        call_command("benchmark_launch", url, "--key", "key", "--secret", "secret",
+                     "--launches", "2", stdout=out)
+        
+        self.assertIn("LAUNCH_CONCURRENT=False: 2 succeeded, 0 failed", out.getvalue())
+        self.assertIn("LAUNCH_CONCURRENT=True: 2 succeeded, 0 failed", out.getvalue())
+        with self.assertRaises(CommandError):
+            call_command("benchmark_launch", "http://testserver/metrics/", "--key", "key",
+                         "--secret", "secret")
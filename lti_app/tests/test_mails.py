@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+#
+#  test_mails.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+import os
+import tempfile
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from lti_app.mails import MailTemplates
+
+
+
+class MailTemplatesTestCase(SimpleTestCase):
+    
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.root.cleanup)
+        self.write("en", "Class {name}\n", "Password: {class_password}")
+        self.write("fr", "Classe {name}\n", "Mot de passe : {class_password}")
+    
+    
+    def write(self, lang, title, body):
+        os.makedirs(os.path.join(self.root.name, lang))
+        with open(os.path.join(self.root.name, lang, "title.txt"), "w") as f:
+            f.write(title)
+        with open(os.path.join(self.root.name, lang, "body.txt"), "w") as f:
+            f.write(body)
+    
+    
+    def test_render(self):
+        templates = MailTemplates(self.root.name)
+        params = {"name": "A", "class_password": "pwd"}
+        self.assertEqual(("Classe A", "Mot de passe : pwd"), templates.render("fr", params))
+        self.assertEqual(("Class A", "Password: pwd"), templates.render("en", params))
+        self.assertEqual(("Class A", "Password: pwd"), templates.render("it", params))
+    
+    
+    def test_loaded_once(self):
+        templates = MailTemplates(self.root.name)
+        templates.load()
+        with mock.patch("builtins.open") as open_:
+            templates.render("fr", {"name": "A", "class_password": "pwd"})
+        open_.assert_not_called()
+    
+    
+    def test_malformed(self):
+        self.write("it", "Classe {name\n", "")
+        with self.assertRaises(ValueError):
+            MailTemplates(self.root.name).load()
+    
+    
+    def test_default_root(self):
+        templates = MailTemplates()
+        templates.load()
+        title, body = templates.render("fr", {
+            "qclass": "1", "name": "A", "institution": "I", "email": "e", "class_password": "p",
+            "supervisor_password": "s", "expiration": "e", "limit": 1, "level": "H4",
+            "lms_url": "https://lms.fr", "wims_url": "https://wims.fr",
+        })
+        self.assertIn("A", title)
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+#
+#  test_metrics.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+from unittest import mock
+
+import requests
+from django.http import HttpResponse
+from django.shortcuts import reverse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+
+from lti_app import metrics, views
+from lti_app.models import LMS, WIMS
+
+
+LAUNCH = {
+    'lti_message_type':                   'basic-lti-launch-request',
+    'lti_version':                        'LTI-1p0',
+    'launch_presentation_locale':         'fr-FR',
+    'resource_link_id':                   'X',
+    'context_id':                         '77777',
+    'context_title':                      "A title",
+    'user_id':                            '77',
+    'lis_result_sourcedid':               "14821455",
+    'lis_outcome_service_url':            "http://www.outcom.com",
+    'lis_person_contact_email_primary':   'test@email.com',
+    'lis_person_name_family':             'Doe',
+    'lis_person_name_given':              'Jhon',
+    'tool_consumer_instance_description': "UPEM",
+    'tool_consumer_instance_guid':        "elearning.upem.fr",
+    'oauth_consumer_key':                 "provider1",
+    'oauth_signature_method':             "HMAC-SHA1",
+    'oauth_timestamp':                    "0",
+    'oauth_nonce':                        "nonce",
+    'oauth_signature':                    "signature",
+    'roles':                              "Learner",
+}
+
+
+
+class HistogramTestCase(SimpleTestCase):
+    
+    def test_render(self):
+        histogram = metrics.Histogram("test_seconds", "Test.", ["stage"], [0.1, 1])
+        histogram.observe(0.05, stage="a")
+        histogram.observe(0.1, stage="a")
+        histogram.observe(0.5, stage="a")
+        histogram.observe(5, stage='b"')
+        
+        lines = histogram.render().splitlines()
+        self.assertEqual("# TYPE test_seconds histogram", lines[1])
+        self.assertIn('test_seconds_bucket{stage="a",le="0.1"} 2', lines)
+        self.assertIn('test_seconds_bucket{stage="a",le="1"} 3', lines)
+        self.assertIn('test_seconds_bucket{stage="a",le="+Inf"} 3', lines)
+        self.assertIn('test_seconds_sum{stage="a"} 0.65', lines)
+        self.assertIn('test_seconds_count{stage="a"} 3', lines)
+        self.assertIn('test_seconds_bucket{stage="b\\"",le="1"} 0', lines)
+        self.assertIn('test_seconds_count{stage="b\\""} 1', lines)
+        
+        histogram.clear()
+        self.assertEqual(2, len(histogram.render().splitlines()))
+
+
+
+class TimingTestCase(SimpleTestCase):
+    
+    def setUp(self):
+        metrics.launch_stages.clear()
+        self.addCleanup(metrics.launch_stages.clear)
+    
+    
+    @override_settings(METRICS_ENABLED=True)
+    @mock.patch("lti_app.metrics.time.perf_counter", side_effect=[0, 0.01, 0.03, 0.04, 0.1])
+    def test_timing(self, _):
+        timing = metrics.Timing("wims_class")
+        timing.lap("oauth")
+        timing.label(wims="WIMS", lms="moodle")
+        timing.lap("user")
+        timing.lap("user")
+        response = HttpResponse()
+        timing.finish(response)
+        
+        self.assertEqual("oauth;dur=10.0, user;dur=30.0, total;dur=100.0",
+                         response["Server-Timing"])
+        rendered = metrics.render()
+        self.assertIn(
+            'wimslti_launch_stage_seconds_count{view="wims_class",stage="user",wims="WIMS",'
+            'lms="moodle"} 1',
+            rendered
+        )
+    
+    
+    @override_settings(SERVER_TIMING_HEADER=False, METRICS_ENABLED=False)
+    def test_disabled(self):
+        timing = metrics.Timing("wims_class")
+        response = HttpResponse()
+        timing.finish(response)
+        
+        self.assertFalse(response.has_header("Server-Timing"))
+        self.assertNotIn("_count", metrics.render())
+
+
+
+@override_settings(METRICS_ENABLED=True)
+class LaunchTimingTestCase(TestCase):
+    
+    def setUp(self):
+        metrics.launch_stages.clear()
+        self.addCleanup(metrics.launch_stages.clear)
+    
+    
+    def test_bad_request(self):
+        response = self.client.post(reverse("lti:wims_class", args=[1]), {})
+        self.assertEqual(400, response.status_code)
+        self.assertIn("total;dur=", response["Server-Timing"])
+        self.assertNotIn("oauth", response["Server-Timing"])
+    
+    
+    @mock.patch("lti_app.launch.cache.check_server", side_effect=requests.ConnectionError)
+    @mock.patch("lti_app.launch.is_valid_request")
+    def test_stages(self, is_valid_request, check_server):
+        wims = WIMS.objects.create(url="https://can.not.join.fr/", name="WIMS UPEM",
+                                   ident="X", passwd="X", rclass="myclass")
+        LMS.objects.create(guid="elearning.upem.fr", url="https://elearning.u-pem.fr/",
+                           name="Moodle UPEM", key="provider1", secret="secret1")
+        request = RequestFactory().post(reverse("lti:wims_class", args=[wims.pk]), LAUNCH)
+        
+        response = views.wims_class(request, wims.pk)
+        
+        self.assertEqual(504, response.status_code)
+        stages = [s.split(";")[0] for s in response["Server-Timing"].split(", ")]
+        self.assertEqual(["oauth", "lookup", "total"], stages)
+        self.assertIn('stage="lookup",wims="WIMS UPEM",lms="elearning.upem.fr"',
+                      metrics.render())
+
+
+
+class MetricsViewTestCase(SimpleTestCase):
+    
+    @override_settings(METRICS_ENABLED=True, METRICS_ALLOWED_IPS=["10.0.0.2"])
+    def test_metrics(self):
+        response = self.client.get(reverse("lti:metrics"), REMOTE_ADDR="10.0.0.2")
+        self.assertContains(response, "# TYPE wimslti_launch_stage_seconds histogram")
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+    
+    
+    @override_settings(METRICS_ENABLED=True, METRICS_ALLOWED_IPS=["10.0.0.2"])
+    def test_metrics_forbidden(self):
+        # E.g. a request forwarded by a reverse proxy on the same host
+        response = self.client.get(reverse("lti:metrics"), REMOTE_ADDR="127.0.0.1")
+        self.assertEqual(403, response.status_code)
+    
+    
+    def test_metrics_disabled(self):
+        response = self.client.get(reverse("lti:metrics"), REMOTE_ADDR="127.0.0.1")
+        self.assertEqual(404, response.status_code)
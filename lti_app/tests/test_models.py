@@ -5,8 +5,16 @@
 #  Authors:
 #       - Coumes Quentin <coumes.quentin@gmail.com>
 
-from lti_app.models import GradeLinkExam, GradeLinkSheet
+from unittest import mock
+
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from wimsapi import AdmRawError
+
+from lti_app.models import (GradeLinkExam, GradeLinkSheet, GradeOutbox, LMS, WIMS, WimsClass,
+                            WimsExam, WimsSheet, WimsUser)
 from lti_app.tests.utils import BaseGradeLinksViewTestCase
+from lti_app.utils import upsert_activity
 
 
 
@@ -75,3 +83,257 @@ class GradeLinkExamTestCase(BaseGradeLinksViewTestCase):
         GradeLinkExam.objects.create(user=self.user, sourcedid="1", url=self.url_ok,
                                      lms=self.lms1, activity=self.wexam1)
         self.assertEqual(1, GradeLinkExam.send_back_all(self.wexam1))
+
+
+
+class ScoresTestCase(TestCase):
+    
+    def test_sheet_scores(self):
+        wclass = mock.MagicMock()
+        wclass._api.getsheetscores.return_value = (True, {
+            "sheet_formula": {"formula": "I*Q^0.3", "I": "1"},
+            "data_scores":   [
+                {"id": "jdoe", "user_quality": 10, "user_percent": 100, "user_best": 100,
+                 "user_level": 10},
+                {"id": "jdoe1", "user_quality": 0, "user_percent": 0, "user_best": 0,
+                 "user_level": 0},
+            ]
+        })
+        self.assertEqual([("jdoe", 1.0), ("jdoe1", 0.0)], GradeLinkSheet.scores(wclass, "1"))
+        wclass._api.getsheetscores.assert_called_once_with(
+            wclass.qclass, wclass.rclass, "1", verbose=True
+        )
+    
+    
+    def test_sheet_scores_no_formula(self):
+        wclass = mock.MagicMock()
+        wclass._api.getsheetscores.return_value = (True, {
+            "data_scores": [
+                {"id": "jdoe", "user_quality": 10, "user_percent": 100, "user_best": 50,
+                 "user_level": 10},
+            ]
+        })
+        self.assertEqual([("jdoe", 0.5)], GradeLinkSheet.scores(wclass, "1"))
+    
+    
+    def test_sheet_scores_error(self):
+        wclass = mock.MagicMock()
+        wclass._api.getsheetscores.return_value = (False, {"message": "error"})
+        with self.assertRaisesMessage(AdmRawError, "error"):
+            GradeLinkSheet.scores(wclass, "1")
+    
+    
+    def test_exam_scores(self):
+        wclass = mock.MagicMock()
+        wclass._api.getexamscores.return_value = (True, {
+            "data_scores": [
+                {"id": "jdoe", "score": 10, "attempts": 1},
+                {"id": "jdoe1", "score": 2.5, "attempts": 1},
+            ]
+        })
+        self.assertEqual([("jdoe", 1.0), ("jdoe1", 0.25)], GradeLinkExam.scores(wclass, "1"))
+    
+    
+    def test_exam_scores_error(self):
+        wclass = mock.MagicMock()
+        wclass._api.getexamscores.return_value = (False, {"message": "error"})
+        with self.assertRaisesMessage(AdmRawError, "error"):
+            GradeLinkExam.scores(wclass, "1")
+
+
+
+
+class SheetLinksTestCase(TestCase):
+    """Create a sheet, create_users() adding users with a GradeLinkSheet to it."""
+    
+    def setUp(self):
+        self.lms = LMS.objects.create(guid="elearning.upem.fr", url="https://elearning.u-pem.fr/",
+                                      name="LMS", key="provider1", secret="secret1")
+        self.wims = WIMS.objects.create(url="https://wims.fr/wims/wims.cgi", name="WIMS",
+                                        ident="myself", passwd="toto", rclass="myclass")
+        self.wclass_db = WimsClass.objects.create(lms=self.lms, lms_guid="1", wims=self.wims,
+                                                  qclass="1", name="class")
+        self.sheet = WimsSheet.objects.create(wclass=self.wclass_db, lms_guid="1", qsheet="1")
+    
+    
+    def create_users(self, count):
+        data = []
+        for i in range(count):
+            user = WimsUser.objects.create(lms_guid=str(i), wclass=self.wclass_db,
+                                           quser="user%d" % i)
+            GradeLinkSheet.objects.create(user=user, activity=self.sheet, lms=self.lms,
+                                          sourcedid=str(i), url="https://lms.fr/outcome")
+            data.append({"id": user.quser, "user_quality": 10, "user_percent": 100,
+                         "user_best": 100, "user_level": 10})
+        data.append({"id": "unknown", "user_quality": 10, "user_percent": 100, "user_best": 100,
+                     "user_level": 10})
+        
+        wclass = mock.MagicMock()
+        wclass._api.getsheetscores.return_value = (True, {
+            "sheet_formula": {"formula": "I*Q^0.3", "I": "1"},
+            "data_scores":   data,
+        })
+        return wclass
+
+
+
+class UpsertTestCase(SheetLinksTestCase):
+    """Checks that launching through an unchanged link or activity does not write."""
+    
+    def setUp(self):
+        super().setUp()
+        self.user = WimsUser.objects.create(lms_guid="1", wclass=self.wclass_db, quser="user")
+    
+    
+    def test_link_created(self):
+        gl = GradeLinkSheet.upsert(self.user, self.sheet, self.lms, "1", "https://lms.fr/outcome")
+        self.assertEqual(gl, GradeLinkSheet.objects.get(user=self.user, activity=self.sheet))
+        self.assertEqual("https://lms.fr/outcome", gl.url)
+    
+    
+    def test_link_unchanged(self):
+        GradeLinkSheet.objects.create(user=self.user, activity=self.sheet, lms=self.lms,
+                                      sourcedid="1", url="https://lms.fr/outcome", last_score=1)
+        
+        with self.assertNumQueries(1):
+            GradeLinkSheet.upsert(self.user, self.sheet, self.lms, "1", "https://lms.fr/outcome")
+        self.assertEqual(1, GradeLinkSheet.objects.get().last_score)
+    
+    
+    def test_link_changed(self):
+        GradeLinkSheet.objects.create(user=self.user, activity=self.sheet, lms=self.lms,
+                                      sourcedid="1", url="https://lms.fr/outcome", last_score=1)
+        
+        with self.assertNumQueries(2):
+            gl = GradeLinkSheet.upsert(self.user, self.sheet, self.lms, "2",
+                                       "https://lms.fr/outcome")
+        self.assertIsNone(gl.last_score)
+        gl = GradeLinkSheet.objects.get()
+        self.assertEqual(("2", None), (gl.sourcedid, gl.last_score))
+    
+    
+    def test_activity(self):
+        with self.assertNumQueries(1):
+            sheet = upsert_activity(WimsSheet, self.wclass_db, "qsheet", "1", "1")
+        self.assertEqual(self.sheet, sheet)
+        
+        with self.assertNumQueries(2):
+            upsert_activity(WimsSheet, self.wclass_db, "qsheet", "1", "2")
+        self.assertEqual("2", WimsSheet.objects.get(pk=self.sheet.pk).lms_guid)
+        
+        exam = upsert_activity(WimsExam, self.wclass_db, "qexam", "1", "3")
+        self.assertEqual(("1", "3"), (exam.qexam, exam.lms_guid))
+
+
+
+class SendBackAllQueriesTestCase(SheetLinksTestCase):
+    """Checks that the number of queries needed to send every grade of an activity does not
+    depend on the number of users."""
+    
+    def test_links(self):
+        self.create_users(3)
+        with self.assertNumQueries(1):
+            links = GradeLinkSheet.links(self.sheet)
+        
+        self.assertEqual({"user0", "user1", "user2"}, set(links))
+        with self.assertNumQueries(0):
+            for quser, gl in links.items():
+                self.assertEqual(quser, gl.user.quser)
+                self.assertEqual("provider1", gl.lms.key)
+                self.assertEqual("1", gl.activity.wclass.qclass)
+    
+    
+    def test_send_back_all_queries(self):
+        for count in (5, 50):
+            with self.subTest(count=count):
+                GradeLinkSheet.objects.all().delete()
+                WimsUser.objects.all().delete()
+                wclass = self.create_users(count)
+                dispatcher = mock.MagicMock()
+                
+                with self.assertNumQueries(1):
+                    queued = GradeLinkSheet.send_back_all(self.sheet, dispatcher, wclass)
+                
+                self.assertEqual(count, queued)
+                self.assertEqual(count, dispatcher.submit.call_count)
+    
+    
+    def test_send_back_all_skip_unchanged(self):
+        wclass = self.create_users(4)
+        GradeLinkSheet.objects.filter(user__quser__in=["user0", "user1"]).update(last_score=1.0)
+        GradeLinkSheet.objects.filter(user__quser="user2").update(last_score=0.5)
+        
+        dispatcher = mock.MagicMock()
+        self.assertEqual(2, GradeLinkSheet.send_back_all(self.sheet, dispatcher, wclass))
+        self.assertEqual(2, dispatcher.skip.call_count)
+        
+        dispatcher = mock.MagicMock()
+        self.assertEqual(4, GradeLinkSheet.send_back_all(self.sheet, dispatcher, wclass,
+                                                         force=True))
+        dispatcher.skip.assert_not_called()
+    
+    
+    def test_mark_sent(self):
+        self.create_users(2)
+        links = GradeLinkSheet.links(self.sheet)
+        GradeLinkSheet.mark_sent([(links["user0"], 0.75)])
+        
+        gl = GradeLinkSheet.objects.get(user__quser="user0")
+        self.assertEqual(0.75, gl.last_score)
+        self.assertIsNotNone(gl.last_sent)
+        gl = GradeLinkSheet.objects.get(user__quser="user1")
+        self.assertIsNone(gl.last_score)
+        self.assertIsNone(gl.last_sent)
+
+
+
+class GradeOutboxTestCase(SheetLinksTestCase):
+    
+    def test_defer(self):
+        self.create_users(2)
+        links = GradeLinkSheet.links(self.sheet)
+        GradeLinkSheet.objects.filter(user__quser="user0").update(last_score=0.5)
+        links["user0"].last_score = 0.5
+        
+        GradeLinkSheet.defer([(links["user0"], 0.75), (links["user1"], 0.25)])
+        entry = GradeOutbox.objects.get(sheet_link=links["user0"])
+        self.assertEqual(0.75, entry.grade)
+        self.assertEqual(1, entry.attempts)
+        self.assertEqual(self.lms, entry.lms)
+        self.assertGreater(entry.next_attempt, timezone.now())
+        self.assertEqual(2, GradeOutbox.objects.count())
+        self.assertIsNone(GradeLinkSheet.objects.get(user__quser="user0").last_score)
+        
+        GradeLinkSheet.defer([(links["user0"], 1.0)])
+        GradeLinkSheet.defer([(links["user0"], 1.0)], attempted=False)
+        entry = GradeOutbox.objects.get(sheet_link=links["user0"])
+        self.assertEqual(1.0, entry.grade)
+        self.assertEqual(2, entry.attempts)
+        self.assertEqual(2, GradeOutbox.objects.count())
+    
+    
+    @override_settings(OUTBOX_MAX_ATTEMPTS=2)
+    def test_defer_drop(self):
+        self.create_users(1)
+        gl = GradeLinkSheet.links(self.sheet)["user0"]
+        GradeLinkSheet.defer([(gl, 0.5)])
+        self.assertEqual(1, GradeOutbox.objects.count())
+        GradeLinkSheet.defer([(gl, 0.5)])
+        self.assertEqual(0, GradeOutbox.objects.count())
+    
+    
+    def test_mark_sent_removes_deferred(self):
+        self.create_users(2)
+        links = GradeLinkSheet.links(self.sheet)
+        GradeLinkSheet.defer([(links["user0"], 0.75), (links["user1"], 0.25)])
+        GradeLinkSheet.mark_sent([(links["user0"], 0.5)])
+        self.assertEqual([links["user1"]], [e.link for e in GradeOutbox.objects.all()])
+    
+    
+    @override_settings(OUTBOX_BACKOFF=10, OUTBOX_BACKOFF_MAX=100)
+    def test_backoff(self):
+        for attempts, delay in ((0, 10), (1, 10), (2, 20), (4, 80), (5, 100), (30, 100)):
+            with self.subTest(attempts=attempts):
+                seconds = GradeOutbox.backoff(attempts).total_seconds()
+                self.assertGreaterEqual(seconds, delay / 2)
+                self.assertLessEqual(seconds, delay)
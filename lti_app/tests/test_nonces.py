@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+#
+#  test_nonces.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+import time
+from unittest import mock
+
+from django.core.cache import caches
+from django.test import SimpleTestCase, override_settings
+
+from lti_app.nonces import CacheNonceStore, MemoryNonceStore, create_store
+from lti_app.validator import RequestValidator
+
+
+
+class MemoryNonceStoreTestCase(SimpleTestCase):
+    
+    def test_replay(self):
+        store = MemoryNonceStore(window=1800, buckets=60, max_size=1000)
+        self.assertTrue(store.add("provider1", "nonce", 1000))
+        self.assertFalse(store.add("provider1", "nonce", 1001))
+        self.assertTrue(store.add("provider2", "nonce", 1001))
+        self.assertEqual(2, len(store))
+    
+    
+    def test_expire(self):
+        store = MemoryNonceStore(window=1800, buckets=60, max_size=1000)
+        store.add("provider1", "nonce", 1000)
+        self.assertFalse(store.add("provider1", "nonce", 1000 + 1799))
+        self.assertTrue(store.add("provider1", "nonce", 1000 + 1800 + 30))
+        
+        store.add("provider1", "other", 5000)
+        self.assertTrue(store.add("provider1", "other", 50000))
+        self.assertEqual(1, len(store))
+    
+    
+    def test_bounded(self):
+        store = MemoryNonceStore(window=1800, buckets=60, max_size=100)
+        for i in range(1000):
+            self.assertTrue(store.add("provider1", str(i), 1000 + i))
+            self.assertLessEqual(len(store), 100)
+    
+    
+    def test_seen(self):
+        store = MemoryNonceStore(window=1800, buckets=60, max_size=1000)
+        self.assertFalse(store.seen("provider1", "nonce", 1000))
+        self.assertEqual(0, len(store))
+        store.add("provider1", "nonce", 1000)
+        self.assertTrue(store.seen("provider1", "nonce", 1001))
+        self.assertFalse(store.seen("provider1", "nonce", 1000 + 1800 + 30))
+    
+    
+    def test_burst(self):
+        """Checks that bursts of thousands of launches per minute are all remembered within the
+        window, and that only the oldest ones are forgotten once the store is full."""
+        store = MemoryNonceStore(window=1800, buckets=60, max_size=25_000)
+        for burst in range(10):  # 10 minutes, 10,000 launches per minute
+            now = 1000 + burst * 60
+            for i in range(10_000):
+                store.add("provider%d" % (i % 10), "%d-%d" % (burst, i), now + i / 10_000 * 60)
+            self.assertLessEqual(len(store), 25_000)
+        
+        now = 1000 + 10 * 60
+        self.assertGreaterEqual(len(store), 20_000)
+        self.assertTrue(all(store.seen("provider%d" % (i % 10), "9-%d" % i, now)
+                            for i in range(10_000)))
+        self.assertFalse(any(store.seen("provider%d" % (i % 10), "0-%d" % i, now)
+                             for i in range(10_000)))
+
+
+
+class CacheNonceStoreTestCase(SimpleTestCase):
+    
+    def test_replay(self):
+        caches["default"].clear()
+        store = CacheNonceStore(window=1800)
+        self.assertTrue(store.add("provider1", "nonce", 1000))
+        self.assertFalse(store.add("provider1", "nonce", 1001))
+        self.assertTrue(store.add("provider2", "nonce", 1001))
+        self.assertTrue(store.seen("provider1", "nonce", 1001))
+        self.assertFalse(store.seen("provider1", "other", 1001))
+    
+    
+    def test_create_store(self):
+        shared = {"default": {"BACKEND": "django.core.cache.backends.db.DatabaseCache",
+                              "LOCATION": "cache"}}
+        with override_settings(NONCE_STORE=None):
+            self.assertIsInstance(create_store(), MemoryNonceStore)
+        with override_settings(NONCE_STORE=None, CACHES=shared):
+            self.assertIsInstance(create_store(), CacheNonceStore)
+        with override_settings(NONCE_STORE="memory", CACHES=shared):
+            self.assertIsInstance(create_store(), MemoryNonceStore)
+        with override_settings(NONCE_STORE="cache"):
+            self.assertIsInstance(create_store(), CacheNonceStore)
+
+
+
+class ValidateTimestampAndNonceTestCase(SimpleTestCase):
+    
+    @override_settings(NONCE_WINDOW=1800)
+    def test_validate_timestamp_and_nonce(self):
+        validator = RequestValidator()
+        store = MemoryNonceStore(window=1800, buckets=60, max_size=1000)
+        now = int(time.time())
+        with mock.patch("lti_app.validator.nonce_store", store), \
+                mock.patch("lti_app.validator.time.time", return_value=now):
+            self.assertTrue(validator.validate_timestamp_and_nonce("key", str(now), "a", None))
+            # The nonce is only remembered once the signature is verified
+            self.assertTrue(validator.validate_timestamp_and_nonce("key", str(now), "a", None))
+            self.assertEqual(0, len(store))
+            store.add("key", "a", now)
+            self.assertFalse(validator.validate_timestamp_and_nonce("key", str(now), "a", None))
+            self.assertFalse(
+                validator.validate_timestamp_and_nonce("key", str(now - 1800), "b", None)
+            )
+            self.assertFalse(
+                validator.validate_timestamp_and_nonce("key", str(now + 1800), "c", None)
+            )
+            self.assertTrue(
+                validator.validate_timestamp_and_nonce("key", str(now - 1700), "d", None)
+            )
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+#
+#  test_registry.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+from lti_app.models import LMS, WIMS
+from lti_app.registry import VERSION_KEY, registry
+from lti_app.validator import RequestValidator
+
+
+
+@override_settings(CONFIG_REGISTRY=True, CONFIG_REGISTRY_TTL=60)
+class ConfigRegistryTestCase(TestCase):
+    
+    def setUp(self):
+        self.lms = LMS.objects.create(guid="elearning.upem.fr", url="https://elearning.u-pem.fr/",
+                                      name="LMS", key="provider1", secret="secret1")
+        self.wims = WIMS.objects.create(url="https://wims.fr/wims/wims.cgi", name="WIMS",
+                                        ident="myself", passwd="toto", rclass="myclass")
+        registry.invalidate()
+    
+    
+    def tearDown(self):
+        registry.invalidate()
+    
+    
+    def test_lookups(self):
+        with self.assertNumQueries(2):
+            self.assertEqual(self.lms, registry.get_lms_by_key("provider1"))
+        
+        with self.assertNumQueries(0):
+            self.assertEqual(self.lms, registry.get_lms_by_guid("elearning.upem.fr"))
+            self.assertEqual(self.wims, registry.get_wims(self.wims.pk))
+            self.assertEqual(self.wims, registry.get_wims(str(self.wims.pk)))
+            with self.assertRaises(LMS.DoesNotExist):
+                registry.get_lms_by_key("unknown")
+            with self.assertRaises(LMS.DoesNotExist):
+                registry.get_lms_by_guid("unknown")
+            with self.assertRaises(WIMS.DoesNotExist):
+                registry.get_wims(self.wims.pk + 1)
+    
+    
+    def test_multiple_guid(self):
+        LMS.objects.create(guid="elearning.upem.fr", url="https://elearning.u-pem.fr/",
+                           name="LMS", key="provider2", secret="secret2")
+        with self.assertRaises(LMS.MultipleObjectsReturned):
+            registry.get_lms_by_guid("elearning.upem.fr")
+    
+    
+    def test_invalidated_on_save(self):
+        registry.get_lms_by_key("provider1")
+        self.lms.secret = "secret2"
+        self.lms.save()
+        self.assertEqual("secret2", registry.get_lms_by_key("provider1").secret)
+        
+        pk = self.wims.pk
+        self.wims.delete()
+        with self.assertRaises(WIMS.DoesNotExist):
+            registry.get_wims(pk)
+    
+    
+    def test_invalidated_by_other_process(self):
+        registry.get_lms_by_key("provider1")
+        LMS.objects.filter(pk=self.lms.pk).update(secret="secret2")  # No signal sent
+        self.assertEqual("secret1", registry.get_lms_by_key("provider1").secret)
+        
+        cache.set(VERSION_KEY, "other", None)
+        self.assertEqual("secret2", registry.get_lms_by_key("provider1").secret)
+    
+    
+    def test_expired(self):
+        with mock.patch("lti_app.registry.time.monotonic", return_value=1000):
+            registry.get_lms_by_key("provider1")
+        LMS.objects.filter(pk=self.lms.pk).update(secret="secret2")  # No signal sent
+        
+        with mock.patch("lti_app.registry.time.monotonic", return_value=1059):
+            self.assertEqual("secret1", registry.get_lms_by_key("provider1").secret)
+        with mock.patch("lti_app.registry.time.monotonic", return_value=1060):
+            self.assertEqual("secret2", registry.get_lms_by_key("provider1").secret)
+    
+    
+    @override_settings(CONFIG_REGISTRY=None, TESTING=False)
+    def test_enabled(self):
+        self.assertFalse(registry.enabled())
+        memcached = {"default": {"BACKEND": "django.core.cache.backends.memcached.PyMemcacheCache"}}
+        with override_settings(CACHES=memcached):
+            self.assertTrue(registry.enabled())
+        with override_settings(TESTING=True, CACHES=memcached):
+            self.assertFalse(registry.enabled())
+    
+    
+    def test_validator(self):
+        validator = RequestValidator()
+        registry.get_lms_by_key("provider1")
+        with self.assertNumQueries(0):
+            self.assertTrue(validator.validate_client_key("provider1", None))
+            self.assertEqual("secret1", validator.get_client_secret("provider1", None))
+    
+    
+    @override_settings(CONFIG_REGISTRY=False)
+    def test_disabled(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.lms, registry.get_lms_by_key("provider1"))
+        with self.assertNumQueries(1):
+            self.assertEqual(self.lms, registry.get_lms_by_key("provider1"))
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+#
+#  test_roster.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+import json
+import os
+import tempfile
+from io import StringIO
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.test import TestCase
+from django.urls import reverse
+from wimsapi import WimsAPIError
+
+from lti_app.models import LMS, WIMS, WimsClass, WimsUser
+from lti_app.roster import provision, read_roster
+
+
+CSV_ROSTER = (
+    "user_id,firstname,lastname,email,roles\n"
+    "1,Jean,Martin,jmartin@email.com,Learner\n"
+    "2,Julie,Martin,jmartin2@email.com,Learner\n"
+    "3,Paul,Durand,pdurand@email.com,Instructor\n"
+)
+
+
+
+class ReadRosterTestCase(TestCase):
+    
+    def test_csv(self):
+        members = read_roster(CSV_ROSTER)
+        self.assertEqual(3, len(members))
+        self.assertEqual("1", members[0]["user_id"])
+        self.assertEqual("Jean", members[0]["lis_person_name_given"])
+        self.assertEqual("Martin", members[0]["lis_person_name_family"])
+        self.assertEqual("jmartin@email.com", members[0]["lis_person_contact_email_primary"])
+        self.assertFalse(members[0].is_teacher)
+        self.assertTrue(members[2].is_teacher)
+    
+    
+    def test_json(self):
+        members = read_roster(json.dumps({"members": [
+            {
+                "user_id":     "1",
+                "given_name":  "Jean",
+                "family_name": "Martin",
+                "email":       "jmartin@email.com",
+                "roles":       ["http://purl.imsglobal.org/vocab/lis/v2/membership#Instructor"],
+            },
+        ]}))
+        self.assertEqual(1, len(members))
+        self.assertEqual("Martin", members[0]["lis_person_name_family"])
+        self.assertTrue(members[0].is_teacher)
+    
+    
+    def test_missing_column(self):
+        with self.assertRaises(ValueError):
+            read_roster("user_id,firstname\n1,Jean\n")
+
+
+
+class ProvisionTestCase(TestCase):
+    
+    def setUp(self):
+        wims = WIMS.objects.create(url="https://wims.u-pem.fr/", name="WIMS UPEM",
+                                   ident="X", passwd="X", rclass="myclass")
+        lms = LMS.objects.create(guid="elearning.upem.fr", url="https://elearning.u-pem.fr/",
+                                 name="Moodle UPEM", key="provider1", secret="secret1")
+        self.wclass_db = WimsClass.objects.create(lms=lms, lms_guid="77777", wims=wims,
+                                                  qclass="60004", name="test1")
+        self.wclass = mock.Mock()
+        patcher = mock.patch("lti_app.roster.get_class", return_value=self.wclass)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+    
+    
+    def members(self, n):
+        return read_roster("user_id,firstname,lastname\n" + "".join(
+            "%d,Jean,Martin\n" % i for i in range(n)
+        ))
+    
+    
+    def test_provision(self):
+        report = provision(self.wclass_db, read_roster(CSV_ROSTER), workers=2, batch_size=1)
+        
+        self.assertEqual((2, 1, 0), (report.created, report.skipped, report.failed))
+        self.assertEqual(2, self.wclass.additem.call_count)
+        self.assertEqual(
+            {("1", "jmartin"), ("2", "jmartin1")},
+            set(WimsUser.objects.values_list("lms_guid", "quser"))
+        )
+    
+    
+    def test_batches(self):
+        WimsUser.objects.create(lms_guid="x", wclass=self.wclass_db, quser="jmartin")
+        
+        report = provision(self.wclass_db, self.members(250), workers=8, batch_size=100)
+        
+        self.assertEqual(250, report.created)
+        self.assertEqual(250, self.wclass.additem.call_count)
+        qusers = set(WimsUser.objects.values_list("quser", flat=True))
+        self.assertEqual({"jmartin"} | {"jmartin%d" % i for i in range(1, 251)}, qusers)
+    
+    
+    def test_resume(self):
+        provision(self.wclass_db, self.members(10), batch_size=4)
+        self.wclass.additem.reset_mock()
+        
+        report = provision(self.wclass_db, self.members(15), batch_size=4)
+        
+        self.assertEqual((5, 10), (report.created, report.skipped))
+        self.assertEqual(5, self.wclass.additem.call_count)
+        self.assertEqual(15, WimsUser.objects.count())
+    
+    
+    @mock.patch("wimsapi.User.get")
+    def test_adopt(self, get):
+        self.wclass.additem.side_effect = WimsAPIError("user already exists")
+        get.return_value = mock.Mock(regnum="0")
+        
+        report = provision(self.wclass_db, self.members(1))
+        
+        self.assertEqual(1, report.created)
+        self.assertEqual("jmartin", WimsUser.objects.get(lms_guid="0").quser)
+    
+    
+    @mock.patch("wimsapi.User.get")
+    def test_conflict(self, get):
+        self.wclass.additem.side_effect = [WimsAPIError("user already exists")] * 2 + [None]
+        get.return_value = mock.Mock(regnum="other")
+        
+        report = provision(self.wclass_db, self.members(1))
+        
+        self.assertEqual(1, report.created)
+        self.assertEqual("jmartin1", WimsUser.objects.get(lms_guid="0").quser)
+    
+    
+    def test_failed(self):
+        self.wclass.additem.side_effect = [WimsAPIError("Bad request"), None]
+        
+        report = provision(self.wclass_db, self.members(2), workers=1)
+        
+        self.assertEqual((1, 1), (report.created, report.failed))
+        self.assertEqual(1, WimsUser.objects.count())
+    
+    
+    def test_command(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".csv", delete=False) as f:
+            f.write(CSV_ROSTER)
+        self.addCleanup(os.remove, f.name)
+        
+        out = StringIO()
+        call_command("provision_roster", str(self.wclass_db.pk), f.name, stdout=out)
+        self.assertIn("2 created, 1 skipped, 0 failed", out.getvalue())
+        
+        with self.assertRaises(CommandError):
+            call_command("provision_roster", str(self.wclass_db.pk + 1), f.name)
+        with self.assertRaises(CommandError):
+            call_command("provision_roster", str(self.wclass_db.pk), f.name + ".missing")
+    
+    
+    def test_admin_action(self):
+        self.client.force_login(User.objects.create_superuser("admin", "admin@email.com", "pwd"))
+        url = reverse("admin:lti_app_wimsclass_changelist")
+        data = {"action": "provision_roster", "_selected_action": [self.wclass_db.pk]}
+        
+        response = self.client.post(url, data)
+        self.assertContains(response, 'name="roster"')
+        
+        roster = SimpleUploadedFile("roster.csv", CSV_ROSTER.encode())
+        response = self.client.post(url, {**data, "apply": "1", "roster": roster}, follow=True)
+        self.assertContains(response, "2 created, 1 skipped, 0 failed")
+        self.assertEqual(2, WimsUser.objects.count())
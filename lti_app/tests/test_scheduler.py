@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+#
+#  test_scheduler.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+from apscheduler.schedulers.background import BackgroundScheduler
+from django.apps import apps
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from lti_app.models import TaskLock
+from lti_app.scheduler import create_scheduler, run_locked
+
+
+
+class TaskLockTestCase(TestCase):
+    
+    def test_acquire(self):
+        self.assertTrue(TaskLock.acquire("task", "owner1", timedelta(hours=1)))
+        self.assertFalse(TaskLock.acquire("task", "owner2", timedelta(hours=1)))
+        self.assertTrue(TaskLock.acquire("other", "owner2", timedelta(hours=1)))
+        
+        TaskLock.release("task", "owner2")  # Not the owner
+        self.assertFalse(TaskLock.acquire("task", "owner2", timedelta(hours=1)))
+        TaskLock.release("task", "owner1")
+        self.assertTrue(TaskLock.acquire("task", "owner2", timedelta(hours=1)))
+    
+    
+    def test_abandoned(self):
+        self.assertTrue(TaskLock.acquire("task", "owner1", timedelta(hours=1)))
+        TaskLock.objects.update(expires=timezone.now() - timedelta(seconds=1))
+        self.assertTrue(TaskLock.acquire("task", "owner2", timedelta(hours=1)))
+        self.assertEqual("owner2", TaskLock.objects.get(name="task").owner)
+
+
+
+class SchedulerTestCase(TestCase):
+    
+    @mock.patch("lti_app.tasks.check_classes_exists", return_value=3)
+    def test_run_locked(self, check_classes_exists):
+        self.assertEqual(3, run_locked("check_classes_exists"))
+        self.assertFalse(TaskLock.objects.exists())
+        
+        TaskLock.acquire("check_classes_exists", "other", timedelta(hours=1))
+        self.assertIsNone(run_locked("check_classes_exists"))
+        check_classes_exists.assert_called_once_with()
+    
+    
+    @mock.patch("lti_app.tasks.check_classes_exists", side_effect=ValueError())
+    def test_run_locked_released_on_error(self, check_classes_exists):
+        with self.assertRaises(ValueError):
+            run_locked("check_classes_exists")
+        self.assertFalse(TaskLock.objects.exists())
+    
+    
+    def test_create_scheduler(self):
+        scheduler = create_scheduler(BackgroundScheduler)
+        self.assertEqual(
+            {"send_back_all_grades", "check_classes_exists"},
+            {job.id for job in scheduler.get_jobs()}
+        )
+        self.assertFalse(scheduler.running)
+    
+    
+    @mock.patch("lti_app.tasks.send_back_all_grades", return_value=12)
+    def test_command_run(self, send_back_all_grades):
+        out = StringIO()
+        call_command("run_scheduler", run="send_back_all_grades", stdout=out)
+        send_back_all_grades.assert_called_once_with()
+        self.assertIn("Task 'send_back_all_grades' done: 12", out.getvalue())
+    
+    
+    @mock.patch("lti_app.management.commands.run_scheduler.worker")
+    @mock.patch("apscheduler.schedulers.blocking.BlockingScheduler.start",
+                side_effect=KeyboardInterrupt)
+    def test_command_starts_worker(self, start, worker):
+        call_command("run_scheduler", stdout=StringIO())
+        worker.start.assert_called_once_with()
+        start.assert_called_once_with()
+    
+    
+    @mock.patch("lti_app.apps.worker")
+    def test_worker_not_started_in_process(self, worker):
+        apps.get_app_config("lti_app").ready()
+        worker.start.assert_not_called()
+        
+        with override_settings(WORKER_IN_PROCESS=True):
+            apps.get_app_config("lti_app").ready()
+        worker.start.assert_called_once_with()
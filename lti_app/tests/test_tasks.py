@@ -6,8 +6,27 @@
 #       - Coumes Quentin <coumes.quentin@gmail.com>
 
 
+import threading
+import time
+from collections import defaultdict
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+import requests
+import wimsapi
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
 from lti_app import tasks
-from lti_app.models import GradeLinkExam, GradeLinkSheet, WimsClass
+from lti_app.dispatch import GradeDispatcher, circuit_breaker
+from lti_app.models import (GradeLinkExam, GradeLinkSheet, GradeOutbox, GradeSyncJob,
+                            GradeSyncShard, LMS, MailOutbox, WIMS, WimsClass, WimsExam, WimsSheet,
+                            WimsUser)
 from lti_app.tests.utils import BaseGradeLinksViewTestCase
 
 
@@ -40,3 +59,480 @@ class TestTasks(BaseGradeLinksViewTestCase):
         before = WimsClass.objects.all().count()
         self.assertEqual(3, tasks.check_classes_exists())
         self.assertEqual(before - 3, WimsClass.objects.all().count())
+
+
+
+
+class SendBackGradesTestCase(TestCase):
+    
+    def setUp(self):
+        self.lms = LMS.objects.create(guid="elearning.upem.fr", url="https://elearning.u-pem.fr/",
+                                      name="LMS", key="provider1", secret="secret1")
+        self.wims = WIMS.objects.create(url="https://wims.fr/wims/wims.cgi", name="WIMS",
+                                        ident="myself", passwd="toto", rclass="myclass")
+        for i in range(2):
+            wclass = WimsClass.objects.create(lms=self.lms, lms_guid=str(i), wims=self.wims,
+                                              qclass=str(i), name="class")
+            for j in range(3):
+                WimsSheet.objects.create(wclass=wclass, lms_guid=str(j), qsheet=str(j))
+            for j in range(2):
+                WimsExam.objects.create(wclass=wclass, lms_guid=str(j), qexam=str(j))
+        WimsClass.objects.create(lms=self.lms, lms_guid="empty", wims=self.wims, qclass="empty",
+                                 name="class")
+    
+    
+    @mock.patch("wimsapi.Class.get")
+    def test_send_back_grades_one_fetch_per_class(self, get):
+        wclass = get.return_value
+        wclass._api.getsheetscores.return_value = (True, {"data_scores": []})
+        wclass._api.getexamscores.return_value = (True, {"data_scores": []})
+        
+        report = tasks.send_back_grades()
+        
+        self.assertEqual(0, report.total)
+        self.assertEqual(2, get.call_count)
+        self.assertEqual(6, wclass._api.getsheetscores.call_count)
+        self.assertEqual(4, wclass._api.getexamscores.call_count)
+    
+    
+    @mock.patch("wimsapi.Class.get")
+    def test_send_back_grades_sheets_only(self, get):
+        wclass = get.return_value
+        wclass._api.getsheetscores.return_value = (True, {"data_scores": []})
+        
+        tasks.send_back_grades(exams=False)
+        
+        self.assertEqual(2, get.call_count)
+        self.assertEqual(6, wclass._api.getsheetscores.call_count)
+        wclass._api.getexamscores.assert_not_called()
+    
+    
+    def test_plan(self):
+        self.assertEqual(2, GradeSyncShard.plan("all", size=2))
+        self.assertIsNone(GradeSyncShard.plan("all", size=2))
+        self.assertEqual(1, GradeSyncShard.plan("sheets", size=10))
+        self.assertEqual(
+            [2, 1], list(GradeSyncShard.objects.filter(kind="all").values_list("classes_total",
+                                                                                flat=True))
+        )
+        
+        GradeSyncShard.objects.update(status=GradeSyncShard.DONE)
+        self.assertEqual(2, GradeSyncShard.plan("all", size=2))
+        self.assertEqual(3, GradeSyncShard.objects.count())
+    
+    
+    def test_plan_force(self):
+        GradeSyncShard.plan("all", size=2)
+        shard = GradeSyncShard.claim("a")
+        
+        # The unfinished run is discarded, its process stopping at its next checkpoint
+        self.assertEqual(2, GradeSyncShard.plan("all", force=True, size=2))
+        self.assertTrue(all(s.force for s in GradeSyncShard.objects.all()))
+        self.assertFalse(shard.save_checkpoint(shard.first_class, 1, 0, 0))
+    
+    
+    def test_plan_no_class(self):
+        WimsClass.objects.all().delete()
+        self.assertEqual(0, GradeSyncShard.plan("all"))
+        
+        with self.assertLogs("lti_app.tasks", "INFO") as logs:
+            tasks.send_back_grades()
+        self.assertFalse(any("Resuming" in line for line in logs.output))
+    
+    
+    @mock.patch("wimsapi.Class.get", side_effect=requests.ConnectionError())
+    def test_send_back_grades_server_down(self, get):
+        with self.assertLogs("lti_app.tasks", "WARNING") as logs:
+            tasks.send_back_grades()
+        
+        self.assertEqual(1, get.call_count)
+        shard = GradeSyncShard.objects.get()
+        self.assertIn("shard %d" % shard.pk, logs.output[0])
+        self.assertIn("its 3 remaining class(es)", logs.output[0])
+        self.assertEqual(GradeSyncShard.FAILED, shard.status)
+        self.assertIsNotNone(shard.finished)
+        # The next run starts over instead of resuming the failed shard
+        self.assertEqual(1, GradeSyncShard.plan("all"))
+    
+    
+    def test_claim(self):
+        GradeSyncShard.plan("all", size=2)
+        
+        first = GradeSyncShard.claim("a")
+        second = GradeSyncShard.claim("b")
+        self.assertNotEqual(first.pk, second.pk)
+        self.assertIsNone(GradeSyncShard.claim("c"))
+        
+        GradeSyncShard.objects.filter(pk=first.pk).update(
+            lease_expires=timezone.now() - timedelta(seconds=1)
+        )
+        self.assertEqual(first.pk, GradeSyncShard.claim("c").pk)
+        self.assertFalse(first.save_checkpoint(first.first_class, 1, 0, 0))
+    
+    
+    @mock.patch("wimsapi.Class.get")
+    def test_send_back_grades_resume(self, get):
+        wclass = get.return_value
+        wclass._api.getsheetscores.return_value = (True, {"data_scores": []})
+        wclass._api.getexamscores.return_value = (True, {"data_scores": []})
+        
+        # Interrupted run, whose owner stopped after the first class
+        GradeSyncShard.plan("all", size=2)
+        shard = GradeSyncShard.claim("interrupted")
+        shard.save_checkpoint(shard.first_class, 1, 0, 0)
+        GradeSyncShard.objects.filter(pk=shard.pk).update(
+            lease_expires=timezone.now() - timedelta(seconds=1)
+        )
+        
+        tasks.send_back_grades()
+        
+        self.assertEqual(1, get.call_count)
+        self.assertEqual(3, wclass._api.getsheetscores.call_count)
+        shards = GradeSyncShard.objects.all()
+        self.assertTrue(all(s.status == GradeSyncShard.DONE for s in shards))
+        self.assertEqual(3, sum(s.classes_done for s in shards))
+    
+    
+    @mock.patch("wimsapi.Class.get")
+    def test_run_grade_sync_shards_checkpoint(self, get):
+        wclass = get.return_value
+        wclass._api.getsheetscores.return_value = (True, {"data_scores": []})
+        GradeSyncShard.plan("sheets", size=10)
+        
+        with mock.patch.object(GradeSyncShard, "save_checkpoint", autospec=True,
+                               side_effect=GradeSyncShard.save_checkpoint) as save:
+            self.assertEqual(1, tasks.run_grade_sync_shards("sheets", checkpoint=1))
+        
+        self.assertEqual(4, save.call_count)
+        self.assertEqual(GradeSyncShard.DONE, GradeSyncShard.objects.get().status)
+    
+    
+    def test_sync_grades_command(self):
+        out = StringIO()
+        call_command("sync_grades", "--join", stdout=out)
+        self.assertIn("0 shard(s) run", out.getvalue())
+
+
+
+
+class GradeSyncJobTestCase(TestCase):
+    
+    def setUp(self):
+        lms = LMS.objects.create(guid="elearning.upem.fr", url="https://elearning.u-pem.fr/",
+                                 name="LMS", key="provider1", secret="secret1")
+        wims = WIMS.objects.create(url="https://wims.fr/wims/wims.cgi", name="WIMS",
+                                   ident="myself", passwd="toto", rclass="myclass")
+        wclass = WimsClass.objects.create(lms=lms, lms_guid="1", wims=wims, qclass="1",
+                                          name="class")
+        self.sheet = WimsSheet.objects.create(wclass=wclass, lms_guid="1", qsheet="1")
+        self.exam = WimsExam.objects.create(wclass=wclass, lms_guid="1", qexam="1")
+    
+    
+    def test_enqueue_deduplicated(self):
+        self.assertTrue(GradeSyncJob.enqueue(self.sheet))
+        self.assertFalse(GradeSyncJob.enqueue(self.sheet))
+        self.assertTrue(GradeSyncJob.enqueue(self.exam))
+        self.assertFalse(GradeSyncJob.enqueue(self.exam))
+        self.assertEqual(2, GradeSyncJob.objects.count())
+    
+    
+    @mock.patch("lti_app.models.GradeLinkExam.send_back_all")
+    @mock.patch("lti_app.models.GradeLinkSheet.send_back_all")
+    def test_run_grade_sync_jobs(self, sheet_send_back_all, exam_send_back_all):
+        GradeSyncJob.enqueue(self.sheet)
+        GradeSyncJob.enqueue(self.exam)
+        
+        self.assertEqual(2, tasks.run_grade_sync_jobs())
+        
+        self.assertEqual(0, GradeSyncJob.objects.count())
+        self.assertEqual(self.sheet, sheet_send_back_all.call_args[0][0])
+        self.assertEqual(self.exam, exam_send_back_all.call_args[0][0])
+        self.assertTrue(GradeSyncJob.enqueue(self.sheet))
+        self.assertEqual(1, tasks.run_grade_sync_jobs())
+        self.assertEqual(0, tasks.run_grade_sync_jobs())
+
+
+
+class RetryDeferredGradesTestCase(TestCase):
+    
+    def setUp(self):
+        circuit_breaker.reset()
+        self.lms = LMS.objects.create(guid="elearning.upem.fr", url="https://elearning.u-pem.fr/",
+                                      name="LMS", key="provider1", secret="secret1")
+        wims = WIMS.objects.create(url="https://wims.fr/wims/wims.cgi", name="WIMS",
+                                   ident="myself", passwd="toto", rclass="myclass")
+        wclass = WimsClass.objects.create(lms=self.lms, lms_guid="1", wims=wims, qclass="1",
+                                          name="class")
+        sheet = WimsSheet.objects.create(wclass=wclass, lms_guid="1", qsheet="1")
+        exam = WimsExam.objects.create(wclass=wclass, lms_guid="1", qexam="1")
+        user = WimsUser.objects.create(lms_guid="1", wclass=wclass, quser="user")
+        self.sheet_link = GradeLinkSheet.objects.create(
+            user=user, activity=sheet, lms=self.lms, sourcedid="1", url="https://lms.fr/outcome"
+        )
+        self.exam_link = GradeLinkExam.objects.create(
+            user=user, activity=exam, lms=self.lms, sourcedid="2", url="https://lms.fr/outcome"
+        )
+        GradeLinkSheet.defer([(self.sheet_link, 0.5)])
+        GradeLinkExam.defer([(self.exam_link, 0.25)])
+    
+    
+    def tearDown(self):
+        circuit_breaker.reset()
+    
+    
+    def test_not_due(self):
+        with mock.patch("lti_app.models.GradeLinkBase.send_back") as send_back:
+            self.assertEqual(0, tasks.retry_deferred_grades())
+        send_back.assert_not_called()
+    
+    
+    @mock.patch("lti_app.models.GradeLinkBase.send_back", return_value=True)
+    def test_sent(self, send_back):
+        GradeOutbox.objects.update(next_attempt=timezone.now() - timedelta(seconds=1))
+        
+        self.assertEqual(2, tasks.retry_deferred_grades())
+        
+        self.assertEqual({0.5, 0.25}, {c[0][0] for c in send_back.call_args_list})
+        self.assertEqual(0, GradeOutbox.objects.count())
+        self.assertEqual(0.5, GradeLinkSheet.objects.get(pk=self.sheet_link.pk).last_score)
+        self.assertEqual(0.25, GradeLinkExam.objects.get(pk=self.exam_link.pk).last_score)
+    
+    
+    @mock.patch("lti_app.models.GradeLinkBase.send_back", return_value=False)
+    def test_failed_again(self, send_back):
+        GradeOutbox.objects.update(next_attempt=timezone.now() - timedelta(seconds=1))
+        
+        self.assertEqual(0, tasks.retry_deferred_grades())
+        
+        self.assertEqual(2, send_back.call_count)
+        self.assertEqual([2, 2], [e.attempts for e in GradeOutbox.objects.all()])
+        self.assertFalse(GradeOutbox.objects.filter(next_attempt__lte=timezone.now()).exists())
+    
+    
+    def test_circuit_opened(self):
+        GradeOutbox.objects.update(next_attempt=timezone.now() - timedelta(seconds=1))
+        for _ in range(circuit_breaker.threshold):
+            circuit_breaker.record(self.lms.pk, False)
+        
+        with mock.patch("lti_app.models.GradeLinkBase.send_back") as send_back:
+            self.assertEqual(0, tasks.retry_deferred_grades())
+        send_back.assert_not_called()
+        self.assertEqual([1, 1], [e.attempts for e in GradeOutbox.objects.all()])
+    
+    
+    @mock.patch("lti_app.models.GradeLinkBase.send_back", return_value=True)
+    def test_claimed_by_other_process(self, send_back):
+        GradeOutbox.objects.update(next_attempt=timezone.now() - timedelta(seconds=1))
+        original = GradeOutbox.objects.filter
+        exam_entry = GradeOutbox.objects.get(exam_link=self.exam_link)
+        
+        def claimed(*args, **kwargs):  # Another process claims the exam grade once it was listed
+            if kwargs.get("pk") == exam_entry.pk:
+                original(pk=exam_entry.pk).update(
+                    next_attempt=timezone.now() + GradeOutbox.CLAIM_DELAY
+                )
+            return original(*args, **kwargs)
+        
+        with mock.patch.object(GradeOutbox.objects, "filter", side_effect=claimed):
+            self.assertEqual(1, tasks.retry_deferred_grades())
+        
+        send_back.assert_called_once_with(0.5)
+        self.assertEqual([1], [e.attempts for e in GradeOutbox.objects.all()])
+    
+    
+    @mock.patch("lti_app.models.GradeLinkBase.send_back", return_value=True)
+    def test_claimed_before_sending(self, send_back):
+        GradeOutbox.objects.update(next_attempt=timezone.now() - timedelta(seconds=1))
+        submit = GradeDispatcher.submit
+        due = []
+        
+        def claimed(dispatcher, gl, grade):  # A submitted grade cannot be retried by others
+            due.append(GradeOutbox.objects.filter(next_attempt__lte=timezone.now()).count())
+            return submit(dispatcher, gl, grade)
+        
+        with mock.patch.object(GradeDispatcher, "submit", claimed):
+            self.assertEqual(2, tasks.retry_deferred_grades())
+        self.assertEqual([1, 0], due)
+
+
+
+class SendQueuedMailsTestCase(TestCase):
+    
+    def setUp(self):
+        self.mail = MailOutbox.enqueue("Title", "Body", ["a@email.com", "b@email.com"])
+    
+    
+    def test_sent(self):
+        self.assertEqual(1, tasks.send_queued_mails())
+        
+        self.assertEqual(1, len(mail.outbox))
+        self.assertEqual("Title", mail.outbox[0].subject)
+        self.assertEqual(["a@email.com", "b@email.com"], mail.outbox[0].to)
+        self.assertFalse(MailOutbox.objects.exists())
+    
+    
+    def test_not_due(self):
+        MailOutbox.objects.update(next_attempt=timezone.now() + timedelta(seconds=60))
+        self.assertEqual(0, tasks.send_queued_mails())
+        self.assertEqual(0, len(mail.outbox))
+    
+    
+    @mock.patch("lti_app.models.send_mail", side_effect=ConnectionRefusedError())
+    def test_failed(self, send_mail):
+        self.assertEqual(0, tasks.send_queued_mails())
+        
+        entry = MailOutbox.objects.get()
+        self.assertEqual(1, entry.attempts)
+        self.assertGreater(entry.next_attempt, timezone.now())
+    
+    
+    @override_settings(OUTBOX_MAX_ATTEMPTS=2)
+    @mock.patch("lti_app.models.send_mail", side_effect=ConnectionRefusedError())
+    def test_dropped(self, send_mail):
+        MailOutbox.objects.update(attempts=1)
+        self.assertEqual(0, tasks.send_queued_mails())
+        self.assertFalse(MailOutbox.objects.exists())
+    
+    
+    def test_claimed_by_other_process(self):
+        original = MailOutbox.objects.filter
+        
+        def claimed(*args, **kwargs):  # Another process claims the mail after it was listed
+            if "next_attempt" in kwargs:
+                MailOutbox.objects.update(next_attempt=timezone.now())
+            return original(*args, **kwargs)
+        
+        with mock.patch.object(MailOutbox.objects, "filter", side_effect=claimed):
+            self.assertEqual(0, tasks.send_queued_mails())
+        self.assertEqual(0, len(mail.outbox))
+    
+    
+    def test_deleted_with_class(self):
+        lms = LMS.objects.create(guid="elearning.upem.fr", url="https://elearning.u-pem.fr/",
+                                 name="LMS", key="provider1", secret="secret1")
+        wims = WIMS.objects.create(url="https://wims.fr/wims/wims.cgi", name="WIMS",
+                                   ident="myself", passwd="toto", rclass="myclass")
+        wclass = WimsClass.objects.create(lms=lms, lms_guid="1", wims=wims, qclass="1",
+                                          name="class")
+        MailOutbox.enqueue("Credentials", "Password: secret", ["a@email.com"], wclass=wclass)
+        
+        wclass.delete()
+        self.assertEqual(["Title"], [m.subject for m in MailOutbox.objects.all()])
+    
+    
+    def test_body_not_in_admin(self):
+        self.client.force_login(User.objects.create_superuser("admin", "admin@email.com", "pwd"))
+        response = self.client.get(reverse("admin:lti_app_mailoutbox_change", args=[self.mail.pk]))
+        self.assertContains(response, "a@email.com")
+        self.assertNotContains(response, 'name="body"')
+
+
+
+class CheckClassesExistsTestCase(TestCase):
+    
+    def setUp(self):
+        lms = LMS.objects.create(guid="elearning.upem.fr", url="https://elearning.u-pem.fr/",
+                                 name="LMS", key="provider1", secret="secret1")
+        self.wims1 = WIMS.objects.create(url="https://wims1.fr/wims/wims.cgi", name="WIMS1",
+                                         ident="myself", passwd="toto", rclass="myclass")
+        self.wims2 = WIMS.objects.create(url="https://wims2.fr/wims/wims.cgi", name="WIMS2",
+                                         ident="myself", passwd="toto", rclass="myclass")
+        for wims in (self.wims1, self.wims2):
+            for qclass in ("1", "2", "3"):
+                WimsClass.objects.create(lms=lms, lms_guid=wims.name + qclass, wims=wims,
+                                         qclass=qclass, name="class")
+    
+    
+    @staticmethod
+    def class_get(existing):
+        def get(url, ident, passwd, qclass, rclass, **kwargs):
+            if (url, qclass) in existing:
+                return mock.Mock()
+            raise wimsapi.AdmRawError("class %s not existing" % qclass)
+        return get
+    
+    
+    def test_listed(self):
+        listed = {self.wims1.url: {"1", "2", "3"}, self.wims2.url: {"1"}}
+        existing = {(self.wims2.url, "2")}
+        with mock.patch("lti_app.tasks.list_qclasses", side_effect=lambda w: listed[w.url]), \
+                mock.patch("wimsapi.Class.get", side_effect=self.class_get(existing)) as get:
+            self.assertEqual(1, tasks.check_classes_exists())
+        
+        # Only the classes missing from the lists are checked one by one
+        self.assertEqual({"2", "3"}, {c[0][3] for c in get.call_args_list})
+        self.assertEqual(
+            {("WIMS1", "1"), ("WIMS1", "2"), ("WIMS1", "3"), ("WIMS2", "1"), ("WIMS2", "2")},
+            set(WimsClass.objects.values_list("wims__name", "qclass"))
+        )
+    
+    
+    def test_list_failed(self):
+        existing = {(self.wims1.url, "1"), (self.wims1.url, "2"), (self.wims1.url, "3")}
+        with mock.patch("lti_app.tasks.list_qclasses", side_effect=requests.ConnectTimeout()), \
+                mock.patch("wimsapi.Class.get", side_effect=self.class_get(existing)) as get:
+            self.assertEqual(3, tasks.check_classes_exists())
+        self.assertEqual(6, get.call_count)
+    
+    
+    def test_check_failed(self):
+        with mock.patch("lti_app.tasks.list_qclasses", return_value=set()), \
+                mock.patch("wimsapi.Class.get", side_effect=requests.ReadTimeout()):
+            self.assertEqual(0, tasks.check_classes_exists())
+        self.assertEqual(6, WimsClass.objects.count())
+    
+    
+    def test_per_server_cap(self):
+        running = defaultdict(int)
+        highest = defaultdict(int)
+        lock = threading.Lock()
+        
+        def get(url, *args, **kwargs):
+            with lock:
+                running[url] += 1
+                highest[url] = max(highest[url], running[url])
+            time.sleep(0.02)
+            with lock:
+                running[url] -= 1
+            return mock.Mock()
+        
+        with mock.patch("lti_app.tasks.list_qclasses", return_value=set()), \
+                mock.patch("wimsapi.Class.get", side_effect=get):
+            tasks.check_classes_exists(workers=6, per_server=2)
+        self.assertEqual({self.wims1.url: 2, self.wims2.url: 2}, dict(highest))
+    
+    
+    def test_slow_server(self):
+        """The checks of a slow server do not hold the threads the other server needs."""
+        other_done = threading.Event()
+        other_checked = []
+        waited = []
+        
+        def get(url, ident, passwd, qclass, rclass, **kwargs):
+            if url == self.wims1.url:
+                waited.append(other_done.wait(5))
+            else:
+                other_checked.append(qclass)
+                if len(other_checked) == 3:
+                    other_done.set()
+            return mock.Mock()
+        
+        with mock.patch("lti_app.tasks.list_qclasses", return_value=set()), \
+                mock.patch("wimsapi.Class.get", side_effect=get):
+            tasks.check_classes_exists(workers=2, per_server=1)
+        self.assertEqual([True, True, True], waited)
+        
+        
+    def test_list_qclasses(self):
+        with mock.patch("wimsapi.WimsAPI.listclasses") as listclasses:
+            listclasses.return_value = (True, {"classes_list": [{"qclass": 1}, {"qclass": 2}]})
+            self.assertEqual({"1", "2"}, tasks.list_qclasses(self.wims1))
+            
+            listclasses.return_value = (
+                False, {"message": "there is no class allowed for this server"}
+            )
+            self.assertEqual(set(), tasks.list_qclasses(self.wims1))
+            
+            listclasses.return_value = (False, {"message": "Bad ident"})
+            with self.assertRaises(wimsapi.WimsAPIError):
+                tasks.list_qclasses(self.wims1)
@@ -9,19 +9,28 @@
 import time
 import traceback
 from datetime import date, datetime, timedelta
+from io import StringIO
+from unittest import mock
 
 import oauth2
 import oauthlib.oauth1.rfc5849.signature as oauth_signature
+import requests
 from django.conf import settings
 from django.core import mail
 from django.core.exceptions import PermissionDenied
-from django.test import RequestFactory, TestCase
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import IntegrityError
+from django.test import RequestFactory, TestCase, override_settings
 from django.urls import reverse
-from wimsapi import Class, Exam, Sheet, User, WimsAPI
+from django.utils import timezone
+from wimsapi import Class, Exam, Sheet, User, WimsAPI, WimsAPIError
 
-from lti_app import utils
+from lti_app import tasks, utils
+from lti_app.enums import Role
 from lti_app.exceptions import BadRequestException
-from lti_app.models import LMS, WIMS, WimsClass, WimsUser
+from lti_app.models import ClassCreation, LMS, MailOutbox, WIMS, WimsClass, WimsUser
+from lti_app.nonces import nonce_store
 from lti_app.tests.utils import KEY, SECRET, WIMS_URL, TEST_SERVER
 from lti_app.utils import parse_parameters
 
@@ -66,6 +75,25 @@ class IsValidRequestTestCase(TestCase):
             utils.is_valid_request(request)
         except Exception:
             self.fail(traceback.format_exc())
+        
+        with self.assertRaises(PermissionDenied):  # Replayed
+            utils.is_valid_request(request)
+    
+    
+    @mock.patch("lti_app.utils.DjangoToolProvider")
+    def test_is_valid_request_concurrent_replay(self, provider):
+        """The nonce was remembered by a concurrent request once this one was validated."""
+        provider.from_django_request.return_value.is_valid_request.return_value = True
+        nonce = oauth2.generate_nonce()
+        request = RequestFactory().post(reverse("lti:wims_class", args=[1]), {
+            'lti_message_type':   'basic-lti-launch-request',
+            'oauth_consumer_key': KEY,
+            'oauth_nonce':        nonce,
+        })
+        nonce_store.add(KEY, nonce, time.time())
+        
+        with self.assertRaisesMessage(PermissionDenied, "nonce already used"):
+            utils.is_valid_request(request)
     
     
     def test_is_valid_request_wrong_lti_message_type(self):
@@ -139,6 +167,7 @@ class IsValidRequestTestCase(TestCase):
         
         with self.assertRaises(PermissionDenied):
             utils.is_valid_request(request)
+        self.assertFalse(nonce_store.seen(KEY, params['oauth_nonce'], time.time()))
     
     
     def test_is_valid_request_unknown_consumer(self):
@@ -328,6 +357,89 @@ class CheckParametersTestCase(TestCase):
 
 
 
+class LaunchContextTestCase(TestCase):
+    
+    def setUp(self):
+        self.params = {
+            'lti_message_type':                   'basic-lti-launch-request',
+            'lti_version':                        'LTI-1p0',
+            'launch_presentation_locale':         'fr-FR',
+            'resource_link_id':                   'X',
+            'context_id':                         'X',
+            'context_title':                      "A title",
+            'user_id':                            'X',
+            'lis_person_contact_email_primary':   'X',
+            'lis_person_name_family':             'X',
+            'lis_person_name_given':              'X',
+            'tool_consumer_instance_description': 'X',
+            'tool_consumer_instance_guid':        'elearning.u-pem.fr',
+            'oauth_consumer_key':                 KEY,
+            'oauth_signature_method':             'HMAC-SHA1',
+            'oauth_timestamp':                    str(oauth2.generate_timestamp()),
+            'oauth_nonce':                        oauth2.generate_nonce(),
+            'oauth_signature':                    oauth2.generate_nonce(),
+            'roles':                              "Learner,urn:lti:role:ims/lis/Instructor",
+            'custom_class_lang':                  "fr",
+        }
+    
+    
+    def test_mapping(self):
+        context = utils.parse_parameters(self.params)
+        self.assertEqual("X", context["context_id"])
+        self.assertIsNone(context["custom_class_name"])
+        self.assertEqual(len(utils.LTI_PARAMETERS), len(context))
+        self.assertEqual(set(utils.LTI_PARAMETERS), set(context))
+        self.assertEqual("X", context.get("user_id"))
+    
+    
+    def test_immutable(self):
+        context = utils.parse_parameters(self.params)
+        with self.assertRaises(TypeError):
+            context["context_id"] = "Y"
+        with self.assertRaises(AttributeError):
+            context.other = "Y"
+        with self.assertRaises(AttributeError):
+            context.__dict__
+    
+    
+    def test_roles_cached(self):
+        context = utils.parse_parameters(self.params)
+        with mock.patch.object(Role, "parse_role_lti", wraps=Role.parse_role_lti) as parse:
+            self.assertEqual({Role.LEARNER, Role.INSTRUCTOR}, context.roles)
+            self.assertTrue(context.is_teacher)
+            self.assertEqual({Role.LEARNER, Role.INSTRUCTOR}, context.roles)
+        parse.assert_called_once_with("Learner,urn:lti:role:ims/lis/Instructor")
+    
+    
+    def test_parse_launch(self):
+        self.assertEqual("fr", utils.parse_launch(self.params)["custom_class_lang"])
+        
+        self.params["custom_class_lang"] = "xx"
+        with self.assertRaises(BadRequestException):
+            utils.parse_launch(self.params)
+        
+        del self.params["user_id"]
+        with self.assertRaises(BadRequestException):
+            utils.parse_launch(self.params)
+    
+    
+    def test_is_teacher(self):
+        self.assertTrue(utils.is_teacher(frozenset({Role.LEARNER, Role.INSTRUCTOR})))
+        self.assertTrue(utils.is_teacher([Role.ADMINISTRATOR]))
+        self.assertFalse(utils.is_teacher(frozenset({Role.LEARNER, Role.ALUMNI})))
+        self.assertFalse(utils.is_teacher(frozenset()))
+    
+    
+    def test_benchmark_command(self):
+        out = StringIO()
+        call_command("benchmark_parsing", "--iterations", "10", stdout=out)
+        self.assertIn("Parsed 10 launches in", out.getvalue())
+        
+        with self.assertRaises(CommandError):
+            call_command("benchmark_parsing", "--iterations", "0")
+
+
+
 class GetOrCreateClassTestCase(TestCase):
     
     def tearDown(self):
@@ -672,6 +784,8 @@ class GetOrCreateClassTestCase(TestCase):
                                  name="Moodle UPEM", key=KEY, secret=SECRET)
         api = WimsAPI(WIMS_URL, "myself", "toto")
         wclass_db, wclass = utils.get_or_create_class(lms, wims, api, params)
+        self.assertEqual(0, len(mail.outbox))
+        tasks.send_queued_mails()
         
         self.assertIn(wclass.name, mail.outbox[0].body)
         self.assertIn(wclass.qclass, mail.outbox[0].body)
@@ -680,6 +794,130 @@ class GetOrCreateClassTestCase(TestCase):
 
 
 
+class CreateClassOnceTestCase(TestCase):
+    
+    def setUp(self):
+        self.params = parse_parameters({
+            'context_id':                       '77777',
+            'context_title':                    "A title",
+            'user_id':                          '77',
+            'lis_person_contact_email_primary': 'test@email.com',
+            'lis_person_name_family':           'Doe',
+            'lis_person_name_given':            'Jhon',
+            'roles':                            "Instructor",
+        })
+        self.wims = WIMS.objects.create(url="https://wims.u-pem.fr/", name="WIMS UPEM",
+                                        ident="X", passwd="X", rclass="myclass")
+        self.lms = LMS.objects.create(guid="elearning.upem.fr", url="https://elearning.u-pem.fr/",
+                                      name="Moodle UPEM", key="provider1", secret="secret1")
+        self.api = mock.Mock(url=WIMS_URL, ident="myself", passwd="toto")
+        self.wclass = mock.Mock(qclass="60001")
+        self.wclass.name = "A title"
+        self.wclass.supervisor.email = "supervisor@email.com"
+        for target, kwargs in (("lti_app.utils.create_class", {"return_value": self.wclass}),
+                               ("lti_app.utils.generate_mail", {"return_value": ("t", "b")}),
+                               ("lti_app.utils.cache.get_class", {"return_value": self.wclass})):
+            patcher = mock.patch(target, **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+    
+    
+    def test_create(self):
+        wclass_db, wclass = utils.create_class_once(self.lms, self.wims, self.api, self.params)
+        
+        self.assertIs(self.wclass, wclass)
+        self.assertEqual("60001", wclass_db.qclass)
+        self.wclass.save.assert_called_once()
+        self.assertTrue(WimsUser.objects.filter(wclass=wclass_db, quser="supervisor").exists())
+        self.assertFalse(ClassCreation.objects.exists())
+        self.assertEqual(wclass_db, MailOutbox.objects.get().wclass)
+    
+    
+    def test_wait_other_process(self):
+        self.assertTrue(ClassCreation.acquire(self.lms, "77777", self.wims))
+        
+        def other_process(_):
+            WimsClass.objects.create(lms=self.lms, lms_guid="77777", wims=self.wims,
+                                     qclass="60002", name="A title")
+        
+        with mock.patch("lti_app.utils.time.sleep", side_effect=other_process):
+            wclass_db, _ = utils.create_class_once(self.lms, self.wims, self.api, self.params)
+        
+        self.assertEqual("60002", wclass_db.qclass)
+        self.wclass.save.assert_not_called()
+    
+    
+    def test_wait_reads_only(self):
+        self.assertTrue(ClassCreation.acquire(self.lms, "77777", self.wims))
+        
+        def other_process(_):
+            if sleep.call_count == 3:
+                WimsClass.objects.create(lms=self.lms, lms_guid="77777", wims=self.wims,
+                                         qclass="60002", name="A title")
+        
+        with mock.patch("lti_app.utils.time.sleep", side_effect=other_process) as sleep, \
+                mock.patch.object(ClassCreation, "acquire", wraps=ClassCreation.acquire) as acquire:
+            wclass_db, _ = utils.create_class_once(self.lms, self.wims, self.api, self.params)
+        
+        self.assertEqual("60002", wclass_db.qclass)
+        self.assertEqual(1, acquire.call_count)
+    
+    
+    def test_wait_lock_released(self):
+        self.assertTrue(ClassCreation.acquire(self.lms, "77777", self.wims))
+        
+        def other_process(_):  # Failed to create the class
+            ClassCreation.release(self.lms, "77777", self.wims)
+        
+        with mock.patch("lti_app.utils.time.sleep", side_effect=other_process):
+            wclass_db, _ = utils.create_class_once(self.lms, self.wims, self.api, self.params)
+        
+        self.assertEqual("60001", wclass_db.qclass)
+        self.wclass.save.assert_called_once()
+        self.assertFalse(ClassCreation.objects.exists())
+    
+    
+    @override_settings(CLASS_CREATION_TIMEOUT=60)
+    def test_wait_timeout(self):
+        self.assertTrue(ClassCreation.acquire(self.lms, "77777", self.wims))
+        
+        with mock.patch("lti_app.utils.time.sleep"), \
+                mock.patch("lti_app.utils.time.monotonic", side_effect=[0, 30, 61]):
+            with self.assertRaises(requests.Timeout):
+                utils.create_class_once(self.lms, self.wims, self.api, self.params)
+        self.wclass.save.assert_not_called()
+    
+    
+    @override_settings(CLASS_CREATION_TIMEOUT=60)
+    def test_stale_lock(self):
+        self.assertTrue(ClassCreation.acquire(self.lms, "77777", self.wims))
+        self.assertFalse(ClassCreation.acquire(self.lms, "77777", self.wims))
+        ClassCreation.objects.update(created=timezone.now() - timedelta(seconds=61))
+        
+        utils.create_class_once(self.lms, self.wims, self.api, self.params)
+        
+        self.wclass.save.assert_called_once()
+        self.assertFalse(ClassCreation.objects.exists())
+    
+    
+    def test_released_on_error(self):
+        self.wclass.save.side_effect = WimsAPIError("Error")
+        
+        with self.assertRaises(WimsAPIError):
+            utils.create_class_once(self.lms, self.wims, self.api, self.params)
+        self.assertFalse(ClassCreation.objects.exists())
+        self.assertFalse(WimsClass.objects.exists())
+    
+    
+    def test_class_saved_with_supervisor(self):
+        with mock.patch("lti_app.utils.WimsUser.objects.create", side_effect=IntegrityError()):
+            with self.assertRaises(IntegrityError):
+                utils.create_class_once(self.lms, self.wims, self.api, self.params)
+        self.assertFalse(WimsClass.objects.exists())
+        self.assertFalse(ClassCreation.objects.exists())
+
+
+
 class GetOrCreateUserTestCase(TestCase):
     
     def test_wims_username(self):
@@ -698,6 +936,72 @@ class GetOrCreateUserTestCase(TestCase):
         )
     
     
+    def test_quser_candidates(self):
+        wims = WIMS.objects.create(url="https://wims.u-pem.fr/", name="WIMS UPEM",
+                                   ident="X", passwd="X", rclass="myclass")
+        lms = LMS.objects.create(guid="elearning.upem.fr", url="https://elearning.u-pem.fr/",
+                                 name="Moodle UPEM", key="provider1", secret="secret1")
+        wclass_db = WimsClass.objects.create(lms=lms, lms_guid="77777", wims=wims,
+                                             qclass="60004", name="test1")
+        for quser in ["jdoe", "jdoe1", "jdoe3", "jdoe01", "jdoex", "jdoe2x"]:
+            WimsUser.objects.create(lms_guid=quser, wclass=wclass_db, quser=quser)
+        
+        with self.assertNumQueries(1):
+            candidates = utils.quser_candidates(wclass_db, "jdoe")
+            self.assertEqual(["jdoe2", "jdoe4", "jdoe5"], [next(candidates) for _ in range(3)])
+        self.assertEqual("jmartin", next(utils.quser_candidates(wclass_db, "jmartin")))
+    
+    
+    def test_get_or_create_user_no_retry(self):
+        params = parse_parameters({
+            'user_id':                          '77',
+            'lis_person_contact_email_primary': 'test@email.com',
+            'lis_person_name_family':           'Martin',
+            'lis_person_name_given':            'Jean',
+            'roles':                            "Learner",
+        })
+        wims = WIMS.objects.create(url="https://wims.u-pem.fr/", name="WIMS UPEM",
+                                   ident="X", passwd="X", rclass="myclass")
+        lms = LMS.objects.create(guid="elearning.upem.fr", url="https://elearning.u-pem.fr/",
+                                 name="Moodle UPEM", key="provider1", secret="secret1")
+        wclass_db = WimsClass.objects.create(lms=lms, lms_guid="77777", wims=wims,
+                                             qclass="60004", name="test1")
+        WimsUser.objects.create(lms_guid="0", wclass=wclass_db, quser="jmartin")
+        for i in range(1, 40):
+            WimsUser.objects.create(lms_guid=str(i), wclass=wclass_db, quser="jmartin%d" % i)
+        wclass = mock.Mock()
+        
+        user_db, user = utils.get_or_create_user(wclass_db, wclass, params)
+        
+        wclass.additem.assert_called_once_with(user)
+        self.assertEqual("jmartin40", user.quser)
+        self.assertEqual("jmartin40", user_db.quser)
+    
+    
+    def test_get_or_create_user_race(self):
+        params = parse_parameters({
+            'user_id':                          '77',
+            'lis_person_contact_email_primary': 'test@email.com',
+            'lis_person_name_family':           'Martin',
+            'lis_person_name_given':            'Jean',
+            'roles':                            "Learner",
+        })
+        wims = WIMS.objects.create(url="https://wims.u-pem.fr/", name="WIMS UPEM",
+                                   ident="X", passwd="X", rclass="myclass")
+        lms = LMS.objects.create(guid="elearning.upem.fr", url="https://elearning.u-pem.fr/",
+                                 name="Moodle UPEM", key="provider1", secret="secret1")
+        wclass_db = WimsClass.objects.create(lms=lms, lms_guid="77777", wims=wims,
+                                             qclass="60004", name="test1")
+        WimsUser.objects.create(lms_guid="0", wclass=wclass_db, quser="jmartin")
+        wclass = mock.Mock()
+        wclass.additem.side_effect = [WimsAPIError("user already exists"), None]
+        
+        user_db, user = utils.get_or_create_user(wclass_db, wclass, params)
+        
+        self.assertEqual(2, wclass.additem.call_count)
+        self.assertEqual("jmartin2", user_db.quser)
+    
+    
     def test_get_or_create_user_create_ok(self):
         params = {
             'lti_message_type':                   'basic-lti-launch-request',
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+#
+#  test_worker.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+import threading
+import time
+from datetime import timedelta
+
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from lti_app.models import MailOutbox
+from lti_app.worker import Worker
+
+
+
+class WorkerTestCase(SimpleTestCase):
+    
+    @override_settings(WORKER_THREAD=True, WORKER_POLL_INTERVAL=60, WORKER_BACKLOG_WARNING=None)
+    def test_notify(self):
+        done = threading.Event()
+        worker = Worker(done.set)
+        worker.notify()  # Not started
+        self.assertIsNone(worker._thread)
+        
+        worker.start()
+        self.assertTrue(done.wait(5))
+        
+        done.clear()
+        worker.notify()
+        self.assertTrue(done.wait(5))
+    
+    
+    @override_settings(WORKER_THREAD=True, WORKER_POLL_INTERVAL=0.01)
+    def test_poll(self):
+        done = threading.Event()
+        worker = Worker(done.set)
+        worker.start()
+        self.assertTrue(done.wait(5))
+    
+    
+    @override_settings(WORKER_THREAD=True, WORKER_POLL_INTERVAL=60)
+    def test_exception_does_not_stop_worker(self):
+        calls = []
+        done = threading.Event()
+        
+        def run():
+            calls.append(1)
+            if len(calls) == 1:
+                raise ValueError()
+            done.set()
+        
+        worker = Worker(run)
+        worker.start()
+        worker.notify()
+        for _ in range(500):
+            if calls:
+                break
+            time.sleep(0.01)
+        worker.notify()
+        self.assertTrue(done.wait(5))
+    
+    
+    @override_settings(WORKER_THREAD=False)
+    def test_disabled(self):
+        worker = Worker(lambda: None)
+        worker.start()
+        self.assertIsNone(worker._thread)
+
+
+
+@override_settings(WORKER_THREAD=False, WORKER_BACKLOG_WARNING=60)
+class BacklogTestCase(TestCase):
+    
+    def test_backlog(self):
+        MailOutbox.enqueue("subject", "body", ["a@b.c"])
+        MailOutbox.objects.update(next_attempt=timezone.now() - timedelta(minutes=5))
+        worker = Worker(lambda: None)
+        
+        with self.assertLogs("lti_app.worker", "WARNING") as logs:
+            worker.notify()
+        self.assertIn("0 job(s), 0 deferred grade(s) and 1 mail(s)", logs.output[0])
+        
+        # Checked at most once every WORKER_BACKLOG_WARNING seconds
+        with self.assertNoLogs("lti_app.worker", "WARNING"):
+            worker.notify()
+    
+    
+    def test_no_backlog(self):
+        MailOutbox.enqueue("subject", "body", ["a@b.c"])
+        worker = Worker(lambda: None)
+        
+        with self.assertNoLogs("lti_app.worker", "WARNING"):
+            worker.notify()
@@ -6,48 +6,179 @@
 #       - Coumes Quentin <coumes.quentin@gmail.com>
 #
 
+import copy
 import logging
-import os
 import random
 import string
+import time
+from collections.abc import Mapping
 from datetime import datetime
 from string import ascii_letters, digits
-from typing import Any, Dict, Tuple
+from typing import Any, Dict, FrozenSet, Iterable, Iterator, Tuple
 
 import oauth2
+import requests
 import wimsapi
 from django.conf import settings
 from django.core.exceptions import PermissionDenied
-from django.core.mail import send_mail
+from django.db import transaction
 from django.http import HttpRequest
 from lti.contrib.django import DjangoToolProvider
 from wimsapi import Exam, Sheet
 
+from lti_app import cache, mails
 from lti_app.enums import Role
 from lti_app.exceptions import BadRequestException
-from lti_app.models import LMS, WIMS, WimsClass, WimsExam, WimsSheet, WimsUser
+from lti_app.models import (ClassCreation, LMS, MailOutbox, WIMS, WimsClass, WimsExam, WimsSheet,
+                            WimsUser)
+from lti_app.nonces import nonce_store
 from lti_app.validator import CustomParameterValidator, RequestValidator, validate
+from lti_app.worker import worker
 
 
 logger = logging.getLogger(__name__)
 
 MODE = ["pending", "active", "expired", "hidden"]
 
+# Concurrent creations of a same class in this process are only run once, see
+# get_or_create_class() (nothing is cached)
+class_creations = cache.TTLCache(0)
+
+# Roles considered as a teacher, see is_teacher()
+TEACHER_ROLES = frozenset(settings.ROLES_ALLOWED_CREATE_WIMS_CLASS)
+
+# Every known LTI parameter, with its default value if missing from the request
+LTI_PARAMETERS = {
+    'lti_version':                            None,
+    'context_id':                             None,
+    'context_label':                          None,
+    'context_title':                          None,
+    'context_type':                           None,
+    'custom_canvas_account_id':               None,
+    'custom_canvas_account_sis_id':           None,
+    'custom_canvas_api_domain':               None,
+    'custom_canvas_course_id':                None,
+    'custom_canvas_enrollment_state':         None,
+    'custom_canvas_membership_roles':         '',
+    'custom_canvas_user_id':                  None,
+    'custom_canvas_user_login_id':            None,
+    'launch_presentation_css_url':            None,
+    'launch_presentation_document_target':    None,
+    'launch_presentation_height':             None,
+    'launch_presentation_locale':             None,
+    'launch_presentation_return_url':         None,
+    'launch_presentation_width':              None,
+    'lis_course_offering_sourcedid':          None,
+    'lis_outcome_service_url':                None,
+    'lis_result_sourcedid':                   None,
+    'lis_person_contact_email_primary':       None,
+    'lis_person_name_family':                 None,
+    'lis_person_name_full':                   None,
+    'lis_person_name_given':                  None,
+    'lis_person_sourcedid':                   None,
+    'lti_message_type':                       None,
+    'oauth_consumer_key':                     None,
+    'oauth_consumer_secret':                  None,
+    'oauth_signature_method':                 None,
+    'oauth_timestamp':                        None,
+    'oauth_nonce':                            None,
+    'oauth_version':                          None,
+    'oauth_signature':                        None,
+    'oauth_callback':                         None,
+    'resource_link_description':              None,
+    'resource_link_id':                       None,
+    'resource_link_title':                    None,
+    'roles':                                  '',
+    'selection_directive':                    None,
+    'tool_consumer_info_product_family_code': None,
+    'tool_consumer_info_version':             None,
+    'tool_consumer_instance_contact_email':   None,
+    'tool_consumer_instance_description':     None,
+    'tool_consumer_instance_guid':            None,
+    'tool_consumer_instance_name':            None,
+    'tool_consumer_instance_url':             None,
+    'user_id':                                None,
+    'user_image':                             None,
+    'custom_class_name':                      None,
+    'custom_class_institution':               None,
+    'custom_class_email':                     None,
+    'custom_class_lang':                      None,
+    'custom_class_expiration':                None,
+    'custom_class_limit':                     None,
+    'custom_class_level':                     None,
+    'custom_class_css':                       None,
+    'custom_supervisor_lastname':             None,
+    'custom_supervisor_firstname':            None,
+}
+
+
+
+class LaunchContext(Mapping):
+    """Immutable parameters of a LTI launch request, built once per request by
+    parse_parameters().
+    
+    Behaves like a read-only dict of every parameter of LTI_PARAMETERS. The roles of the user are
+    parsed on first access and cached."""
+    
+    __slots__ = ("_parameters", "_roles")
+    
+    
+    def __init__(self, parameters: Dict[str, Any]):
+        object.__setattr__(self, "_parameters", parameters)
+        object.__setattr__(self, "_roles", None)
+    
+    
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError("LaunchContext is immutable")
+    
+    
+    def __getitem__(self, key: str) -> Any:
+        return self._parameters[key]
+    
+    
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._parameters)
+    
+    
+    def __len__(self) -> int:
+        return len(self._parameters)
+    
+    
+    def __repr__(self) -> str:
+        return "LaunchContext(%s)" % repr(self._parameters)
+    
+    
+    @property
+    def roles(self) -> FrozenSet[Role]:
+        """Roles of the user, parsed from the 'roles' parameter."""
+        if self._roles is None:
+            object.__setattr__(self, "_roles", Role.parse_role_lti(self["roles"]))
+        return self._roles
+    
+    
+    @property
+    def is_teacher(self) -> bool:
+        """Whether the user is considered as a teacher, see is_teacher()."""
+        return is_teacher(self.roles)
 
 
-def is_teacher(role: Role) -> bool:
+
+def is_teacher(role: Iterable[Role]) -> bool:
     """Returns whether role is considered as a teacher."""
-    return not set(role).isdisjoint(settings.ROLES_ALLOWED_CREATE_WIMS_CLASS)
+    return not TEACHER_ROLES.isdisjoint(role)
 
 
 
-def is_valid_request(request: HttpRequest) -> bool:
+def is_valid_request(request: HttpRequest, parameters: LaunchContext = None) -> bool:
     """Check whether the request is valid and is accepted by oauth2.
 
+    <parameters> should be the LaunchContext of the request if it has already been parsed.
+    
     Raises:
         - api.exceptions.BadRequestException if the request is invalid.
         - django.core.exceptions.PermissionDenied if signature check failed."""
-    parameters = parse_parameters(request.POST)
+    if parameters is None:
+        parameters = parse_parameters(request.POST)
     
     if parameters['lti_message_type'] != 'basic-lti-launch-request':
         raise BadRequestException("LTI request is invalid, parameter 'lti_message_type' "
@@ -64,6 +195,13 @@ def is_valid_request(request: HttpRequest) -> bool:
         logger.debug("LTI Authentification aborted: signature check failed with parameters : %s",
                      parameters)
         raise PermissionDenied("Invalid request: signature check failed.")
+    
+    # Remembered only now that the signature is verified, this also rejects a concurrent replay
+    if not nonce_store.add(parameters['oauth_consumer_key'], parameters['oauth_nonce'],
+                           int(time.time())):
+        logger.warning("LTI Authentification aborted: nonce '%s' already used by consumer '%s'"
+                       % (parameters['oauth_nonce'], parameters['oauth_consumer_key']))
+        raise PermissionDenied("Invalid request: nonce already used.")
     return True
 
 
@@ -74,13 +212,13 @@ def check_parameters(param: Dict[str, Any]) -> None:
 
     Raises api.exceptions.BadRequestException if this is not the case."""
     
-    if not all([param[i] is not None for i in settings.LTI_MANDATORY]):
-        missing = [i for i in settings.LTI_MANDATORY if param[i] is None]
+    missing = [i for i in settings.LTI_MANDATORY if param[i] is None]
+    if missing:
         raise BadRequestException("LTI request is invalid, missing parameter(s): "
                                   + str(missing))
     
-    if not all([param[i] is not None for i in settings.WIMSLTI_MANDATORY]):
-        missing = [i for i in settings.WIMSLTI_MANDATORY if param[i] is None]
+    missing = [i for i in settings.WIMSLTI_MANDATORY if param[i] is None]
+    if missing:
         raise BadRequestException("LTI request is invalid, WIMS LTI require parameter(s): "
                                   + str(missing))
 
@@ -118,9 +256,9 @@ def check_custom_parameters(params: Dict[str, Any]) -> None:
 
 
 
-def parse_parameters(p: Dict[str, Any]) -> Dict[str, Any]:
-    """Returns the a dictionnary of the LTI request parameters,
-    replacing missing parameters with None.
+def parse_parameters(p: Dict[str, Any]) -> LaunchContext:
+    """Returns a LaunchContext of the LTI request parameters,
+    replacing missing parameters with their default value (None for most of them).
 
     Raises api.exceptions.BadRequestException if one of the parameters
     starts with 'custom_custom'."""
@@ -131,68 +269,19 @@ def parse_parameters(p: Dict[str, Any]) -> Dict[str, Any]:
                                   " maybe your LMS automatically prefix custom LTI parameters with "
                                   "'custom_': %s" % str(custom_custom))
     
-    return {
-        'lti_version':                            p.get('lti_version'),
-        'context_id':                             p.get('context_id'),
-        'context_label':                          p.get('context_label'),
-        'context_title':                          p.get('context_title'),
-        'context_type':                           p.get('context_type'),
-        'custom_canvas_account_id':               p.get('custom_canvas_account_id'),
-        'custom_canvas_account_sis_id':           p.get('custom_canvas_account_sis_id'),
-        'custom_canvas_api_domain':               p.get('custom_canvas_api_domain'),
-        'custom_canvas_course_id':                p.get('custom_canvas_course_id'),
-        'custom_canvas_enrollment_state':         p.get('custom_canvas_enrollment_state'),
-        'custom_canvas_membership_roles':         p.get('custom_canvas_membership_roles', ''),
-        'custom_canvas_user_id':                  p.get('custom_canvas_user_id'),
-        'custom_canvas_user_login_id':            p.get('custom_canvas_user_login_id'),
-        'launch_presentation_css_url':            p.get('launch_presentation_css_url'),
-        'launch_presentation_document_target':    p.get('launch_presentation_document_target'),
-        'launch_presentation_height':             p.get('launch_presentation_height'),
-        'launch_presentation_locale':             p.get('launch_presentation_locale'),
-        'launch_presentation_return_url':         p.get('launch_presentation_return_url'),
-        'launch_presentation_width':              p.get('launch_presentation_width'),
-        'lis_course_offering_sourcedid':          p.get('lis_course_offering_sourcedid'),
-        'lis_outcome_service_url':                p.get('lis_outcome_service_url'),
-        'lis_result_sourcedid':                   p.get('lis_result_sourcedid'),
-        'lis_person_contact_email_primary':       p.get('lis_person_contact_email_primary'),
-        'lis_person_name_family':                 p.get('lis_person_name_family'),
-        'lis_person_name_full':                   p.get('lis_person_name_full'),
-        'lis_person_name_given':                  p.get('lis_person_name_given'),
-        'lis_person_sourcedid':                   p.get('lis_person_sourcedid'),
-        'lti_message_type':                       p.get('lti_message_type'),
-        'oauth_consumer_key':                     p.get('oauth_consumer_key'),
-        'oauth_consumer_secret':                  p.get('oauth_consumer_secret'),
-        'oauth_signature_method':                 p.get('oauth_signature_method'),
-        'oauth_timestamp':                        p.get('oauth_timestamp'),
-        'oauth_nonce':                            p.get('oauth_nonce'),
-        'oauth_version':                          p.get('oauth_version'),
-        'oauth_signature':                        p.get('oauth_signature'),
-        'oauth_callback':                         p.get('oauth_callback'),
-        'resource_link_description':              p.get('resource_link_description'),
-        'resource_link_id':                       p.get('resource_link_id'),
-        'resource_link_title':                    p.get('resource_link_title'),
-        'roles':                                  p.get('roles', ''),
-        'selection_directive':                    p.get('selection_directive'),
-        'tool_consumer_info_product_family_code': p.get('tool_consumer_info_product_family_code'),
-        'tool_consumer_info_version':             p.get('tool_consumer_info_version'),
-        'tool_consumer_instance_contact_email':   p.get('tool_consumer_instance_contact_email'),
-        'tool_consumer_instance_description':     p.get('tool_consumer_instance_description'),
-        'tool_consumer_instance_guid':            p.get('tool_consumer_instance_guid'),
-        'tool_consumer_instance_name':            p.get('tool_consumer_instance_name'),
-        'tool_consumer_instance_url':             p.get('tool_consumer_instance_url'),
-        'user_id':                                p.get('user_id'),
-        'user_image':                             p.get('user_image'),
-        'custom_class_name':                      p.get('custom_class_name'),
-        'custom_class_institution':               p.get('custom_class_institution'),
-        'custom_class_email':                     p.get('custom_class_email'),
-        'custom_class_lang':                      p.get('custom_class_lang'),
-        'custom_class_expiration':                p.get('custom_class_expiration'),
-        'custom_class_limit':                     p.get('custom_class_limit'),
-        'custom_class_level':                     p.get('custom_class_level'),
-        'custom_class_css':                       p.get('custom_class_css'),
-        'custom_supervisor_lastname':             p.get('custom_supervisor_lastname'),
-        'custom_supervisor_firstname':            p.get('custom_supervisor_firstname'),
-    }
+    return LaunchContext({key: p.get(key, default) for key, default in LTI_PARAMETERS.items()})
+
+
+
+def parse_launch(p: Dict[str, Any]) -> LaunchContext:
+    """Parse and check the parameters of a LTI launch request in a single pass, see
+    parse_parameters(), check_parameters() and check_custom_parameters().
+    
+    Raises api.exceptions.BadRequestException if the parameters are invalid."""
+    parameters = parse_parameters(p)
+    check_parameters(parameters)
+    check_custom_parameters(parameters)
+    return parameters
 
 
 
@@ -252,26 +341,86 @@ def generate_mail(wclass_db: WimsClass, wclass: wimsapi.Class) -> Tuple[str, str
         'wims_url':            wclass_db.wims.url,
     }
     
-    root = os.path.join(settings.MAIL_ROOT, wclass.lang)
-    tpath = os.path.join(root, "title.txt")
-    bpath = os.path.join(root, "body.txt")
-    if not (os.path.isfile(tpath) and os.path.isfile(bpath)):
-        root = os.path.join(settings.MAIL_ROOT, "en")
-        tpath = os.path.join(root, "title.txt")
-        bpath = os.path.join(root, "body.txt")
+    return mails.templates.render(wclass.lang, params)
+
+
+
+def create_class_once(lms: LMS, wims_srv: WIMS, wapi: wimsapi.WimsAPI,
+                      parameters: LaunchContext) -> Tuple[WimsClass, wimsapi.Class]:
+    """Create the class of the LTI request's course on the WIMS server and its WimsClass, unless
+    another process is already creating it, in which case wait for this process to create it
+    (see models.ClassCreation).
+    
+    Raises:
+        - requests.Timeout if the class was still not created by the other process after
+            CLASS_CREATION_TIMEOUT seconds.
+        - wimsapi.WimsAPIError if the WIMS' server denied a request.
+        - requests.RequestException if the WIMS server could not be joined.
     
-    with open(tpath) as t, open(bpath) as b:
-        title = t.read().format(**params)
-        body = b.read().format(**params)
+    Returns a tuple (wclass_db, wclass) where wclas_db is an instance of models.WimsClass and
+    wclass an instance of wimsapi.Class."""
+    context_id = parameters["context_id"]
+    deadline = time.monotonic() + settings.CLASS_CREATION_TIMEOUT
+    while not ClassCreation.acquire(lms, context_id, wims_srv):
+        # acquire() takes the write lock of the database, only reads are thus used to wait until
+        # the class is created, or the lock released or abandoned
+        while True:
+            if time.monotonic() >= deadline:
+                raise requests.Timeout("Timed out waiting for the class of '%s' to be created"
+                                       % context_id)
+            time.sleep(settings.CLASS_CREATION_POLL)
+            wclass_db = WimsClass.objects.filter(wims=wims_srv, lms=lms,
+                                                 lms_guid=context_id).first()
+            if wclass_db is not None:
+                return wclass_db, cache.get_class(wims_srv, wclass_db.qclass)
+            if not ClassCreation.held(lms, context_id, wims_srv):
+                break
     
-    return title.rstrip(), body
+    released = False
+    try:
+        # The class may have been created between the first lookup and the lock
+        wclass_db = WimsClass.objects.filter(wims=wims_srv, lms=lms, lms_guid=context_id).first()
+        if wclass_db is not None:
+            return wclass_db, cache.get_class(wims_srv, wclass_db.qclass)
+        
+        wclass = create_class(wims_srv, parameters)
+        wclass.save(wapi.url, wapi.ident, wapi.passwd, timeout=settings.WIMSAPI_TIMEOUT)
+        # The class is saved with its supervisor, the lock being released in the same transaction,
+        # so that the launches waiting for this class never see it without its supervisor
+        with transaction.atomic():
+            wclass_db = WimsClass.objects.create(
+                lms=lms, lms_guid=parameters["context_id"],
+                wims=wims_srv, qclass=wclass.qclass, name=wclass.name
+            )
+            WimsUser.objects.create(wclass=wclass_db, quser="supervisor")
+            ClassCreation.release(lms, context_id, wims_srv)
+        released = True
+        logger.info("New class created (id : %d - wims id : %s - lms id : %s)"
+                    % (wclass_db.id, str(wclass.qclass), str(wclass_db.lms_guid)))
+        logger.info("New user created (wims id : supervisor - lms id : None) in class %d"
+                    % wclass_db.id)
+        
+        try:
+            # Sent by the worker, so that the launch does not wait for the SMTP server
+            title, body = generate_mail(wclass_db, wclass)
+            MailOutbox.enqueue(title, body, [wclass.supervisor.email], wclass=wclass_db)
+            worker.notify()
+        except Exception:
+            logger.exception("An exception occurred while queuing email:")
+        
+        return wclass_db, wclass
+    finally:
+        if not released:
+            ClassCreation.release(lms, context_id, wims_srv)
 
 
 
 def get_or_create_class(lms: LMS, wims_srv: WIMS, wapi: wimsapi.WimsAPI,
-                        parameters: Dict[str, Any]) -> Tuple[WimsClass, wimsapi.Class]:
+                        parameters: LaunchContext) -> Tuple[WimsClass, wimsapi.Class]:
     """Get the WIMS' class database and wimsapi.Class instances, create them if they does not
     exists.
+    
+    Concurrent launches creating a same class only create it once, see create_class_once().
 
     Raises:
         - exceptions.PermissionDenied if the class does not exists and none of the roles in
@@ -286,10 +435,10 @@ def get_or_create_class(lms: LMS, wims_srv: WIMS, wapi: wimsapi.WimsAPI,
                                           lms_guid=parameters['context_id'])
         
         try:
-            wclass = wimsapi.Class.get(wapi.url, wapi.ident, wapi.passwd, wclass_db.qclass,
-                                       wims_srv.rclass)
+            wclass = cache.get_class(wims_srv, wclass_db.qclass)
         except wimsapi.WimsAPIError as e:
             if "not existing" in str(e):  # Class was deleted on the WIMS server
+                cache.invalidate_class(wims_srv, wclass_db.qclass)
                 logger.info(("Deleting class (id : %d - wims id : %s - lms id : %s) as it was"
                              "deleted from the WIMS server.")
                             % (wclass_db.id, str(wclass_db.qclass), str(wclass_db.lms_guid)))
@@ -298,37 +447,20 @@ def get_or_create_class(lms: LMS, wims_srv: WIMS, wapi: wimsapi.WimsAPI,
             raise  # Unknown error (pragma: no cover)
     
     except WimsClass.DoesNotExist:
-        role = Role.parse_role_lti(parameters["roles"])
+        role = parameters.roles
         if not is_teacher(role):
             logger.warning(str(role))
             msg = ("You must have at least one of these roles to create a Wims class: %s. Your "
                    "roles: %s")
             msg %= (str([r.value for r in settings.ROLES_ALLOWED_CREATE_WIMS_CLASS]),
-                    str([r.value for r in role]))
+                    str(sorted(r.value for r in role)))
             raise PermissionDenied(msg)
         
-        wclass = create_class(wims_srv, parameters)
-        wclass.save(wapi.url, wapi.ident, wapi.passwd, timeout=settings.WIMSAPI_TIMEOUT)
-        wclass_db = WimsClass.objects.create(
-            lms=lms, lms_guid=parameters["context_id"],
-            wims=wims_srv, qclass=wclass.qclass, name=wclass.name
+        key = (lms.pk, parameters["context_id"], wims_srv.pk)
+        wclass_db, wclass = class_creations.get(
+            key, lambda: create_class_once(lms, wims_srv, wapi, parameters)
         )
-        logger.info("New class created (id : %d - wims id : %s - lms id : %s)"
-                    % (wclass_db.id, str(wclass.qclass), str(wclass_db.lms_guid)))
-        WimsUser.objects.create(wclass=wclass_db, quser="supervisor")
-        logger.info("New user created (wims id : supervisor - lms id : None) in class %d"
-                    % wclass_db.id)
-        
-        try:
-            title, body = generate_mail(wclass_db, wclass)
-            send_mail(
-                title,
-                body,
-                settings.SERVER_EMAIL,
-                [wclass.supervisor.email],
-            )
-        except Exception:
-            logger.exception("An exception occurred while sending email:")
+        wclass_db, wclass = copy.copy(wclass_db), copy.copy(wclass)
     
     return wclass_db, wclass
 
@@ -360,7 +492,30 @@ def create_user(parameters: Dict[str, Any]) -> wimsapi.User:
 
 
 
-def get_or_create_user(wclass_db: WimsClass, wclass: wimsapi.Class, parameters: Dict[str, Any]
+def quser_candidates(wclass_db: WimsClass, base: str) -> Iterator[str]:
+    """Yield the quser derived from <base> (base, base1, base2, ...) which are not used by any
+    WimsUser of <wclass_db>, in increasing order.
+    
+    The quser already used are retrieved with a single prefix lookup, so that the first
+    candidate is usually free on the WIMS server too."""
+    used = set()
+    for quser in WimsUser.objects.filter(
+            wclass=wclass_db, quser__startswith=base).values_list("quser", flat=True):
+        suffix = quser[len(base):]
+        if not suffix:
+            used.add(0)
+        elif suffix.isdigit() and suffix[0] != "0":
+            used.add(int(suffix))
+    
+    i = 0
+    while True:
+        if i not in used:
+            yield base + str(i) if i else base
+        i += 1
+
+
+
+def get_or_create_user(wclass_db: WimsClass, wclass: wimsapi.Class, parameters: LaunchContext
                        ) -> Tuple[WimsUser, wimsapi.User]:
     """Get the WIMS' user database and wimsapi.User instances, create them if they does not
     exists.
@@ -375,7 +530,7 @@ def get_or_create_user(wclass_db: WimsClass, wclass: wimsapi.Class, parameters:
     Returns a tuple (user_db, user) where user_db is an instance of models.WimsUser and
     user an instance of wimsapi.User."""
     try:
-        role = Role.parse_role_lti(parameters["roles"])
+        role = parameters.roles
         if is_teacher(role):
             user_db = WimsUser.objects.get(lms_guid=None, wclass=wclass_db)
         else:
@@ -384,25 +539,20 @@ def get_or_create_user(wclass_db: WimsClass, wclass: wimsapi.Class, parameters:
     except WimsUser.DoesNotExist:
         user = create_user(parameters)
         
-        i = 0
-        while True:
+        for i, quser in enumerate(quser_candidates(wclass_db, user.quser)):
+            user.quser = quser
             try:
                 wclass.additem(user)
                 break
             except wimsapi.WimsAPIError as e:
-                # Raised if an user with the same quser already exists,
-                # in this case, keep trying by appending integer to quser (jdoe, jdoe1,
-                # jdoe2, ...), stopping after 100 tries.
+                # Raised if an user with the same quser already exists, which only happens if
+                # it was created concurrently or outside of the LTI, in this case, keep trying
+                # the next free quser, stopping after 100 tries.
                 
                 # Can also be raised if an error occured while communicating with the
                 # WIMS server, hence the following test.
                 if "user already exists" not in str(e) or i >= 100:  # pragma: no cover
                     raise
-                
-                if i:
-                    user.quser = user.quser[:-len(str(i))]
-                i += 1
-                user.quser += str(i)
         
         user_db = WimsUser.objects.create(
             lms_guid=parameters["user_id"], wclass=wclass_db, quser=user.quser
@@ -414,10 +564,28 @@ def get_or_create_user(wclass_db: WimsClass, wclass: wimsapi.Class, parameters:
 
 
 
-def get_sheet(wclass_db: WimsClass, wclass: wimsapi.Class, qsheet: int, parameters: Dict[str, Any]
-              ) -> Tuple[WimsSheet, wimsapi.Sheet]:
+def upsert_activity(model: type, wclass_db: WimsClass, field: str, ident: str, lms_guid: str
+                    ) -> Any:
+    """Get or create the <model> (WimsSheet or WimsExam) of <wclass_db> whose <field> (qsheet or
+    qexam) is <ident>, updating its <lms_guid>. The activity is only written if it is created or
+    if its <lms_guid> changed."""
+    activity, created = model.objects.get_or_create(
+        wclass=wclass_db, **{field: ident}, defaults={"lms_guid": lms_guid}
+    )
+    if created:
+        logger.info("New %s created (wims id: %s - lms id : %s) in class %d"
+                    % (model._meta.verbose_name, ident, lms_guid, wclass_db.id))
+    elif activity.lms_guid != lms_guid:
+        activity.lms_guid = lms_guid
+        model.objects.filter(pk=activity.pk).update(lms_guid=lms_guid)
+    return activity
+
+
+
+def get_sheet(wclass_db: WimsClass, wclass: wimsapi.Class, qsheet: int, parameters: Dict[str, Any],
+              sheet: wimsapi.Sheet = None) -> Tuple[WimsSheet, wimsapi.Sheet]:
     """Get the WIMS' sheet database and wimsapi.Sheet instances, create them if they does not
-    exists.
+    exists. The sheet is only retrieved from <wclass> if <sheet> is not given.
 
     Raises:
         - wimsapi.WimsAPIError if the WIMS' server denied a request.
@@ -426,27 +594,19 @@ def get_sheet(wclass_db: WimsClass, wclass: wimsapi.Class, qsheet: int, paramete
     Returns a tuple (sheet_db, sheet) where sheet_db is an instance of models.WimsSheet and
     sheet an instance of wimsapi.Sheet."""
     
-    sheet = wclass.getitem(qsheet, Sheet)
-    try:
-        sheet_db = WimsSheet.objects.get(wclass=wclass_db, qsheet=str(qsheet))
-        sheet_db.lms_guid = parameters["resource_link_id"]
-        sheet_db.save()
-    except WimsSheet.DoesNotExist:
-        sheet_db = WimsSheet.objects.create(
-            lms_guid=parameters["resource_link_id"],
-            wclass=wclass_db, qsheet=str(qsheet)
-        )
-        logger.info("New sheet created (wims id: %s - lms id : %s) in class %d"
-                    % (str(qsheet), str(sheet_db.lms_guid), wclass_db.id))
+    if sheet is None:
+        sheet = wclass.getitem(qsheet, Sheet)
+    sheet_db = upsert_activity(WimsSheet, wclass_db, "qsheet", str(qsheet),
+                               parameters["resource_link_id"])
     
     return sheet_db, sheet
 
 
 
-def get_exam(wclass_db: WimsClass, wclass: wimsapi.Class, qexam: int, parameters: Dict[str, Any]
-             ) -> Tuple[WimsExam, wimsapi.Exam]:
+def get_exam(wclass_db: WimsClass, wclass: wimsapi.Class, qexam: int, parameters: Dict[str, Any],
+             exam: wimsapi.Exam = None) -> Tuple[WimsExam, wimsapi.Exam]:
     """Get the WIMS' exam database and wimsapi.Exam instances, create them if they does not
-    exists.
+    exists. The exam is only retrieved from <wclass> if <exam> is not given.
 
     Raises:
         - wimsapi.WimsAPIError if the WIMS' server denied a request.
@@ -455,17 +615,9 @@ def get_exam(wclass_db: WimsClass, wclass: wimsapi.Class, qexam: int, parameters
     Returns a tuple (exam_db, exam) where exam_db is an instance of models.WimsExam and
     exam an instance of wimsapi.Exam."""
     
-    exam = wclass.getitem(qexam, Exam)
-    try:
-        exam_db = WimsExam.objects.get(wclass=wclass_db, qexam=str(qexam))
-        exam_db.lms_guid = parameters["resource_link_id"]
-        exam_db.save()
-    except WimsExam.DoesNotExist:
-        exam_db = WimsExam.objects.create(
-            lms_guid=parameters["resource_link_id"],
-            wclass=wclass_db, qexam=str(qexam)
-        )
-        logger.info("New exam created (wims id: %s - lms id : %s) in class %d"
-                    % (str(qexam), str(exam_db.lms_guid), wclass_db.id))
+    if exam is None:
+        exam = wclass.getitem(qexam, Exam)
+    exam_db = upsert_activity(WimsExam, wclass_db, "qexam", str(qexam),
+                              parameters["resource_link_id"])
     
     return exam_db, exam
@@ -13,12 +13,15 @@ from typing import Callable, Optional, Union
 
 import wimsapi
 from django.apps import apps
+from django.conf import settings
 from django.core.exceptions import PermissionDenied, ValidationError
 from django.core.validators import EmailValidator
 from django.http import HttpRequest
 from oauthlib.oauth1 import RequestValidator as BaseRequestValidator
 
 from lti_app.exceptions import BadRequestException
+from lti_app.nonces import nonce_store
+from lti_app.registry import registry
 
 
 logger = logging.getLogger(__name__)
@@ -111,7 +114,7 @@ class RequestValidator(BaseRequestValidator):
         """Check that a LMS with this client_key exists."""
         LMS = apps.get_model('lti_app.LMS')
         try:
-            return bool(LMS.objects.get(key=client_key))
+            return bool(registry.get_lms_by_key(client_key))
         except LMS.DoesNotExist:
             logger.debug("LTI Authentification aborted: Unknown consumer key: '%s'" % client_key)
             raise PermissionDenied("Unknown consumer key: '%s'" % client_key)
@@ -120,11 +123,24 @@ class RequestValidator(BaseRequestValidator):
     def validate_timestamp_and_nonce(self, client_key: str, timestamp: str, nonce: str,
                                      request: HttpRequest, request_token: str = None,
                                      access_token: str = None) -> bool:
-        """Check that timestamp is not older than 30 minutes."""
-        return int(time.time()) - int(timestamp) < 1800
+        """Check that timestamp is neither older nor further in the future than
+        settings.NONCE_WINDOW seconds, and that the nonce was not already used by this client
+        during this window.
+        
+        This is called before the signature is verified, the nonce is thus only remembered once
+        the request is known to be valid (see utils.is_valid_request()), so that unsigned
+        requests cannot fill the nonce store."""
+        now = int(time.time())
+        if abs(now - int(timestamp)) >= settings.NONCE_WINDOW:
+            return False
+        
+        if nonce_store.seen(client_key, nonce, now):
+            logger.warning("LTI Authentification aborted: nonce '%s' already used by consumer "
+                           "'%s'" % (nonce, client_key))
+            return False
+        return True
     
     
     def get_client_secret(self, client_key: str, request: HttpRequest) -> str:
         """Retrieve the secret corresponding to the LMS using client_key."""
-        LMS = apps.get_model('lti_app.LMS')
-        return LMS.objects.get(key=client_key).secret
+        return registry.get_lms_by_key(client_key).secret
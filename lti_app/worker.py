@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+#
+#  worker.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+import logging
+import threading
+import time
+from datetime import timedelta
+from typing import Callable
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from lti_app import tasks
+
+
+logger = logging.getLogger(__name__)
+
+
+
+class Worker:
+    """Background thread running the jobs queued in the database.
+    
+    The thread is started by the 'run_scheduler' command, and when the application is ready if
+    settings.WORKER_IN_PROCESS is True. It picks up the jobs queued by every process, and the
+    deferred grades, every settings.WORKER_POLL_INTERVAL seconds. notify() wakes it up so that
+    the jobs queued by its own process are run right away.
+    
+    The thread is never started if settings.WORKER_THREAD is False, the jobs are then only run
+    when <run> is called explicitly.
+    
+    When jobs are queued by a process which does not run the thread, a warning is logged if some
+    jobs, deferred grades or mails have been waiting for more than
+    settings.WORKER_BACKLOG_WARNING seconds, as no process is then probably running the worker."""
+    
+    
+    def __init__(self, run: Callable[[], None]):
+        self.run = run
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._checked = None
+    
+    
+    def _loop(self) -> None:
+        """Run the jobs each time the worker is notified, or every WORKER_POLL_INTERVAL
+        seconds."""
+        while True:
+            self._event.wait(settings.WORKER_POLL_INTERVAL)
+            self._event.clear()
+            try:
+                self.run()
+            except Exception:
+                logger.exception("An error occurred while running queued jobs:")
+            finally:
+                connection.close()
+    
+    
+    def start(self) -> None:
+        """Start the worker's thread, if enabled and not already running."""
+        if not settings.WORKER_THREAD:
+            return
+        
+        with self._lock:
+            if not self.running():
+                self._thread = threading.Thread(target=self._loop, name="lti-worker",
+                                                daemon=True)
+                self._thread.start()
+    
+    
+    def running(self) -> bool:
+        """Return whether the worker's thread is running in this process."""
+        return self._thread is not None and self._thread.is_alive()
+    
+    
+    def check_backlog(self) -> None:
+        """Log a warning if some jobs, deferred grades or mails have been waiting for more than
+        WORKER_BACKLOG_WARNING seconds. Checked at most once every WORKER_BACKLOG_WARNING seconds,
+        never if it is None."""
+        delay = settings.WORKER_BACKLOG_WARNING
+        now = time.monotonic()
+        if delay is None or (self._checked is not None and now - self._checked < delay):
+            return
+        self._checked = now
+        
+        GradeSyncJob = apps.get_model("lti_app", "GradeSyncJob")
+        GradeOutbox = apps.get_model("lti_app", "GradeOutbox")
+        MailOutbox = apps.get_model("lti_app", "MailOutbox")
+        
+        before = timezone.now() - timedelta(seconds=delay)
+        jobs = GradeSyncJob.objects.filter(created__lt=before).count()
+        grades = GradeOutbox.objects.filter(next_attempt__lt=before).count()
+        mails = MailOutbox.objects.filter(next_attempt__lt=before).count()
+        if jobs or grades or mails:
+            logger.warning(
+                ("%d job(s), %d deferred grade(s) and %d mail(s) have been waiting for more than "
+                 "%d seconds, make sure that 'python3 manage.py run_scheduler' is running")
+                % (jobs, grades, mails, delay)
+            )
+    
+    
+    def notify(self) -> None:
+        """Tell the worker that new jobs were queued. If its thread is not running in this
+        process, the jobs are picked up by the process running it, the backlog being checked
+        (see check_backlog())."""
+        self._event.set()
+        if not self.running():
+            self.check_backlog()
+
+
+
+worker = Worker(tasks.run_pending_jobs)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+#
+#  databases.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+"""
+Database profiles, returning an entry of the DATABASES setting.
+
+To use PostgreSQL instead of the default SQLite database, add to wimsLTI/config.py:
+    
+    from wimsLTI.databases import postgresql
+    DATABASES = {
+        'default': postgresql('wimslti', 'user', 'password', host='localhost'),
+    }
+
+See lti_app/db.py for how the 'PRAGMAS' and 'CONN_HEALTH_CHECKS' keys are applied.
+"""
+
+from typing import Any, Dict
+
+
+
+def sqlite(path: str, timeout: int = 20) -> Dict[str, Any]:
+    """SQLite database stored in <path>.
+    
+    The database is put in WAL mode, so that reading does not block writing (and conversely),
+    with synchronous=NORMAL, which is safe in WAL mode and avoids a fsync per transaction. A
+    connection waits up to <timeout> seconds for the lock held by another connection before
+    failing with 'database is locked'."""
+    return {
+        'ENGINE':  'django.db.backends.sqlite3',
+        'NAME':    path,
+        'OPTIONS': {
+            'timeout': timeout,
+        },
+        'PRAGMAS': {
+            'journal_mode': 'WAL',
+            'synchronous':  'NORMAL',
+            'busy_timeout': timeout * 1000,
+        },
+    }
+
+
+
+def postgresql(name: str, user: str, password: str, host: str = "localhost",
+               port: int = 5432, conn_max_age: int = 60) -> Dict[str, Any]:
+    """PostgreSQL database <name> (requires psycopg2).
+    
+    Connections are kept open for <conn_max_age> seconds and reused by the following requests
+    of the same process, after checking that they are still usable."""
+    return {
+        'ENGINE':             'django.db.backends.postgresql',
+        'NAME':               name,
+        'USER':               user,
+        'PASSWORD':           password,
+        'HOST':               host,
+        'PORT':               str(port),
+        'CONN_MAX_AGE':       conn_max_age,
+        'CONN_HEALTH_CHECKS': True,
+    }
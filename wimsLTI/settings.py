@@ -26,6 +26,7 @@ from apscheduler.triggers.cron import CronTrigger
 from django.contrib.messages import constants as messages
 
 from lti_app.enums import Role
+from wimsLTI import databases
 
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
@@ -83,11 +84,20 @@ WSGI_APPLICATION = 'wimsLTI.wsgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/2.1/ref/settings/#databases
+# See wimsLTI/databases.py for the available profiles: SQLite in WAL mode (default), or PostgreSQL
+# with persistent connections, recommended when running several processes.
 DATABASES = {
+    'default': databases.sqlite(os.path.join(BASE_DIR, 'db.sqlite3')),
+}
+
+# Cache
+# https://docs.djangoproject.com/en/3.2/ref/settings/#caches
+# The default cache is local to each process, a shared backend (e.g. Memcached or Redis) should be
+# used when running several processes (see CONFIG_REGISTRY and NONCE_STORE).
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME':   os.path.join(BASE_DIR, 'db.sqlite3'),
-    }
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
 }
 
 # Logging informations
@@ -229,9 +239,140 @@ CHECK_CLASSES_EXISTS_CRON_TRIGGER = CronTrigger(
     second="0",
 )
 
+# Classes are checked by at most CHECK_CLASSES_WORKERS concurrent requests, and at most
+# CHECK_CLASSES_PER_SERVER concurrent requests to a same WIMS server, see
+# tasks.check_classes_exists().
+CHECK_CLASSES_WORKERS = 16
+CHECK_CLASSES_PER_SERVER = 4
+
+# The scheduled tasks above are run by 'python3 manage.py run_scheduler', which should run in a
+# single dedicated process. Setting SCHEDULER_IN_PROCESS to True runs them in every process of the
+# server instead (e.g. in each worker of gunicorn). Either way, a lock stored in the database
+# ensures that a task is never run by two processes at once. This lock is considered abandoned
+# SCHEDULER_LOCK_TTL seconds after being acquired.
+SCHEDULER_IN_PROCESS = False
+SCHEDULER_LOCK_TTL = 60 * 60 * 6
+
 # Time before requests sent to a WIMS server from wims-lti time out. Should be increased
 # if some WIMS server contains a lot of classes / users.
 WIMSAPI_TIMEOUT = 5
 
+# Classes retrieved from the WIMS servers during the LTI launches are cached for
+# WIMS_CLASS_CACHE_TTL seconds, so that students of a same class launching an activity at the same
+# time only send a single request to the WIMS server. Set to 0 to disable the cache.
+WIMS_CLASS_CACHE_TTL = 0 if TESTING else 30
+
+# WIMS servers are considered available for WIMS_HEALTH_TTL seconds after answering a request
+# checking their availability, the LTI launches then skip this request. They are considered
+# unavailable for WIMS_DOWN_TTL seconds after failing to answer it, the LTI launches then fail
+# right away with a 504 response.
+WIMS_HEALTH_TTL = 0 if TESTING else 10
+WIMS_DOWN_TTL = 0 if TESTING else 5
+
+# During the launches of a sheet or an exam, the activity is retrieved from the WIMS server
+# concurrently with the user if LAUNCH_CONCURRENT is True, by a pool of LAUNCH_WORKERS threads
+# shared by every launch of the process.
+LAUNCH_CONCURRENT = True
+LAUNCH_WORKERS = 16
+
+# LMS and WIMS used by the LTI launches and the OAuth validation are kept in memory, and reloaded
+# once modified. Processes are notified of the modifications made by the others through the
+# default cache: if CONFIG_REGISTRY is None, the registry is thus only enabled (outside of the
+# tests) if this cache is shared by every process (see CACHES). The registry is also reloaded
+# every CONFIG_REGISTRY_TTL seconds, bounding the time a process may use a modified LMS or WIMS if
+# a notification is lost.
+CONFIG_REGISTRY = None
+CONFIG_REGISTRY_TTL = 60
+
+# Nonces of the LTI requests are remembered for NONCE_WINDOW seconds, requests older than that
+# being rejected. NONCE_STORE can be 'memory', keeping at most NONCE_STORE_MAX_SIZE nonces in the
+# memory of each process (expired by slices of NONCE_WINDOW / NONCE_BUCKETS seconds), or 'cache',
+# storing them in the NONCE_CACHE_ALIAS cache of CACHES. If NONCE_STORE is None, 'cache' is used
+# if this cache is shared by every process (e.g. Memcached or Redis), 'memory' otherwise.
+# A replayed request is only rejected if it reaches a process which remembers its nonce: 'memory'
+# thus only protects single-process deployments. When the server runs several processes (e.g.
+# several workers of gunicorn or mod_wsgi), configure a shared cache in CACHES.
+NONCE_WINDOW = 1800
+NONCE_BUCKETS = 60
+NONCE_STORE = None
+NONCE_STORE_MAX_SIZE = 1_000_000
+NONCE_CACHE_ALIAS = "default"
+
+# The duration of each stage of the LTI launches (OAuth validation, class and user retrieval,
+# authentication on the WIMS server, ...) is added to the 'Server-Timing' header of the response
+# if SERVER_TIMING_HEADER is True. If METRICS_ENABLED is True, these durations are also recorded
+# in histograms (with buckets METRICS_BUCKETS, in seconds) labeled by WIMS server and LMS, which
+# are exported in the Prometheus text format at '/metrics/' to the addresses in
+# METRICS_ALLOWED_IPS. Histograms are kept in the memory of each process.
+# These addresses are compared to the REMOTE_ADDR of the request: behind a reverse proxy (e.g.
+# nginx), every request comes from the address of the proxy, which must then not be allowed.
+SERVER_TIMING_HEADER = True
+METRICS_ENABLED = False
+METRICS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+METRICS_ALLOWED_IPS = []
+
+# Maximum number of grades sent back concurrently to the LMSs when sending every grade, and maximum
+# number of these concurrent requests sent to a same LMS.
+SEND_GRADE_BACK_WORKERS = 16
+SEND_GRADE_BACK_PER_LMS = 4
+
+# Grades are sent back by shards of at most GRADE_SYNC_SHARD_SIZE classes of a same WIMS server,
+# which can be run by several processes at once (see 'python3 manage.py sync_grades'). Each shard
+# saves its progress every GRADE_SYNC_CHECKPOINT classes, and is taken over by another process if
+# its progress was not saved for GRADE_SYNC_LEASE seconds, so that an interrupted synchronization
+# resumes where it stopped.
+GRADE_SYNC_SHARD_SIZE = 50
+GRADE_SYNC_CHECKPOINT = 10
+GRADE_SYNC_LEASE = 60 * 10
+
+# HTTP connections to the LMSs and WIMS servers are pooled and kept alive for each host. At most
+# HTTP_POOL_SIZE connections are kept for a same host (should not be lower than
+# SEND_GRADE_BACK_PER_LMS). Requests failing to connect are retried HTTP_POOL_RETRIES times, with
+# an exponential backoff of HTTP_POOL_BACKOFF seconds.
+HTTP_POOL_SIZE = 16
+HTTP_POOL_KEEP_ALIVE = True
+HTTP_POOL_RETRIES = 2
+HTTP_POOL_BACKOFF = 0.2
+
+# Jobs queued in the database (e.g. sending every grade of an activity when a teacher launches it,
+# retrying deferred grades, sending queued mails) are run by a background thread started by
+# 'python3 manage.py run_scheduler', which picks them up every WORKER_POLL_INTERVAL seconds.
+# Setting WORKER_IN_PROCESS to True also starts this thread in every process of the server, which
+# then runs the jobs it queues right away. The thread is never started if WORKER_THREAD is False.
+#
+# A process queuing jobs without running this thread logs a warning if some jobs, deferred grades
+# or mails have been waiting for more than WORKER_BACKLOG_WARNING seconds, which usually means that
+# 'run_scheduler' is not running. Set to None to disable this warning.
+WORKER_THREAD = not TESTING
+WORKER_IN_PROCESS = False
+WORKER_POLL_INTERVAL = 10
+WORKER_BACKLOG_WARNING = 60 * 15
+
+# Grades which could not be sent back to the LMS are sent again by the worker, after a delay
+# starting at OUTBOX_BACKOFF seconds and doubling after each failure, up to OUTBOX_BACKOFF_MAX
+# seconds. A grade is dropped after OUTBOX_MAX_ATTEMPTS failed attempts. At most OUTBOX_BATCH_SIZE
+# grades are sent each time the worker runs.
+OUTBOX_BACKOFF = 60
+OUTBOX_BACKOFF_MAX = 60 * 60 * 6
+OUTBOX_MAX_ATTEMPTS = 12
+OUTBOX_BATCH_SIZE = 500
+
+# Once CIRCUIT_BREAKER_THRESHOLD grades in a row failed to be sent to a same LMS, no grade is sent
+# to this LMS for CIRCUIT_BREAKER_COOLDOWN seconds, these grades being deferred to the outbox.
+CIRCUIT_BREAKER_THRESHOLD = 5
+CIRCUIT_BREAKER_COOLDOWN = 60 * 5
+
+# Launches creating a same class concurrently wait for the first one to create it, checking every
+# CLASS_CREATION_POLL seconds, for at most CLASS_CREATION_TIMEOUT seconds (should be greater than
+# WIMSAPI_TIMEOUT).
+CLASS_CREATION_POLL = 0.2
+CLASS_CREATION_TIMEOUT = 30
+
+# Rosters are provisioned by batches of ROSTER_BATCH_SIZE users (see the 'provision_roster'
+# command), the accounts of a batch being created by at most ROSTER_WORKERS concurrent requests to
+# the WIMS server (should not be greater than HTTP_POOL_SIZE).
+ROSTER_BATCH_SIZE = 100
+ROSTER_WORKERS = 8
+
 # Allow the file 'wimsLTI/config.py' to override these settings.
 from wimsLTI.config import *  # noqa: E402 F401 F403